@@ -1,20 +1,32 @@
 # -*- coding: utf-8 -*-
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
 import plotly.graph_objs as go
-import plotly.express as px
-from plotly.subplots import make_subplots
 
 import pandas as pd
-from pandas.tseries.offsets import *
 pd.options.mode.chained_assignment = None
 
 import numpy as np
-import json
 
+import copy
+import functools
+import json
 import os
-
+import threading
+import uuid
+from collections import namedtuple
+
+import figure_cache
+import instrumentation
+import payload
+import reloader
+import scheduler
+import series_api
+import shared_cache
+import smoothing
+import snapshot
 
 default_colors = [ '#636EFA', '#EF553B', '#00CC96', '#AB63FA', '#FFA15A', '#19D3F3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52',
 '#9e7200', '#00588d', '#ff0000', '#352300', '#ff003e',
@@ -25,28 +37,31 @@ default_colors = [ '#636EFA', '#EF553B', '#00CC96', '#AB63FA', '#FFA15A', '#19D3
 '#007200', '#ff4f00', '#00b9ff', '#00ffb9', '#ffc100', '#0046ff', '#00ff00', '#ff00ff']
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 default_states = []
+default_metros_per_state = 4
+
+# Facets of the county plot built per request, the others are on further pages
+facets_per_page = int(os.environ.get('FACETS_PER_PAGE', 10))
 
 # Import data
-# Load cases/deaths data
-cases_data = pd.read_csv('data/cases_and_deaths.csv', parse_dates=['date'])
-cases_data['day_of_week'] = cases_data['date'].dt.day_name()
-cases_data['city'] = cases_data['city'].str.split(',').str[0]
-
-# Get the dates which are weekends
-all_dates = cases_data[['date', 'day_of_week']].drop_duplicates()
-present_saturdays = set(all_dates[all_dates['day_of_week'] == 'Saturday']['date'])
-implied_saturdays = set(all_dates[all_dates['day_of_week'] == 'Sunday']['date'] - pd.DateOffset(days=1))
-saturdays = present_saturdays.union(implied_saturdays)
-
-# Get all the states present in the data for the map
-states = cases_data[cases_data['state_abbreviation'] != '']['state_abbreviation'].drop_duplicates().to_frame().reset_index(drop=True)
-states_with_county = set(cases_data[cases_data.county.notnull()]['state_abbreviation'])
-states['has_counties'] = states['state_abbreviation'].isin(states_with_county)
-
-# For the Date slider
-dates = cases_data['date'].drop_duplicates().sort_values().reset_index(drop=True)
-min_date = min(dates)
-max_date = max(dates)
+# Load cases/deaths data and everything derived from it. Replaced as a whole when a new version of the
+# data is published, see reloader.Reloader
+data_snapshot = snapshot.load()
+
+# A line of the cases plot, and a facet holding a line per county
+Group = namedtuple('Group', ['name', 'entity', 'plot_bool'])
+Facet = namedtuple('Facet', ['name', 'lines'])
+
+# Built figures of the cases plot, keyed on the normalized callback inputs
+cases_plot_cache = figure_cache.FigureCache(max_entries=int(os.environ.get('FIGURE_CACHE_ENTRIES', 256)),
+                                            max_bytes=int(os.environ.get('FIGURE_CACHE_MB', 64))*1024*1024)
+cases_plot_cache.invalidate(data_snapshot.version)
+
+# Figures and series shared by the workers of this machine, on top of the per-process caches
+shared_results = shared_cache.open_cache()
+shared_results.purge(data_snapshot.version)
+
+# Slots for the figure builds of browser sessions, superseded requests are dropped
+build_scheduler = scheduler.BuildScheduler()
 
 empty_plot = {
         'data': [],
@@ -65,195 +80,312 @@ empty_plot = {
             })
         }
 
+# Build the most requested cases plots at startup and after every reload, see warm_up
+warm_up_figures = os.environ.get('WARM_UP_FIGURES', '1') == '1'
+
+# Milliseconds each date is shown when the metric map plays
+map_frame_ms = int(os.environ.get('MAP_FRAME_MS', 100))
+
+# Toggle map selections in the browser instead of with a round trip to the server
+clientside_map = os.environ.get('CLIENTSIDE_MAP', '1') == '1'
+
+# Send the series of the selected lines to the browser and switch the metric, smoothing and dates there,
+# instead of building a figure on the server for every change of the controls
+clientside_plot = os.environ.get('CLIENTSIDE_PLOT', '1') == '1'
+
 # Build the app
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 server = app.server
 server.secret_key = os.environ.get('SECRET_KEY', 'my-secret-key')
 
+# Opt-in with DASH_INSTRUMENTATION=1: Server-Timing headers and histograms on /metrics
+instrumentation.instrument(server)
+instrumentation.add_metrics_source('cases_plot_cache', cases_plot_cache.stats)
+instrumentation.add_metrics_source('build_scheduler', build_scheduler.stats)
+instrumentation.add_metrics_source('shared_cache', shared_results.stats)
 
-app.title = 'Covid-19 Dashboard'
-app.layout = html.Div([
-    # row - Header
-    html.Div([
-        html.H1(children='COVID 19 Cases And Deaths',
-                className='twelve columns'),
-        html.P(["Data Source: ", html.A('Johns Hopkins University Center for Systems Science and Engineering',
-                                         href='https://github.com/CSSEGISandData/COVID-19'), html.Br(),
-                "Author: ", html.A('Jack Barbey', href='https://www.linkedin.com/in/jack-barbey/')]
-        ),
-    ], className='row', style={'marginBottom': 20}),
+# Series as JSON or CSV on /api/series.json and /api/series.csv, for consumers which don't need the plots
+series_api.SeriesAPI(lambda: data_snapshot, shared_results, build_scheduler).register(server)
 
-    html.Button('Notes & Instructions', id='instructions-button', n_clicks=0),
-    html.Div([  # instructions modal div
-        html.Div([  # content div
-            html.Div([
-                html.H6('Steps For Use:'),
-                html.P([
-                    '1. Select which states to include by clicking them on the map.', html.Br(),
-                    '2. Select the range of dates to display. It is automatically set to the maximum date range.', html.Br(),
-                    '3. Select whether to view the data aggregated for the state overall or for the top 4 metropolitan areas in each state.', html.Br(),
-                    '4. Select whether to display confirmed cases or deaths, both normalized by population', html.Br(),
-                    '5. Select whether to break the plots out by indiviudal counties.', html.Br(),
-                    '6. Select whether to plot daily new records or cumulative counts over time.', html.Br(),
-                    '7. Select whether to smooth the data using a locally linear Savgol Filter, window size of 13 days.', html.Br(),
-                ]),
-                html.H6('Notes and Tips:'),
-                html.P([
-                    "- For metro areas which extend over multiple states, each state's portion of that metro area will be shown indiviudally when 'Metro' aggregation is selected. ", html.Br(),
-                    "- The gray bars on the plots indicate weekends.", html.Br(),
-                    "- You may need to scroll on the legend at the bottom to display the full list.", html.Br(),
-                    "- Items in the plot's legends can be clicked to be removed or double clicked to isolate their lines.", html.Br(),
-                    "- You can zoom in on the plot by drawing a rectangle over the portion of interest.", html.Br(),
-                ]),
 
-            ]),
+def load_snapshot():
+    return snapshot.load()
 
-            html.Hr(),
-            html.Button('Close', id='modal-close-button')
-        ],
 
-            className='modal-content',
-        ),
-        ],
-        id='modal',
-        className='modal',
-        style={"display": "none"},
-    ),
-    html.Br(),
-
-    # row - all selectors
-    html.Div([
-        # column - Map
-        html.Div([
-                # Choose a state
-                dcc.Graph(id='states-plot', figure=empty_plot),  # Initialize empty until 1st callback
+def swap_snapshot(new_snapshot):
+    """
+    Serve new_snapshot from now on. Requests already running finish with the snapshot they started with
+    """
+    global data_snapshot
+    data_snapshot = new_snapshot
+    cases_plot_cache.invalidate(new_snapshot.version)
+    shared_results.purge(new_snapshot.version)
+    if warm_up_figures:
+        warm_up(new_snapshot)
+
 
-                # Stores which states are clicked
-                dcc.Store(id='states-memory', data=default_states),
+# Watch for new versions of the data (DATA_RELOAD_SECONDS), from the first request of each worker
+data_reloader = reloader.Reloader(load_snapshot, swap_snapshot, data_snapshot.version)
+server.before_request(data_reloader.ensure_started)
 
-        ], className='seven columns'),
 
-        # column - All other selectors
+app.title = 'Covid-19 Dashboard'
+def serve_layout():
+    """
+    The layout is built on every page load, so that new pages get the bounds and map of the current data
+    """
+    data = data_snapshot
+
+    return html.Div([
+        # row - Header
         html.Div([
-            # row - Date range and state/city
-            html.Div([
-                # column - date range
-                html.Div([
-                    html.H6('Date Range:'),
-                    dcc.DatePickerRange(
-                        id='date-range',
-                        min_date_allowed=min_date,
-                        start_date=min_date,
-                        max_date_allowed=max_date,
-                        end_date=max_date,
-                        initial_visible_month=max_date
-                        ),
-                ], className='seven columns',  style={'marginLeft': 0, 'marginRight':15}),
+            html.H1(children='COVID 19 Cases And Deaths',
+                    className='twelve columns'),
+            html.P(["Data Source: ", html.A('Johns Hopkins University Center for Systems Science and Engineering',
+                                             href='https://github.com/CSSEGISandData/COVID-19'), html.Br(),
+                    "Author: ", html.A('Jack Barbey', href='https://www.linkedin.com/in/jack-barbey/')]
+            ),
+        ], className='row', style={'marginBottom': 20}),
 
-                # column - state/city
+        html.Button('Notes & Instructions', id='instructions-button', n_clicks=0),
+        html.Div([  # instructions modal div
+            html.Div([  # content div
                 html.Div([
-                    html.H6('State or City:'),
-                    dcc.RadioItems(
-                        id='state-or-city-selector',
-                        options=[
-                            {'label': 'State', 'value': 'state'},
-                            {'label': 'Metro', 'value': 'state_metro'},
-                        ],
-                        value='state',
-                        #labelStyle={'display': 'inline-block'}
-                    ),
-                ], className='five columns', style={'marginLeft': 0, 'marginRight':0}),
-            ], className='row', style={'marginBottom': 25}),
+                    html.H6('Steps For Use:'),
+                    html.P([
+                        '1. Select which states to include by clicking them on the map.', html.Br(),
+                        '2. Select the range of dates to display. It is automatically set to the maximum date range.', html.Br(),
+                        '3. Select whether to view the data aggregated for the state overall or for the largest metropolitan areas in each state, and how many metropolitan areas to show per state.', html.Br(),
+                        '4. Select whether to display confirmed cases or deaths, both normalized by population', html.Br(),
+                        '5. Select whether to break the plots out by indiviudal counties.', html.Br(),
+                        '6. Select whether to plot daily new records or cumulative counts over time.', html.Br(),
+                        '7. Select whether to smooth the data using a locally linear Savgol Filter, and its window size in days.', html.Br(),
+                    ]),
+                    html.H6('Notes and Tips:'),
+                    html.P([
+                        "- For metro areas which extend over multiple states, each state's portion of that metro area will be shown indiviudally when 'Metro' aggregation is selected. ", html.Br(),
+                        "- The gray bars on the plots indicate weekends.", html.Br(),
+                        "- You may need to scroll on the legend at the bottom to display the full list.", html.Br(),
+                        "- Items in the plot's legends can be clicked to be removed or double clicked to isolate their lines.", html.Br(),
+                        "- You can zoom in on the plot by drawing a rectangle over the portion of interest.", html.Br(),
+                    ]),
 
-            # row - deaths/cases and county
+                ]),
+
+                html.Hr(),
+                html.Button('Close', id='modal-close-button')
+            ],
+
+                className='modal-content',
+            ),
+            ],
+            id='modal',
+            className='modal',
+            style={"display": "none"},
+        ),
+        html.Br(),
+
+        # row - all selectors
+        html.Div([
+            # column - Map
             html.Div([
-                # column - deaths/cases
-                html.Div([
-                    html.H6('Confirmed Cases or Deaths'),
-                    dcc.RadioItems(
-                        id='cases-or-deaths',
-                        options=[
-                            {'label': 'Cases Per 100,000 People', 'value': 'cases'},
-                            {'label': 'Deaths Per 100,000 People', 'value': 'deaths'},
-                        ],
-                        value='cases'
-                    ),
-                ], className='seven columns',  style={'marginLeft': 0, 'marginRight':15}),
+                    # Choose a state
+                    dcc.Graph(id='states-plot', figure=data.base_map_figure),
 
-                # column - county selector
-                html.Div([
-                    html.H6('By County'),
+                    # Optionally the plotted metric of every state, animated over the selected dates
                     dcc.Checklist(
-                        id='cases-by-county',
-                        options=[
-                            {'label': 'Show', 'value': 1},
-                        ],
+                        id='metric-map-toggle',
+                        options=[{'label': 'Map the plotted metric over time', 'value': 1}],
                         value=[]
                     ),
-                ], className='five columns', style={'marginLeft': 0, 'marginRight':0}),
-            ], className='row', style={'marginBottom': 25}),
+                    html.Div([
+                        dcc.Graph(id='metric-map', figure=empty_plot)
+                    ], id='metric-map-container', style={'display': 'none'}),
+
+                    # Series of the metric map drawn by the browser, see produce_metric_map_series, or the controls of
+                    # the map built by the server, only passed on while it is shown, see produce_metric_map
+                    html.Div([dcc.Store(id='metric-map-series-request'), dcc.Store(id='metric-map-series')] if clientside_plot
+                             else [dcc.Store(id='metric-map-request')]),
+
+                    # Stores which states are clicked
+                    dcc.Store(id='states-memory', data=default_states),
+
+                    # Identifies the page, for dropping the requests it supersedes
+                    dcc.Store(id='session-id', data=uuid.uuid4().hex),
 
-            # row - new/cumulative and smooth
+                    # Series of the cases plot drawn by the browser, see produce_plot_series, and the figures of the
+                    # selections too large for it, see produce_requested_cases_plot
+                    html.Div([dcc.Store(id='plot-series', data=plot_series(data, *default_plot_series_inputs(data))),
+                              dcc.Store(id='cases-plot-request'),
+                              dcc.Store(id='requested-cases-plot')] if clientside_plot else []),
+
+                    # Version of the data the page shows, checked periodically for a reload
+                    dcc.Store(id='data-version', data={'version': data.version, 'max_date': data.max_date.strftime('%Y-%m-%d')}),
+                    dcc.Interval(id='data-version-interval', interval=max(reloader.INTERVAL_SECONDS, 1)*1000,
+                                 disabled=reloader.INTERVAL_SECONDS <= 0),
+
+            ], className='seven columns'),
+
+            # column - All other selectors
             html.Div([
-                # column - new/cumulative
+                # row - Date range and state/city
                 html.Div([
-                    html.H6('Daily New or Cumulative'),
-                    dcc.RadioItems(
-                        id='cumulative-or-new',
-                        options=[
-                            {'label': 'New', 'value': 'new'},
-                            {'label': 'Cumulative', 'value': 'cumulative'},
-                        ],
-                        value='new'
-                    ),
-                ], className='seven columns',  style={'marginLeft': 0, 'marginRight':15}),
+                    # column - date range
+                    html.Div([
+                        html.H6('Date Range:'),
+                        dcc.DatePickerRange(
+                            id='date-range',
+                            min_date_allowed=data.min_date,
+                            start_date=data.min_date,
+                            max_date_allowed=data.max_date,
+                            end_date=data.max_date,
+                            initial_visible_month=data.max_date
+                            ),
+                    ], className='seven columns',  style={'marginLeft': 0, 'marginRight':15}),
+
+                    # column - state/city
+                    html.Div([
+                        html.H6('State or City:'),
+                        dcc.RadioItems(
+                            id='state-or-city-selector',
+                            options=[
+                                {'label': 'State', 'value': 'state'},
+                                {'label': 'Metro', 'value': 'state_metro'},
+                            ],
+                            value='state',
+                            #labelStyle={'display': 'inline-block'}
+                        ),
+                        html.H6('Metros Per State:'),
+                        dcc.Dropdown(
+                            id='metros-per-state',
+                            options=[{'label': str(i), 'value': i} for i in [1, 2, 3, 4, 5, 10]] + [{'label': 'All', 'value': 0}],
+                            value=default_metros_per_state,
+                            clearable=False,
+                        ),
+                    ], className='five columns', style={'marginLeft': 0, 'marginRight':0}),
+                ], className='row', style={'marginBottom': 25}),
 
-                # column - smooth or not
+                # row - deaths/cases and county
                 html.Div([
-                    html.H6('Smooth Data'),
-                    dcc.Checklist(
-                        id='smooth-cases',
-                        options=[
-                            {'label': 'Show', 'value': 1},
-                        ],
-                        value=[]
-                    ),
-                ], className='five columns', style={'marginLeft': 0, 'marginRight':0}),
+                    # column - deaths/cases
+                    html.Div([
+                        html.H6('Confirmed Cases or Deaths'),
+                        dcc.RadioItems(
+                            id='cases-or-deaths',
+                            options=[
+                                {'label': 'Cases Per 100,000 People', 'value': 'cases'},
+                                {'label': 'Deaths Per 100,000 People', 'value': 'deaths'},
+                            ],
+                            value='cases'
+                        ),
+                    ], className='seven columns',  style={'marginLeft': 0, 'marginRight':15}),
+
+                    # column - county selector
+                    html.Div([
+                        html.H6('By County'),
+                        dcc.Checklist(
+                            id='cases-by-county',
+                            options=[
+                                {'label': 'Show', 'value': 1},
+                            ],
+                            value=[]
+                        ),
+                    ], className='five columns', style={'marginLeft': 0, 'marginRight':0}),
+                ], className='row', style={'marginBottom': 25}),
 
-            ], className='row', style={'marginBottom': 25})
+                # row - new/cumulative and smooth
+                html.Div([
+                    # column - new/cumulative
+                    html.Div([
+                        html.H6('Daily New or Cumulative'),
+                        dcc.RadioItems(
+                            id='cumulative-or-new',
+                            options=[
+                                {'label': 'New', 'value': 'new'},
+                                {'label': 'Cumulative', 'value': 'cumulative'},
+                            ],
+                            value='new'
+                        ),
+                    ], className='seven columns',  style={'marginLeft': 0, 'marginRight':15}),
+
+                    # column - smooth or not
+                    html.Div([
+                        html.H6('Smooth Data'),
+                        dcc.RadioItems(
+                            id='smooth-cases',
+                            options=[{'label': 'Off', 'value': 0}] +
+                                    [{'label': '{} Days'.format(i), 'value': i} for i in smoothing.WINDOW_LENGTHS],
+                            value=0
+                        ),
+                    ], className='five columns', style={'marginLeft': 0, 'marginRight':0}),
+
+                ], className='row', style={'marginBottom': 25})
 
-        ], className='five columns', style={'marginLeft': 5, 'marginRight':0})
+            ], className='five columns', style={'marginLeft': 5, 'marginRight':0})
 
-    ], className='row', style={'marginBottom': 25, 'marginTop': 30}),
+        ], className='row', style={'marginBottom': 25, 'marginTop': 30}),
 
-    # row - Plot title
-    html.Div([
-        html.H3('Cases and Deaths Data, Normalized by Population')
-    ], className='row'),
+        # row - Plot title
+        html.Div([
+            html.H3('Cases and Deaths Data, Normalized by Population')
+        ], className='row'),
 
 
-    # row - Cases/Deaths plot
-    html.Div([
+        # row - Cases/Deaths plot
         html.Div([
-            dcc.Graph(id='cases-plot', figure=empty_plot)  # Initialize empty until 1st callback
-        ], className='twelve columns'),
-    ], className='row'),
-])
+            html.Div([
+                # Pages of the county plot
+                html.Div([
+                    html.H6('Facets:', style={'display': 'inline-block', 'marginRight': 10}),
+                    dcc.RadioItems(
+                        id='facet-page',
+                        options=[],
+                        value=0,
+                        labelStyle={'display': 'inline-block'},
+                        style={'display': 'inline-block'}
+                    ),
+                ], id='facet-pager', style={'display': 'none'}),
+
+                dcc.Graph(id='cases-plot', figure=cases_plot(data, *default_cases_plot_inputs(data)))  # Prerendered, no callback on load
+            ], className='twelve columns'),
+        ], className='row'),
+    ])
+
 
 
 @app.callback(
-    [dash.dependencies.Output('states-plot', 'figure'),
-     dash.dependencies.Output('states-memory', 'data')],
-    [dash.dependencies.Input('states-plot', 'clickData')],
-    [dash.dependencies.State('states-memory', 'data')]
+    [dash.dependencies.Output('date-range', 'min_date_allowed'),
+     dash.dependencies.Output('date-range', 'max_date_allowed'),
+     dash.dependencies.Output('date-range', 'end_date'),
+     dash.dependencies.Output('data-version', 'data')],
+    [dash.dependencies.Input('data-version-interval', 'n_intervals')],
+    [dash.dependencies.State('data-version', 'data'),
+     dash.dependencies.State('date-range', 'end_date')],
+    prevent_initial_call=True
     )
-def display_map(clickData, states_store):
+def refresh_date_range(n_intervals, shown, end_date):
     """
-    Make the clickable map
+    Extend the date picker of an open page to the dates of reloaded data. The end date only follows
+    the new last date if it was on the last date before, otherwise the user's choice is kept.
     """
-    states['selection'] = 0
+    data = data_snapshot
+    if shown is not None and shown['version'] == data.version:
+        raise dash.exceptions.PreventUpdate
+
+    max_date = data.max_date.strftime('%Y-%m-%d')
+    new_end_date = dash.no_update
+    if shown is None or end_date is None or pd.to_datetime(end_date) >= pd.to_datetime(shown['max_date']):
+        new_end_date = max_date
+
+    return data.min_date.strftime('%Y-%m-%d'), max_date, new_end_date, {'version': data.version, 'max_date': max_date}
+
 
+@instrumentation.timed('display_map')
+def display_map(clickData, states_store):
+    """
+    Make the clickable map. Doesn't touch any module state, the selection is applied to a copy of the base figure
+    """
     current_selected_states = set(states_store)
 
     if clickData is not None:
@@ -263,148 +395,604 @@ def display_map(clickData, states_store):
         else:
             current_selected_states.remove(selected_state)
 
-    states_to_show = states
-    states_to_show.loc[states_to_show.state_abbreviation.isin(current_selected_states), 'selection'] = 1
-
-    data = go.Choropleth({
-         'colorscale': [[0, '#009dd9'], [0.5, '#a5a5a4'], [1, '#ffcd00']],
-         'geo': 'geo',
-         'hovertemplate': '%{location}',
-         'locationmode': 'USA-states',
-         'locations': states_to_show['state_abbreviation'],
-         'name': '',
-         'showlegend': False,
-         'showscale': False,
-         'z': states_to_show['selection']
-    })
+    data = data_snapshot
+    selection = data.states['state_abbreviation'].isin(current_selected_states).astype(int).tolist()
+
+    base_choropleth = data.base_map_figure['data'][0]
+    plot = dict(data.base_map_figure, data=[dict(base_choropleth, z=selection)])
+
+    return plot, list(current_selected_states)
+
+
+if clientside_map:
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='map', function_name='toggle_state'),
+        [dash.dependencies.Output('states-plot', 'figure'),
+         dash.dependencies.Output('states-memory', 'data')],
+        [dash.dependencies.Input('states-plot', 'clickData')],
+        [dash.dependencies.State('states-memory', 'data'),
+         dash.dependencies.State('states-plot', 'figure')],
+        prevent_initial_call=True
+        )
+else:
+    app.callback(
+        [dash.dependencies.Output('states-plot', 'figure'),
+         dash.dependencies.Output('states-memory', 'data')],
+        [dash.dependencies.Input('states-plot', 'clickData')],
+        [dash.dependencies.State('states-memory', 'data')],
+        prevent_initial_call=True
+        )(display_map)
+
+
+def scheduled_callback(callback):
+    """
+    Decorator of the callbacks building figures through build_scheduler: requests superseded by a newer one of
+    the same page get no update, and requests finding every build slot taken for too long get a 503
+    """
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        try:
+            return callback(*args, **kwargs)
+        except scheduler.Superseded:
+            raise dash.exceptions.PreventUpdate
+        except scheduler.Busy:
+            flask.abort(flask.Response('Too many plots are being built, try again', status=503, headers={'Retry-After': '1'}))
+
+    return wrapper
+
+
+@instrumentation.timed('produce_cases_plot')
+@scheduled_callback
+def produce_cases_plot(states_list, state_or_metro, metros_per_state, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new, facet_page, session_id):
+    """
+    Serves the cases plot of the current snapshot. Not called on page load, the layout embeds the default plot.
+    """
+    # Take the current snapshot once, a reload swapping it meanwhile doesn't affect this figure
+    return cases_plot(data_snapshot, states_list, state_or_metro, metros_per_state, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new, facet_page, session_id)
+
+
+@instrumentation.timed('produce_plot_series')
+@scheduled_callback
+def produce_plot_series(states_list, state_or_metro, metros_per_state, cases_by_county, facet_page, data_version, session_id):
+    """
+    Serves the series of the cases plot of the current snapshot for the browser to draw, see plot_series.
+    Only called when the selection or the data change, the metric, smoothing and dates are switched in the browser.
+    """
+    return plot_series(data_snapshot, states_list, state_or_metro, metros_per_state, cases_by_county, facet_page, session_id)
+
+
+@instrumentation.timed('produce_requested_cases_plot')
+@scheduled_callback
+def produce_requested_cases_plot(request, session_id):
+    """
+    Serves the cases plot of a selection too large for the browser to draw, see build_plot_series, for the
+    selection and controls passed on by plot.request_cases_plot. The request comes back with the figure, so
+    plot.render only draws the figure of the current controls.
+    """
+    states_list, state_or_metro, metros_per_state, cases_by_county, facet_page, first_date, last_date, smooth_data, cases_or_deaths, cumulative_or_new = request
+    figure = cases_plot(data_snapshot, states_list, state_or_metro, metros_per_state, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new, facet_page, session_id)
+    return {'request': request, 'figure': figure}
+
+
+if clientside_plot:
+    app.callback(
+        dash.dependencies.Output('plot-series', 'data'),
+        [dash.dependencies.Input('states-memory', 'data'),
+         dash.dependencies.Input('state-or-city-selector', 'value'),
+         dash.dependencies.Input('metros-per-state', 'value'),
+         dash.dependencies.Input('cases-by-county', 'value'),
+         dash.dependencies.Input('facet-page', 'value'),
+         dash.dependencies.Input('data-version', 'data')],
+        [dash.dependencies.State('session-id', 'data')],
+        prevent_initial_call=True
+        )(produce_plot_series)
+
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='plot', function_name='request_cases_plot'),
+        dash.dependencies.Output('cases-plot-request', 'data'),
+        [dash.dependencies.Input('plot-series', 'data'),
+         dash.dependencies.Input('date-range', 'start_date'),
+         dash.dependencies.Input('date-range', 'end_date'),
+         dash.dependencies.Input('smooth-cases', 'value'),
+         dash.dependencies.Input('cases-or-deaths', 'value'),
+         dash.dependencies.Input('cumulative-or-new', 'value')],
+        prevent_initial_call=True
+        )
+
+    app.callback(
+        dash.dependencies.Output('requested-cases-plot', 'data'),
+        [dash.dependencies.Input('cases-plot-request', 'data')],
+        [dash.dependencies.State('session-id', 'data')],
+        prevent_initial_call=True
+        )(produce_requested_cases_plot)
+
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='plot', function_name='render'),
+        dash.dependencies.Output('cases-plot', 'figure'),
+        [dash.dependencies.Input('plot-series', 'data'),
+         dash.dependencies.Input('requested-cases-plot', 'data'),
+         dash.dependencies.Input('date-range', 'start_date'),
+         dash.dependencies.Input('date-range', 'end_date'),
+         dash.dependencies.Input('smooth-cases', 'value'),
+         dash.dependencies.Input('cases-or-deaths', 'value'),
+         dash.dependencies.Input('cumulative-or-new', 'value')],
+        prevent_initial_call=True
+        )
+else:
+    app.callback(
+        dash.dependencies.Output('cases-plot', 'figure'),
+        [dash.dependencies.Input('states-memory', 'data'),
+         dash.dependencies.Input('state-or-city-selector', 'value'),
+         dash.dependencies.Input('metros-per-state', 'value'),
+         dash.dependencies.Input('date-range', 'start_date'),
+         dash.dependencies.Input('date-range', 'end_date'),
+         dash.dependencies.Input('cases-by-county', 'value'),
+         dash.dependencies.Input('smooth-cases', 'value'),
+         dash.dependencies.Input('cases-or-deaths', 'value'),
+         dash.dependencies.Input('cumulative-or-new', 'value'),
+         dash.dependencies.Input('facet-page', 'value')],
+        [dash.dependencies.State('session-id', 'data')],
+        prevent_initial_call=True
+        )(produce_cases_plot)
+
+
+def cases_plot(data, states_list, state_or_metro, metros_per_state, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new, facet_page=0, session_id=None):
+    """
+    The cases plot of the snapshot data, see cached_figure
+    """
+    key = figure_cache.make_key(states_list, state_or_metro, metros_per_state, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new, facet_page)
+    build = lambda: build_cases_plot(data, states_list, state_or_metro, metros_per_state, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new, facet_page)
+    return cached_figure(data, ('cases_plot',) + key, build, session_id)
+
+
+def plot_series(data, states_list, state_or_metro, metros_per_state, cases_by_county, facet_page=0, session_id=None):
+    """
+    The series of the cases plot of the snapshot data, see build_plot_series and cached_figure
+    """
+    key = figure_cache.make_series_key(states_list, state_or_metro, metros_per_state, cases_by_county, facet_page)
+    build = lambda: build_plot_series(data, states_list, state_or_metro, metros_per_state, cases_by_county, facet_page)
+    return cached_figure(data, ('plot_series',) + key, build, session_id)
 
-    plot = {
-         'data': data,
-         'layout': dict(
-              height=450,
-              geo_scope='usa', # limit map scope to USA
-              margin=dict(
-                l=0,
-                r=0,
-                b=0,
-                t=0,
-                pad=0
-            ),
-            dragmode = False
-    )}
 
+def cached_figure(data, key, build, session_id=None):
+    """
+    The figure of key for the snapshot data from the figure cache of the process, then from the cache shared
+    with the other workers, building it with build on a miss of both. Only one worker builds a given figure
+    at a time. The builds of a browser session go through build_scheduler.
+
+    A request of a session supersedes the older ones even when it is served from a cache, and an older one
+    finishing afterwards raises scheduler.Superseded, so the browser never gets its figures out of order.
+    """
+    request = None if session_id is None else build_scheduler.enter(session_id)
+    with instrumentation.phase('cache_lookup'):
+        figure = cases_plot_cache.get(key)
+    if figure is None:
+        # Size of the figure once serialized, taken from the bytes stored in or loaded from the shared cache
+        # so that the figure isn't serialized again to measure it
+        sizes = []
+
+        def dumps(figure):
+            serialized = figure_cache.figure_json(figure)
+            sizes.append(len(serialized))
+            return serialized
+
+        def loads(serialized):
+            sizes.append(len(serialized))
+            return json.loads(serialized)
 
-    return go.Figure(plot), list(current_selected_states)
+        scheduled_build = build if session_id is None else lambda: build_scheduler.run(session_id, build, request)
+        figure = shared_results.get_or_compute(repr(key), data.version, scheduled_build, dumps, loads)
+        cases_plot_cache.put(key, figure, size=sizes[-1] if sizes else None, version=data.version)
+
+        # The figure stays cached for the requests which want it
+        if request is not None:
+            build_scheduler.check_latest(session_id, request)
+
+    return figure
 
 
 @app.callback(
-     dash.dependencies.Output('cases-plot', 'figure'),
+    [dash.dependencies.Output('facet-page', 'options'),
+     dash.dependencies.Output('facet-page', 'value'),
+     dash.dependencies.Output('facet-pager', 'style')],
     [dash.dependencies.Input('states-memory', 'data'),
      dash.dependencies.Input('state-or-city-selector', 'value'),
-     dash.dependencies.Input('date-range', 'start_date'),
-     dash.dependencies.Input('date-range', 'end_date'),
-     dash.dependencies.Input('cases-by-county', 'value'),
-     dash.dependencies.Input('smooth-cases', 'value'),
-     dash.dependencies.Input('cases-or-deaths', 'value'),
-     dash.dependencies.Input('cumulative-or-new', 'value')]
+     dash.dependencies.Input('metros-per-state', 'value'),
+     dash.dependencies.Input('cases-by-county', 'value')],
+    prevent_initial_call=True
     )
-def produce_cases_plot(states_list, state_or_metro, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new):
+def update_facet_pages(states_list, state_or_metro, metros_per_state, cases_by_county):
+    """
+    A page per facets_per_page facets of the county plot, back on the first page whenever the facets change.
+    The selector is hidden when everything fits on one page.
+    """
+    num_facets = 0
+    if len(cases_by_county) != 0:
+        num_facets = len(facet_groups(data_snapshot, states_list, state_or_metro, metros_per_state))
+
+    options = facet_page_options(num_facets)
+    return options, 0, {'display': 'block' if len(options) > 1 else 'none'}
+
+
+@instrumentation.timed('produce_metric_map')
+@scheduled_callback
+def produce_metric_map(request, session_id):
+    """
+    Serves the animated map of the current snapshot for the controls passed on by map.request_metric_map in
+    assets/clientside.js, which only happens while the map is shown
+    """
+    first_date, last_date, smooth_data, cases_or_deaths, cumulative_or_new = request
+    # Requests of the map only supersede each other, not those of the cases plot
+    return metric_map(data_snapshot, first_date, last_date, smooth_data, cases_or_deaths, cumulative_or_new, (session_id, 'metric-map'))
+
+
+@instrumentation.timed('produce_metric_map_series')
+@scheduled_callback
+def produce_metric_map_series(request, session_id):
+    """
+    Serves the series of the metric map of the current snapshot for the browser to draw, see metric_map_series.
+    map.request_metric_map_series in assets/clientside.js only asks for them while the map is shown, once per
+    version of the data.
+    """
+    return metric_map_series(data_snapshot, (session_id, 'metric-map'))
+
+
+# The browser shows or hides the metric map, and only asks the server for it while it is shown
+if clientside_plot:
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='map', function_name='request_metric_map_series'),
+        [dash.dependencies.Output('metric-map-series-request', 'data'),
+         dash.dependencies.Output('metric-map-container', 'style')],
+        [dash.dependencies.Input('metric-map-toggle', 'value'),
+         dash.dependencies.Input('data-version', 'data')],
+        [dash.dependencies.State('metric-map-series', 'data')],
+        prevent_initial_call=True
+        )
+
+    app.callback(
+        dash.dependencies.Output('metric-map-series', 'data'),
+        [dash.dependencies.Input('metric-map-series-request', 'data')],
+        [dash.dependencies.State('session-id', 'data')],
+        prevent_initial_call=True
+        )(produce_metric_map_series)
+
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='map', function_name='render_metric_map'),
+        dash.dependencies.Output('metric-map', 'figure'),
+        [dash.dependencies.Input('metric-map-series', 'data'),
+         dash.dependencies.Input('metric-map-toggle', 'value'),
+         dash.dependencies.Input('date-range', 'start_date'),
+         dash.dependencies.Input('date-range', 'end_date'),
+         dash.dependencies.Input('smooth-cases', 'value'),
+         dash.dependencies.Input('cases-or-deaths', 'value'),
+         dash.dependencies.Input('cumulative-or-new', 'value')],
+        prevent_initial_call=True
+        )
+else:
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='map', function_name='request_metric_map'),
+        [dash.dependencies.Output('metric-map-request', 'data'),
+         dash.dependencies.Output('metric-map-container', 'style')],
+        [dash.dependencies.Input('metric-map-toggle', 'value'),
+         dash.dependencies.Input('date-range', 'start_date'),
+         dash.dependencies.Input('date-range', 'end_date'),
+         dash.dependencies.Input('smooth-cases', 'value'),
+         dash.dependencies.Input('cases-or-deaths', 'value'),
+         dash.dependencies.Input('cumulative-or-new', 'value')],
+        prevent_initial_call=True
+        )
+
+    app.callback(
+        dash.dependencies.Output('metric-map', 'figure'),
+        [dash.dependencies.Input('metric-map-request', 'data')],
+        [dash.dependencies.State('session-id', 'data')],
+        prevent_initial_call=True
+        )(produce_metric_map)
+
+
+def metric_map(data, first_date, last_date, smooth_data, cases_or_deaths, cumulative_or_new, session_id=None):
+    """
+    The animated map of the snapshot data, see cached_figure
+    """
+    col, y_title = metric_column(cases_or_deaths, cumulative_or_new)
+    window = int(smooth_data or 0)
+    first_date = pd.to_datetime(first_date).strftime('%Y-%m-%d')
+    last_date = pd.to_datetime(last_date).strftime('%Y-%m-%d')
+
+    build = lambda: build_metric_map(data, first_date, last_date, col, y_title, window)
+    return cached_figure(data, ('metric_map', col, window, first_date, last_date), build, session_id)
+
+
+def metric_map_series(data, session_id=None):
     """
-    Determines the proper format and data to feed into the produce_case_normal_plot
-    or produce_case_facet_plot based on the user settings
+    The series of the metric map of the snapshot data, see build_metric_map_series and cached_figure
+    """
+    return cached_figure(data, ('metric_map_series',), lambda: build_metric_map_series(data), session_id)
+
+
+def default_cases_plot_inputs(data):
+    """
+    Inputs of the cases plot on a freshly loaded page, matching the initial values of the layout
+    """
+    return (default_states, 'state', default_metros_per_state, data.min_date.strftime('%Y-%m-%d'),
+            data.max_date.strftime('%Y-%m-%d'), [], 0, 'cases', 'new')
+
+
+def default_plot_series_inputs(data):
+    """
+    Selection of the series of the cases plot on a freshly loaded page, see default_cases_plot_inputs
+    """
+    states_list, state_or_metro, metros_per_state, _, _, cases_by_county, _, _, _ = default_cases_plot_inputs(data)
+    return states_list, state_or_metro, metros_per_state, cases_by_county
+
+
+def warm_up_inputs(data):
+    """
+    Inputs of the most requested cases plots with the default toggles: the default page first, then all states
+    and each single state, shown as states and as metros
+    """
+    yield default_cases_plot_inputs(data)
+
+    all_states = sorted(data.states['state_abbreviation'])
+    _, _, metros_per_state, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new = default_cases_plot_inputs(data)
+    for states_list in [default_states, all_states] + [[state] for state in all_states]:
+        for state_or_metro in ['state', 'state_metro']:
+            yield (states_list, state_or_metro, metros_per_state, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new)
+
+
+def warm_up(data):
+    """
+    Fill the figure cache with the most requested cases plots of the snapshot data, so the first visitors
+    after a start or a reload don't pay for building them. Stops early if the snapshot is replaced meanwhile.
+    """
+    for inputs in warm_up_inputs(data):
+        if data is not data_snapshot:
+            return
+        if clientside_plot:
+            states_list, state_or_metro, metros_per_state, _, _, cases_by_county, _, _, _ = inputs
+            plot_series(data, states_list, state_or_metro, metros_per_state, cases_by_county)
+        else:
+            cases_plot(data, *inputs)
+
+    if clientside_plot:
+        metric_map_series(data)
+    else:
+        _, _, _, first_date, last_date, _, smooth_data, cases_or_deaths, cumulative_or_new = default_cases_plot_inputs(data)
+        metric_map(data, first_date, last_date, smooth_data, cases_or_deaths, cumulative_or_new)
+
+
+def build_cases_plot(data, states_list, state_or_metro, metros_per_state, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new, facet_page=0):
+    """
+    Determines the proper format and data of the snapshot data to feed into the produce_case_normal_plot
+    or produce_case_facet_plot based on the user settings. Only the metros_per_state largest
+    metros of each state and their counties are shown, all of them if it is 0. The facet plot only
+    shows the facets of page facet_page.
     """
     counties_bool = len(cases_by_county) != 0
-    smooth_bool = len(smooth_data) != 0
 
     first_date = pd.to_datetime(first_date)
     last_date = pd.to_datetime(last_date)
 
+    if counties_bool:
+        # If showing counties, then show a graph for each state OR each state/metro with a line for each county
+        with instrumentation.phase('filter'):
+            facets = facet_groups(data, states_list, state_or_metro, metros_per_state)
+            first_facet = facet_page_start(len(facets), facet_page)
+        return produce_case_facet_plot(data, [first_date, last_date], facets[first_facet:first_facet + facets_per_page], cases_or_deaths, cumulative_or_new, smooth_data)
+
+    with instrumentation.phase('filter'):
+        groups = line_groups(data, states_list, state_or_metro, metros_per_state)
+
+    return produce_case_normal_plot(data, [first_date, last_date], groups, cases_or_deaths, cumulative_or_new, smooth_data)
+
+
+def line_groups(data, states_list, state_or_metro, metros_per_state):
+    """
+    The lines of the cases plot: one for each state, or for each of the metros_per_state largest metros of
+    every state. Only those of the selected states are plotted, the others keep their place in the legend.
+    """
+    cases_cube = data.cube
+    selected = set(states_list)
+
     if state_or_metro == 'state':
-    # Show cases for the state overall
-        if counties_bool:
-            # If showing counties, then show a graph for each state OR each state/metro with a line for each county
-            filtered = cases_data[cases_data.county.notnull()]
-            filtered['plot_bool'] = filtered['state_abbreviation'].isin(states_list)
-            groups = list(filtered[['state_abbreviation', 'plot_bool']].sort_values(['state_abbreviation'])\
-                                                                       .drop_duplicates().itertuples(index=False, name='Group'))
-            return produce_case_facet_plot([first_date, last_date], filtered, groups, cases_or_deaths, cumulative_or_new, smooth_data)
+        return [Group(state, entity, state in selected) for state, entity in sorted(cases_cube.states.items())]
 
-        else:
-            # If not showing counties, then show 1 graph with a line for each state OR each state/metro
-            filtered = cases_data[(cases_data.city.isnull()) &
-                                  (cases_data.county.isnull())]
-            filtered['plot_bool'] = filtered['state_abbreviation'].isin(states_list)
-            groups = list(filtered[['state_abbreviation', 'plot_bool']].sort_values(['state_abbreviation'])\
-                                                                       .drop_duplicates().itertuples(index=False, name='Group'))
-
-            return produce_case_normal_plot([first_date, last_date], filtered, groups, cases_or_deaths, cumulative_or_new, smooth_data)
-    else:
-    # Show cases for the counties in our metros
-        if counties_bool:
-            filtered = cases_data[cases_data.county.notnull()]
-            filtered['plot_bool'] = filtered['state_abbreviation'].isin(states_list)
-            groups = list(filtered[['city', 'state_abbreviation', 'plot_bool']].sort_values(['state_abbreviation', 'city'])\
-                                                                       .drop_duplicates().itertuples(index=False, name='Group'))
-            return produce_case_facet_plot([first_date, last_date], filtered, groups, cases_or_deaths, cumulative_or_new, smooth_data)
+    return [Group(city + ' - ' + state, entity, state in selected)
+            for state in sorted(cases_cube.metros)
+            for city, entity in cases_cube.top_metros(cases_cube.metros[state], metros_per_state)]
 
-        else:
-            # If not showing counties, then show 1 graph with a line for each state OR each state/metro
-            filtered = cases_data[(cases_data.city.notnull()) &
-                                  (cases_data.county.isnull())]
-            filtered['plot_bool'] = filtered['state_abbreviation'].isin(states_list)
-            groups = list(filtered[['city', 'state_abbreviation', 'plot_bool']].sort_values(['state_abbreviation', 'city'])\
-                                                                                   .drop_duplicates().itertuples(index=False, name='Group'))
 
-            return produce_case_normal_plot([first_date, last_date], filtered, groups, cases_or_deaths, cumulative_or_new, smooth_data)
+@instrumentation.timed('build_plot_series')
+def build_plot_series(data, states_list, state_or_metro, metros_per_state, cases_by_county, facet_page=0):
+    """
+    What plot.render in assets/clientside.js needs to draw the cases plot of a selection with any metric,
+    smoothing and dates: the daily counts of every plotted line over all its dates, the points each line may
+    keep, the layout without dates and the weekends. The browser derives the metric like cube.Cube.derived,
+    in the same order. Lines of unselected states are null, they only keep the place of the others in the legend.
+
+    Selections whose series would be larger than their compact figure are drawn by the server instead, see
+    payload.series_fit. Their series only hold the selection, which plot.request_cases_plot passes on to
+    produce_requested_cases_plot with the metric, smoothing and dates.
+    """
+    cases_cube = data.cube
+
+    def line(entity, name, color, show_in_legend, axis_number=''):
+        population = cases_cube.population[entity]
+        return {
+            'name': name,
+            'color': color,
+            'showlegend': show_in_legend,
+            'axis': axis_number,
+            'population': float(population),
+            'population_label': '{:,.0f}'.format(population),
+            'first': int(cases_cube.first[entity]),
+            'cases': daily_counts(cases_cube, entity, 'cases'),
+            'deaths': daily_counts(cases_cube, entity, 'deaths'),
+        }
 
+    def drawn_by_server(entities):
+        # Cases and deaths on every date of each line
+        num_values = 2 * sum(int(cases_cube.last[entity] - cases_cube.first[entity] + 1) for entity in entities)
+        return not payload.series_fit(num_values, len(entities))
+
+    series = {
+        'dates': np.datetime_as_string(cases_cube.dates, unit='D').tolist(),
+        'weekends': data.weekend_shading.bounds(),
+        'metrics': metric_columns(),
+        'facets': len(cases_by_county) != 0,
+        'lines': [],
+    }
+    server = {'server': True, 'inputs': [list(states_list), state_or_metro, metros_per_state, list(cases_by_county), facet_page]}
+
+    if series['facets']:
+        facets = facet_groups(data, states_list, state_or_metro, metros_per_state)
+        first_facet = facet_page_start(len(facets), facet_page)
+        facets = facets[first_facet:first_facet + facets_per_page]
+        if len(facets) == 0:
+            return {'empty': True, 'layout': empty_plot['layout'].to_plotly_json()}
+
+        lines = list(facet_lines(facets))
+        if drawn_by_server([entity for _, _, entity, _, _ in lines]):
+            return server
+
+        for axis_number, county, entity, color, show_in_legend in lines:
+            # Stop here if the user asked for another plot meanwhile
+            build_scheduler.check()
+            series['lines'].append(line(entity, county, color, show_in_legend, axis_number))
+        return dict(series, max_points=max_points_per_line(len(lines)), layout=facet_page_layout([facet.name for facet in facets]))
+
+    groups = line_groups(data, states_list, state_or_metro, metros_per_state)
+    plotted = [group.entity for group in groups if group.plot_bool]
+    if drawn_by_server(plotted):
+        return server
 
-def produce_case_normal_plot(dates_range, data_to_plot, groups, cases_or_deaths, cumulative_or_new, smooth_data):
+    for i, group in enumerate(groups):
+        build_scheduler.check()
+        series['lines'].append(line(group.entity, group.name, default_colors[i%len(default_colors)], True) if group.plot_bool else None)
+    return dict(series, max_points=max_points_per_line(len(plotted)), layout=normal_layout())
+
+
+def daily_counts(cases_cube, entity, count):
     """
-    Given the selections generated in the callback function, produce the main plot of OOH
+    The cumulative count of one entity as its integer daily changes, the first one being the count on its first
+    date. They are several times smaller to send than the cumulative counts, which the browser adds back up.
+    """
+    return np.diff(cases_cube.counts(entity, count), prepend=0).astype(np.int64).tolist()
+
+
+def max_points_per_line(num_lines):
+    """
+    Points each of num_lines lines drawn by the browser may keep, like the compact figures of the server.
+    None when figures aren't compacted.
+    """
+    return payload.points_per_trace(num_lines) if payload.ENABLED else None
+
+
+def facet_groups(data, states_list, state_or_metro, metros_per_state):
+    """
+    The facets of the county plot: one for each selected state, or for each of the metros_per_state largest
+    metros of the selected states, with a line for each of their counties
+    """
+    cases_cube = data.cube
+    selected = set(states_list)
+
+    if state_or_metro == 'state':
+        return [Facet(state, cases_cube.top_metros(cases_cube.state_counties[state], metros_per_state))
+                for state in sorted(cases_cube.state_counties) if state in selected]
+
+    metros = [(city, state) for state in sorted(cases_cube.metros) if state in selected
+              for city, _ in cases_cube.top_metros(cases_cube.metros[state], metros_per_state)]
+    return [Facet(city + ' - ' + state, cases_cube.metro_counties[(city, state)]) for city, state in metros]
+
+
+def facet_page_start(num_facets, facet_page):
+    """
+    Position of the first facet of page facet_page, the last page if there are fewer pages
+    """
+    last_page = max(num_facets - 1, 0) // facets_per_page
+    return min(int(facet_page or 0), last_page) * facets_per_page
+
+
+def facet_page_options(num_facets):
+    """
+    Options of the facet page selector, labelled with the facets on each page
+    """
+    options = []
+    for page, first in enumerate(range(0, num_facets, facets_per_page)):
+        last = min(first + facets_per_page, num_facets)
+        label = str(last) if last == first + 1 else '{}-{}'.format(first + 1, last)
+        options.append({'label': label, 'value': page})
+    return options
+
+
+def metric_column(cases_or_deaths, cumulative_or_new):
+    """
+    The metric of the cube to show and its title
     """
     if cases_or_deaths == 'cases':
         if cumulative_or_new == 'cumulative':
-            col = 'cases_norm'
-            y_title = 'Cumulative Cases'
-        else:
-            col = 'new_cases_norm'
-            y_title = 'Daily New Cases'
-    else:
-        if cumulative_or_new == 'cumulative':
-            col = 'deaths_norm'
-            y_title = 'Cumulative Deaths'
-        else:
-            col = 'new_deaths_norm'
-            y_title = 'Daily New Deaths'
+            return 'cases', 'Cumulative Cases'
+        return 'new_cases', 'Daily New Cases'
+
+    if cumulative_or_new == 'cumulative':
+        return 'deaths', 'Cumulative Deaths'
+    return 'new_deaths', 'Daily New Deaths'
+
+
+def metric_columns():
+    """
+    metric_column of every setting of the toggles, keyed by cases_or_deaths + '_' + cumulative_or_new for the browser
+    """
+    return {cases_or_deaths + '_' + cumulative_or_new: metric_column(cases_or_deaths, cumulative_or_new)
+            for cases_or_deaths in ['cases', 'deaths'] for cumulative_or_new in ['cumulative', 'new']}
+
+
+def trace_values(dates, values, population, max_points):
+    """
+    The x, y and population of one line. Compact figures send dates as days and values rounded for display,
+    downsample long lines to max_points, and write the population into the hover label once instead of
+    sending it with every point. Returns x, y, the per point population and the population label.
+    """
+    if not payload.ENABLED:
+        return pd.DatetimeIndex(dates), values, np.full(len(values), population), None
 
-    if smooth_data: col = col + '_smooth'
+    x, y = payload.compact_series(dates, values, max_points)
+    return x, y, None, '{:,.0f}'.format(population)
 
-    # Filter the data to the desired breakout
-    data_to_plot = data_to_plot[data_to_plot['date'].between(*dates_range)]
+
+@instrumentation.timed('produce_case_normal_plot')
+def produce_case_normal_plot(data, dates_range, groups, cases_or_deaths, cumulative_or_new, smooth_data):
+    """
+    Given the selections generated in the callback function, produce the main plot of OOH
+    """
+    col, y_title = metric_column(cases_or_deaths, cumulative_or_new)
+
+    # Per 100,000 people, smoothed over smooth_data days unless it is 0
+    window = smooth_data or 0
+
+    # Positions of the desired dates in the cube
+    cases_cube = data.cube
+    start, stop = cases_cube.date_range(*dates_range)
+
+    max_points = payload.points_per_trace(sum(group.plot_bool for group in groups))
 
     main_plot_traces = []
     for i, group in enumerate(groups):
+        # Stop here if the user asked for another plot meanwhile
+        build_scheduler.check()
 
         # Retrieve whether or not this line should be plotted.
         # All possible groups still should be named and added to list to keep lines intact when the plot changes
         plot_bool = group.plot_bool
 
         if plot_bool:
-            filter_columns = [i for i in group._fields if i != 'plot_bool']
-
-            filters = ["{} == '{}'".format(i, getattr(group, i)) for i in filter_columns]
-            one_filter = " & ".join(filters)
-            group_name = " - ".join([getattr(group, i) for i in filter_columns])
-
-            this_groups_data = data_to_plot.query(one_filter)
+            line_dates, line_values = cases_cube.series(group.entity, col, start, stop, window)
 
-            x = this_groups_data['date']
-            y = this_groups_data[col]
+            x, y, population, population_label = trace_values(line_dates, line_values, cases_cube.population[group.entity], max_points)
             vis = True
             leg = True
-            name = group_name
+            name = group.name
             color = default_colors[i%len(default_colors)]
-            population = this_groups_data['population']
 
         else:
             x = None
@@ -415,6 +1003,7 @@ def produce_case_normal_plot(dates_range, data_to_plot, groups, cases_or_deaths,
             name = None
             color = None
             population = None
+            population_label = None
 
         # Make scatter for hours plot
         main_plot_traces.append(go.Scatter(
@@ -428,7 +1017,7 @@ def produce_case_normal_plot(dates_range, data_to_plot, groups, cases_or_deaths,
             hovertemplate="<b>%{meta}</b><br>" +
                           "Date: %{x}<br>" +
                           y_title + ": %{y:.2f}<br>" +
-                          "Population: %{customdata:,}",
+                          "Population: " + (population_label or "%{customdata:,}"),
             opacity=0.8,
             visible=vis,
             showlegend=True,
@@ -437,91 +1026,147 @@ def produce_case_normal_plot(dates_range, data_to_plot, groups, cases_or_deaths,
             customdata=population
         ))
 
-    # Shading for the weekends
-    weekends = []
-    for saturday in saturdays:
-        weekends.append(dict(
-            type="rect",
-            # x-reference is assigned to the x-values
-            xref="x",
-            # y-reference is assigned to the plot paper [0,1]
-            yref="paper",
-            x0=saturday - pd.DateOffset(days=0.4),
-            y0=0,
-            x1=saturday + pd.DateOffset(days=1.4),
-            y1=1,
-            fillcolor="black",
-            opacity=0.04,
-            layer="below",
-            line_width=0.0
-        ))
+    # Shading for the weekends in the date range
+    weekend_shapes = data.weekend_shading.shapes(*dates_range)
 
     plot = {
         'data': main_plot_traces,
-        'layout': dict(
-            xaxis={
-                'title': None,
-                'range': dates_range,
-                'showgrid': False,
-            },
-            yaxis={
-                'title': None,
-                'zeroline': True
-            },
-            height=500,
-            margin={'l': 40, 'b': 100, 't': 10, 'r': 10},
-            showlegend=True,
-            legend={'orientation':'h'},
-            hovermode='closest',
-            transition={
-                'duration': 800,
-                'easing': 'cubic-in-out'
-            },
-            shapes=weekends
-        )
+        'layout': normal_layout(dates_range, weekend_shapes)
     }
 
     return plot
 
 
-def produce_case_facet_plot(dates_range, data_to_plot, groups, cases_or_deaths, cumulative_or_new, smooth_data):
+def normal_layout(dates_range=None, shapes=()):
     """
-    Makes a facet plot where each plot corresponds to one line in the major plot above
+    Layout of the cases plot with a line per state or metro
     """
-    default_max_in_row = 1
-    colors_assigned = {} # To unify colors across lines
+    return dict(
+        xaxis={
+            'title': None,
+            'range': dates_range,
+            'showgrid': False,
+        },
+        yaxis={
+            'title': None,
+            'zeroline': True
+        },
+        height=500,
+        margin={'l': 40, 'b': 100, 't': 10, 'r': 10},
+        showlegend=True,
+        legend={'orientation':'h'},
+        hovermode='closest',
+        transition={
+            'duration': 800,
+            'easing': 'cubic-in-out'
+        },
+        shapes=list(shapes)
+    )
 
-    if cases_or_deaths == 'cases':
-        if cumulative_or_new == 'cumulative':
-            col = 'cases_norm'
-            y_title = 'Cumulative Cases'
-        else:
-            col = 'new_cases_norm'
-            y_title = 'Daily New Cases'
-    else:
-        if cumulative_or_new == 'cumulative':
-            col = 'deaths_norm'
-            y_title = 'Cumulative Deaths'
-        else:
-            col = 'new_deaths_norm'
-            y_title = 'Daily New Deaths'
 
-    if smooth_data: col = col + '_smooth'
+@instrumentation.timed('produce_case_facet_plot')
+def produce_case_facet_plot(data, dates_range, groups_to_plot, cases_or_deaths, cumulative_or_new, smooth_data):
+    """
+    Makes a facet plot where each plot corresponds to one line in the major plot above
+    """
+    col, y_title = metric_column(cases_or_deaths, cumulative_or_new)
 
-    # Get the groups. Each group is a facet
-    groups_to_plot = [i for i in groups if i.plot_bool]
+    # Per 100,000 people, smoothed over smooth_data days unless it is 0
+    window = smooth_data or 0
 
+    # Each group is a facet
     if len(groups_to_plot) == 0: return empty_plot
 
-    filter_columns = [i for i in groups_to_plot[0]._fields if i != 'plot_bool']
-    names = [" - ".join([getattr(group, column) for column in filter_columns]) for group in groups_to_plot]
+    # Positions of the desired dates in the cube
+    cases_cube = data.cube
+    start, stop = cases_cube.date_range(*dates_range)
+
+    # Points are shared between all the county lines of all facets
+    max_points = payload.points_per_trace(sum(len(group.lines) for group in groups_to_plot))
+
+    layout = facet_page_layout([group.name for group in groups_to_plot])
+
+    traces = []
+    for axis_number, county, entity, color, show_in_legend in facet_lines(groups_to_plot):
+        # Stop here if the user asked for another plot meanwhile
+        build_scheduler.check()
+
+        line_dates, line_values = cases_cube.series(entity, col, start, stop, window)
+        x, y, population, population_label = trace_values(line_dates, line_values, cases_cube.population[entity], max_points)
+
+        traces.append(
+            go.Scatter(
+                x=x,
+                y=y,
+                name=county,
+                meta=county,
+                mode='lines+markers',
+                line_shape='spline',
+                hovertemplate="<b>%{meta}</b><br>" +
+                              "Date: %{x}<br>" +
+                              y_title + ": %{y:.2f}<br>"+
+                              "Population: " + (population_label or "%{customdata:,}"),
+                hoverlabel = dict(namelength = 0),
+                opacity=0.8,
+                showlegend=show_in_legend,
+                legendgroup=county,
+                marker_color=color,
+                customdata=population,
+                xaxis='x' + axis_number,
+                yaxis='y' + axis_number
+            )
+        )
+
+    # Shading for the weekends. Every facet shows the same date range, so one set of shapes on the
+    # first x axis spanning the whole plot paper shades all of them
+    layout['shapes'] = data.weekend_shading.shapes(*dates_range)
+    for axis in layout:
+        if axis.startswith('xaxis'):
+            layout[axis]['range'] = dates_range
+
+    return {'data': traces, 'layout': layout}
+
+
+def facet_lines(groups_to_plot):
+    """
+    The (axis number, county, entity, color, show in legend) of every line of the facets. A county has the
+    same color in every facet, and is only listed once in the legend.
+    """
+    colors_assigned = {}
+    for i, group in enumerate(groups_to_plot):
+        # Subplots are numbered row by row, the axes of the first one have no number
+        axis_number = str(i + 1) if i else ''
+
+        for county, entity in group.lines:
+            show_in_legend = county not in colors_assigned
+            if show_in_legend:
+                colors_assigned[county] = default_colors[len(colors_assigned)%len(default_colors)]
+            yield axis_number, county, entity, colors_assigned[county], show_in_legend
+
+
+def facet_page_layout(names):
+    """
+    Layout of a facet plot with a facet for each of names
+    """
+    default_max_in_row = 1
+    max_in_row = min(default_max_in_row, len(names))
+    num_rows = int(np.ceil(len(names)/max_in_row))
 
-    max_in_row = min(default_max_in_row, len(groups_to_plot))
+    # The axes and title annotations of every page with the same number of facets are the same
+    layout = copy.deepcopy(facet_layout(num_rows, max_in_row))
+    for annotation, name in zip(layout['annotations'], names):
+        annotation['text'] = name
+    return layout
 
-    num_rows = int(np.ceil(len(groups_to_plot)/max_in_row))
 
-    # Filter the data to the desired breakout
-    data_to_plot = data_to_plot[data_to_plot['date'].between(*dates_range)]
+@functools.lru_cache(maxsize=16)
+def facet_layout(num_rows, max_in_row):
+    """
+    Layout of a facet plot with num_rows rows of max_in_row facets, with blank titles. make_subplots costs
+    more than drawing the lines of a page of facets, so it only runs once for each shape of page.
+    """
+    # plotly.subplots imports most of plotly, only pay for it once a facet plot is shown
+    from plotly.subplots import make_subplots
 
     fig = make_subplots(
             rows=num_rows,
@@ -530,92 +1175,114 @@ def produce_case_facet_plot(dates_range, data_to_plot, groups, cases_or_deaths,
             shared_yaxes=False,
             x_title='Date',
             y_title=None,
-            subplot_titles=names,
-            vertical_spacing = 0.05,
+            subplot_titles=[' ']*(num_rows*max_in_row),
+            vertical_spacing = min(0.05, 100/(500*num_rows)), # At most 100px between rows, plotly rejects more than 1/(rows-1)
             horizontal_spacing = 0.01
         )
 
-    range_min = 0
-    range_max = 0
-    for i, group in enumerate(groups_to_plot):
-        fig_row = int(np.ceil((i+1)/max_in_row))
-        fig_col = i%max_in_row + 1
-
-        filter_columns = [i for i in group._fields if i != 'plot_bool']
-        filters = ["{} == '{}'".format(i, getattr(group, i)) for i in filter_columns]
-        one_filter = " & ".join(filters)
-        name = " - ".join([getattr(group, i) for i in filter_columns])
+    fig.update_layout(height=500*num_rows, hovermode='closest', plot_bgcolor='rgba(0,0,0,0)')
+    fig.for_each_yaxis(lambda a: a.update(hoverformat='.2f', zeroline=True, zerolinewidth=0.5,
+                                          gridcolor='rgba(135, 143, 135, 0.2)',
+                                          zerolinecolor='black', rangemode='tozero', showgrid=True))
+    fig.for_each_xaxis(lambda a: a.update(showgrid=False))
 
-        this_groups_data = data_to_plot.query(one_filter)
+    return fig.to_plotly_json()['layout']
 
-        # Keeping track of the ranges for shading weekends
-        range_min = min(range_min, min(this_groups_data[col]))
-        range_max = max(range_max, max(this_groups_data[col]))
 
-        counties = sorted(this_groups_data.county.unique())
+def metric_map_template(data):
+    """
+    The parts of the metric map which depend on neither the metric nor the dates: the choropleth of the states
+    without its values, and the layout with the slider without its steps
+    """
+    buttons = [
+        {'label': 'Play', 'method': 'animate',
+         'args': [None, {'frame': {'duration': map_frame_ms, 'redraw': True}, 'transition': {'duration': 0}}]},
+        {'label': 'Pause', 'method': 'animate',
+         'args': [[None], {'mode': 'immediate', 'frame': {'duration': 0, 'redraw': False}, 'transition': {'duration': 0}}]},
+    ]
+
+    trace = {'type': 'choropleth', 'locations': list(data.states['state_abbreviation']),
+             'locationmode': 'USA-states', 'colorscale': 'Reds', 'zmin': 0}
+    layout = dict(
+        height=450,
+        geo={'scope': 'usa'},
+        margin=dict(l=0, r=0, b=0, t=0, pad=0),
+        dragmode=False,
+        # The date of the frame shows above the slider, the labels of the steps would overlap
+        sliders=[{'currentvalue': {'prefix': 'Date: '}, 'font': {'color': 'rgba(0,0,0,0)'}, 'pad': {'t': 10}, 'x': 0.1, 'len': 0.9}],
+        updatemenus=[{'type': 'buttons', 'showactive': False, 'buttons': buttons,
+                      'x': 0.1, 'xanchor': 'right', 'y': 0, 'yanchor': 'top', 'pad': {'t': 10, 'r': 10}}]
+    )
+    return trace, layout
 
-        # Make a seperate line for each subcategory
-        for county in counties:
-            this_lines_data = this_groups_data[this_groups_data['county'] == county]
 
-            # Get the color of the line based on the county. If it has already been shown before
-            # then make it invisible in the legend as well
-            show_in_legend = False
-            if county not in colors_assigned:
-                colors_assigned[county] = default_colors[len(colors_assigned)%len(default_colors)]
-                show_in_legend = True
-
-            fig.add_trace(
-                go.Scatter(
-                    x=this_lines_data['date'],
-                    y=this_lines_data[col],
-                    name=county,
-                    meta=county,
-                    mode='lines+markers',
-                    line_shape='spline',
-                    hovertemplate="<b>%{meta}</b><br>" +
-                                  "Date: %{x}<br>" +
-                                  y_title + ": %{y:.2f}<br>"+
-                                  "Population: %{customdata:,}",
-                    hoverlabel = dict(namelength = 0),
-                    opacity=0.8,
-                    showlegend=show_in_legend,
-                    legendgroup=county,
-                    marker_color=colors_assigned[county],
-                    customdata=this_lines_data['population']
-                ),
-            row=fig_row, col=fig_col
-            )
+@instrumentation.timed('build_metric_map')
+def build_metric_map(data, first_date, last_date, col, y_title, window):
+    """
+    The states colored by col on each date between first_date and last_date. Every date is a frame of the
+    figure, so the slider and the play button animate the map in the browser, without round trips to the
+    server. The color scale is the same on every date.
+    """
+    cases_cube = data.cube
+    trace, layout = metric_map_template(data)
+
+    # States x dates matrix of the metric, sliced to the selected dates
+    start, stop = cases_cube.date_range(first_date, last_date)
+    values = cases_cube.matrix([cases_cube.states[state] for state in trace['locations']], col, window)[:, start:stop]
+    dates = np.datetime_as_string(cases_cube.dates[start:stop], unit='D')
+    if len(dates) == 0:
+        return empty_plot
+    if payload.ENABLED:
+        values = payload.round_for_display(values)
+
+    # Reporting catch ups would wash out the colors of every other date
+    zmax = float(np.nanpercentile(values, 99)) if np.isfinite(values).any() else 1
+
+    frames = [{'name': date, 'data': [{'type': 'choropleth', 'z': values[:, i]}]} for i, date in enumerate(dates)]
+
+    # Jump to a date when the slider moves
+    steps = [{'label': date, 'method': 'animate',
+              'args': [[date], {'mode': 'immediate', 'frame': {'duration': 0, 'redraw': True}, 'transition': {'duration': 0}}]}
+             for date in dates]
+
+    return {
+        'data': [dict(trace, z=values[:, -1], zmax=zmax, colorbar={'title': {'text': y_title + '<br>per 100k'}, 'thickness': 10},
+                      hovertemplate='%{location}<br>' + y_title + ': %{z:.2f}<extra></extra>')],
+        'layout': dict(layout, sliders=[dict(layout['sliders'][0], active=len(dates) - 1, steps=steps)]),
+        'frames': frames,
+    }
 
-    weekends = []
-    # Create the shapes for shading weekends
-    for i in range(len(groups_to_plot)):
-        for saturday in saturdays:
-            sunday = saturday + pd.DateOffset(days=1)
-            if (((saturday >= dates_range[0]) & (saturday <= dates_range[1])) |
-                ((sunday >= dates_range[0]) & (sunday <= dates_range[1]))) :
-                weekends.append(dict(
-                    type="rect",
-                    # x and y reference is assigned to the x-values of each subplot
-                    xref="x"+str(i+1),
-                    yref="y"+str(i+1),
-                    x0=saturday - pd.DateOffset(days=0.4),
-                    y0=range_min,
-                    x1=saturday + pd.DateOffset(days=1.4),
-                    y1=range_max,
-                    fillcolor="black",
-                    opacity=0.04,
-                    layer="below",
-                    line_width=0.0
-                ))
-
-    fig.update_layout(height=500*num_rows, hovermode='closest', plot_bgcolor='rgba(0,0,0,0)', shapes=weekends)
-    fig.for_each_yaxis(lambda a: a.update(hoverformat='.2f', zeroline=True, zerolinewidth=0.5,
-                                          gridcolor='rgba(135, 143, 135, 0.2)',
-                                          zerolinecolor='black', rangemode='tozero', showgrid=True))
-    fig.for_each_xaxis(lambda a: a.update(showgrid=False))
 
-    return fig
+@instrumentation.timed('build_metric_map_series')
+def build_metric_map_series(data):
+    """
+    What map.render_metric_map in assets/clientside.js needs to draw the metric map with any metric, smoothing
+    and dates, like build_metric_map: the daily counts of every state over all its dates and the template of
+    the figure, see metric_map_template
+    """
+    cases_cube = data.cube
+    trace, layout = metric_map_template(data)
+
+    lines = []
+    for state in trace['locations']:
+        build_scheduler.check()
+        entity = cases_cube.states[state]
+        lines.append({
+            'population': float(cases_cube.population[entity]),
+            'first': int(cases_cube.first[entity]),
+            'cases': daily_counts(cases_cube, entity, 'cases'),
+            'deaths': daily_counts(cases_cube, entity, 'deaths'),
+        })
+
+    return {
+        'version': data.version,
+        'dates': np.datetime_as_string(cases_cube.dates, unit='D').tolist(),
+        'metrics': metric_columns(),
+        'lines': lines,
+        'trace': trace,
+        'layout': layout,
+        'empty_layout': empty_plot['layout'].to_plotly_json(),
+    }
 
 
 # hide/show modal
@@ -633,5 +1300,14 @@ def close_modal(n):
     return 0
 
 
+# Set last, the layout is built once here and uses the callbacks' plot builders
+app.layout = serve_layout
+
+# Prerender the default page before serving the first request, and the other common views in the background
+if warm_up_figures:
+    cases_plot(data_snapshot, *default_cases_plot_inputs(data_snapshot))
+    threading.Thread(target=warm_up, args=(data_snapshot,), name='figure-warm-up', daemon=True).start()
+
+
 if __name__ == '__main__':
     app.run_server()
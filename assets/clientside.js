@@ -0,0 +1,385 @@
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    map: {
+        // Same as display_map in app.py, without the round trip to the server
+        toggle_state: function(clickData, statesStore, figure) {
+            var selected = (statesStore || []).slice();
+
+            if (clickData) {
+                var state = clickData.points[0].location;
+                var position = selected.indexOf(state);
+                if (position === -1) {
+                    selected.push(state);
+                } else {
+                    selected.splice(position, 1);
+                }
+            }
+
+            var choropleth = figure.data[0];
+            var selection = choropleth.locations.map(function(location) {
+                return selected.indexOf(location) === -1 ? 0 : 1;
+            });
+
+            var newFigure = Object.assign({}, figure, {
+                data: [Object.assign({}, choropleth, {z: selection})]
+            });
+
+            return [newFigure, selected];
+        },
+
+        // Shows or hides the metric map, and passes the controls on to produce_metric_map in app.py only while
+        // it is shown, so a hidden map costs no request
+        request_metric_map: function(show, startDate, endDate, smoothWindow, casesOrDeaths, cumulativeOrNew) {
+            if (!show || show.length === 0) {
+                return [window.dash_clientside.no_update, {display: 'none'}];
+            }
+            return [[startDate, endDate, smoothWindow, casesOrDeaths, cumulativeOrNew], {display: 'block'}];
+        },
+
+        // Shows or hides the metric map drawn by render_metric_map, and asks produce_metric_map_series in app.py
+        // for its series only while it is shown and has none of the current data version
+        request_metric_map_series: function(show, dataVersion, series) {
+            if (!show || show.length === 0) {
+                return [window.dash_clientside.no_update, {display: 'none'}];
+            }
+            if (series && dataVersion && series.version === dataVersion.version) {
+                return [window.dash_clientside.no_update, {display: 'block'}];
+            }
+            return [dataVersion ? dataVersion.version : null, {display: 'block'}];
+        }
+    }
+});
+
+// The helpers of the cases plot and the metric map stay out of the global scope
+(function() {
+    window.dash_clientside.plot = {
+        // Passes the selection and the controls on to produce_requested_cases_plot in app.py when the series
+        // of the selection were too large to send, see build_plot_series
+        request_cases_plot: function(series, startDate, endDate, smoothWindow, casesOrDeaths, cumulativeOrNew) {
+            if (!series || !series.server) {
+                return window.dash_clientside.no_update;
+            }
+            return series.inputs.concat([startDate, endDate, smoothWindow, casesOrDeaths, cumulativeOrNew]);
+        },
+
+        // The cases plot of the series sent by produce_plot_series in app.py, for the metric, smoothing and
+        // dates of the controls. Same figure as build_cases_plot, downsampled to the same number of points
+        // but without the rounding, which only makes the server's figures smaller to send. Selections drawn
+        // by the server show its figure once it answers for the current controls.
+        render: function(series, requested, startDate, endDate, smoothWindow, casesOrDeaths, cumulativeOrNew) {
+            if (!series) {
+                return window.dash_clientside.no_update;
+            }
+            if (series.server) {
+                var request = series.inputs.concat([startDate, endDate, smoothWindow, casesOrDeaths, cumulativeOrNew]);
+                if (requested && JSON.stringify(requested.request) === JSON.stringify(request)) {
+                    return requested.figure;
+                }
+                return window.dash_clientside.no_update;
+            }
+            if (series.empty) {
+                return {data: [], layout: series.layout};
+            }
+
+            var metric = series.metrics[casesOrDeaths + '_' + cumulativeOrNew];
+            var column = metric[0];
+            var yTitle = metric[1];
+            var firstDate = String(startDate).slice(0, 10);
+            var lastDate = String(endDate).slice(0, 10);
+
+            // Positions of the dates between firstDate and lastDate, both included
+            var start = sortedIndex(series.dates, firstDate, false);
+            var stop = sortedIndex(series.dates, lastDate, true);
+
+            var traces = series.lines.map(function(line) {
+                if (!line) {
+                    // Keeps the place of the line in the legend, so the colors don't change with the selection
+                    return {
+                        type: 'scatter', mode: 'lines+markers', line: {shape: 'spline'},
+                        hoverlabel: {namelength: 0},
+                        hovertemplate: '<b>%{meta}</b><br>Date: %{x}<br>' + yTitle + ': %{y:.2f}<br>Population: %{customdata:,}',
+                        opacity: 0.8, visible: 'legendonly', showlegend: true
+                    };
+                }
+
+                var values = derived(line, column, smoothWindow || 0);
+                var lineStart = Math.max(start, line.first);
+                var lineStop = Math.max(lineStart, Math.min(stop, line.first + values.length));
+                var x = series.dates.slice(lineStart, lineStop);
+                var y = values.slice(lineStart - line.first, lineStop - line.first);
+
+                if (series.max_points && y.length > series.max_points) {
+                    var keep = lttb(x.map(dayNumber), y, series.max_points);
+                    x = keep.map(function(i) { return x[i]; });
+                    y = keep.map(function(i) { return y[i]; });
+                }
+
+                var trace = {
+                    type: 'scatter',
+                    x: x,
+                    y: y,
+                    name: line.name,
+                    meta: line.name,
+                    mode: 'lines+markers',
+                    line: {shape: 'spline'},
+                    hoverlabel: {namelength: 0},
+                    hovertemplate: '<b>%{meta}</b><br>Date: %{x}<br>' + yTitle + ': %{y:.2f}<br>Population: ' + line.population_label,
+                    opacity: 0.8,
+                    showlegend: line.showlegend,
+                    legendgroup: line.name,
+                    marker: {color: line.color}
+                };
+                if (series.facets) {
+                    trace.xaxis = 'x' + line.axis;
+                    trace.yaxis = 'y' + line.axis;
+                } else {
+                    trace.visible = true;
+                }
+                return trace;
+            });
+
+            var layout = Object.assign({}, series.layout, {shapes: weekendShapes(series.weekends, firstDate, lastDate)});
+            Object.keys(layout).forEach(function(key) {
+                if (key.slice(0, 5) === 'xaxis') {
+                    layout[key] = Object.assign({}, layout[key], {range: [firstDate, lastDate]});
+                }
+            });
+
+            return {data: traces, layout: layout};
+        }
+    };
+
+    // The metric map of the series sent by produce_metric_map_series in app.py, for the metric, smoothing and
+    // dates of the controls. Same figure as build_metric_map, without the rounding.
+    window.dash_clientside.map.render_metric_map = function(series, show, startDate, endDate, smoothWindow, casesOrDeaths, cumulativeOrNew) {
+        if (!series || !show || show.length === 0) {
+            return window.dash_clientside.no_update;
+        }
+
+        var metric = series.metrics[casesOrDeaths + '_' + cumulativeOrNew];
+        var column = metric[0];
+        var yTitle = metric[1];
+        var start = sortedIndex(series.dates, String(startDate).slice(0, 10), false);
+        var stop = sortedIndex(series.dates, String(endDate).slice(0, 10), true);
+        var dates = series.dates.slice(start, stop);
+        if (dates.length === 0) {
+            return {data: [], layout: series.empty_layout};
+        }
+
+        // States x dates matrix of the metric, NaN outside the dates of each state
+        var values = series.lines.map(function(line) {
+            var lineValues = derived(line, column, smoothWindow || 0);
+            return dates.map(function(date, i) {
+                var position = start + i - line.first;
+                return position >= 0 && position < lineValues.length ? lineValues[position] : NaN;
+            });
+        });
+        function onDate(i) {
+            return values.map(function(row) { return row[i]; });
+        }
+
+        var frames = dates.map(function(date, i) {
+            return {name: date, data: [{type: 'choropleth', z: onDate(i)}]};
+        });
+        var steps = dates.map(function(date) {
+            return {
+                label: date, method: 'animate',
+                args: [[date], {mode: 'immediate', frame: {duration: 0, redraw: true}, transition: {duration: 0}}]
+            };
+        });
+
+        var trace = Object.assign({}, series.trace, {
+            z: onDate(dates.length - 1),
+            zmax: percentile(values, 99),
+            colorbar: {title: {text: yTitle + '<br>per 100k'}, thickness: 10},
+            hovertemplate: '%{location}<br>' + yTitle + ': %{z:.2f}<extra></extra>'
+        });
+        var slider = Object.assign({}, series.layout.sliders[0], {active: dates.length - 1, steps: steps});
+
+        return {data: [trace], layout: Object.assign({}, series.layout, {sliders: [slider]}), frames: frames};
+    };
+
+    // numpy.nanpercentile of the rows of a matrix with linear interpolation, 1 when they are all NaN
+    function percentile(rows, q) {
+        var values = [];
+        rows.forEach(function(row) {
+            row.forEach(function(value) {
+                if (!isNaN(value)) {
+                    values.push(value);
+                }
+            });
+        });
+        if (values.length === 0) {
+            return 1;
+        }
+
+        values.sort(function(a, b) { return a - b; });
+        var position = (values.length - 1) * q / 100;
+        var below = Math.floor(position);
+        var above = Math.min(below + 1, values.length - 1);
+        return values[below] + (values[above] - values[below]) * (position - below);
+    }
+
+    // Position of value in the sorted array, before equal elements or after them if right, like numpy.searchsorted
+    function sortedIndex(array, value, right) {
+        var low = 0;
+        var high = array.length;
+        while (low < high) {
+            var middle = (low + high) >> 1;
+            if (array[middle] < value || (right && array[middle] === value)) {
+                low = middle + 1;
+            } else {
+                high = middle;
+            }
+        }
+        return low;
+    }
+
+    // The metric of a line per 100,000 people over its dates, smoothed over window days if window, as
+    // cube.Cube.derived computes it: daily changes of the cumulative count first, then smoothing. The line
+    // holds the daily changes, the first one being the count on its first date, see daily_counts in app.py.
+    function derived(line, column, window) {
+        var isNew = column.slice(0, 4) === 'new_';
+        var values = line[isNew ? column.slice(4) : column].slice();
+
+        if (isNew) {
+            values[0] = 0;
+        } else {
+            for (var i = 1; i < values.length; i++) {
+                values[i] += values[i - 1];
+            }
+        }
+        if (window) {
+            values = smoothSeries(values, window);
+        }
+        return values.map(function(value) { return value / line.population * 100000; });
+    }
+
+    // smoothing.smooth_series: a Savitzky-Golay filter of order 1, fitted like smoothing.fitted_window. Inside
+    // the series it is the mean of the window around each point; the first and last half windows are read off
+    // the least squares line through the first and last windows, like scipy's savgol_filter in interp mode.
+    function smoothSeries(values, windowLength) {
+        var n = values.length;
+        var window = windowLength;
+        if (n < windowLength) {
+            window = n % 2 === 1 ? n : n - 1;
+            if (window <= 1) {
+                return values;
+            }
+        }
+
+        var half = (window - 1) / 2;
+        var smoothed = new Array(n);
+        for (var i = half; i < n - half; i++) {
+            var sum = 0;
+            for (var j = i - half; j <= i + half; j++) {
+                sum += values[j];
+            }
+            smoothed[i] = sum / window;
+        }
+
+        fitEdge(values, smoothed, 0, window, 0, half);
+        fitEdge(values, smoothed, n - window, n, n - half, n);
+        return smoothed;
+    }
+
+    // Fill smoothed from fillStart to fillStop with the least squares line through values from start to stop
+    function fitEdge(values, smoothed, start, stop, fillStart, fillStop) {
+        var count = stop - start;
+        var meanX = (start + stop - 1) / 2;
+        var meanY = 0;
+        for (var i = start; i < stop; i++) {
+            meanY += values[i] / count;
+        }
+
+        var covariance = 0;
+        var variance = 0;
+        for (var i = start; i < stop; i++) {
+            covariance += (i - meanX) * (values[i] - meanY);
+            variance += (i - meanX) * (i - meanX);
+        }
+
+        var slope = covariance / variance;
+        for (var i = fillStart; i < fillStop; i++) {
+            smoothed[i] = meanY + slope * (i - meanX);
+        }
+    }
+
+    // Days since 1970-01-01 of a YYYY-MM-DD date
+    function dayNumber(date) {
+        return Date.parse(date + 'T00:00:00Z') / 86400000;
+    }
+
+    // payload.lttb: the positions of the threshold points of the series which best preserve its shape, the
+    // first and last points always kept
+    function lttb(x, y, threshold) {
+        var n = y.length;
+        var points = [];
+        if (threshold >= n || threshold < 3) {
+            for (var i = 0; i < n; i++) {
+                points.push(i);
+            }
+            return points;
+        }
+
+        y = y.map(function(value) { return isNaN(value) ? 0 : value; });
+
+        // The points between the first and the last are split in threshold-2 buckets
+        var edges = [];
+        for (var i = 0; i < threshold - 1; i++) {
+            edges.push(Math.floor(i * (n - 2) / (threshold - 2)) + 1);
+        }
+        edges[edges.length - 1] = n - 1;
+
+        var previous = 0;
+        points.push(0);
+        for (var i = 0; i < threshold - 2; i++) {
+            var start = edges[i];
+            var stop = edges[i + 1];
+
+            // Average of the next bucket, or the last point for the last bucket
+            var nextX = x[n - 1];
+            var nextY = y[n - 1];
+            if (i + 2 < edges.length) {
+                nextX = mean(x, stop, edges[i + 2]);
+                nextY = mean(y, stop, edges[i + 2]);
+            }
+
+            // Keep the point making the largest triangle with the previously kept point and the next average
+            var largest = -1;
+            var kept = start;
+            for (var j = start; j < stop; j++) {
+                var area = Math.abs((x[previous] - nextX) * (y[j] - y[previous]) - (x[previous] - x[j]) * (nextY - y[previous]));
+                if (area > largest) {
+                    largest = area;
+                    kept = j;
+                }
+            }
+            previous = kept;
+            points.push(kept);
+        }
+        points.push(n - 1);
+        return points;
+    }
+
+    function mean(values, start, stop) {
+        var sum = 0;
+        for (var i = start; i < stop; i++) {
+            sum += values[i];
+        }
+        return sum / (stop - start);
+    }
+
+    // weekends.WeekendShading.shapes: a bar for each weekend with a day between firstDate and lastDate
+    function weekendShapes(weekends, firstDate, lastDate) {
+        var dayBefore = new Date(new Date(firstDate + 'T00:00:00Z').getTime() - 86400000).toISOString().slice(0, 10);
+
+        return weekends.filter(function(weekend) {
+            return weekend[0] >= dayBefore && weekend[0] <= lastDate;
+        }).map(function(weekend) {
+            return {
+                type: 'rect', xref: 'x', yref: 'paper', x0: weekend[1], y0: 0, x1: weekend[2], y1: 1,
+                fillcolor: 'black', opacity: 0.04, layer: 'below', line: {width: 0.0}
+            };
+        });
+    }
+})();
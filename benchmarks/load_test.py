@@ -0,0 +1,519 @@
+import argparse
+import gzip
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from benchmarks import synthetic
+from benchmarks.run_benchmarks import benchmark_pipeline, git_revision
+
+
+# Seconds to wait for a server to answer its first request
+BOOT_SECONDS = 120
+
+# Callbacks a browser sends at once, like the few connections it opens to a host
+BROWSER_CONNECTIONS = 4
+
+# Relative frequency of the user actions, see Session
+ACTIONS = {
+    'map_click': 8,
+    'date_drag': 3,
+    'toggle_counties': 2,
+    'facet_page': 2,
+    'smoothing': 2,
+    'metric': 3,
+    'state_or_metro': 1,
+    'metric_map': 1,
+}
+
+# Seconds between the two ends of a date range drag
+DRAG_SECONDS = 0.3
+
+
+def split_output(output):
+    """
+    The (id, property) of each output of a callback from its Dash output string, e.g. ..a.figure...b.data..
+    """
+    outputs = output[2:-2].split('...') if output.startswith('..') else [output]
+    return [tuple(i.rsplit('.', 1)) for i in outputs]
+
+
+def callback_name(dependency):
+    """
+    The components a callback updates, e.g. facet-page,facet-pager
+    """
+    ids = []
+    for component_id, _ in split_output(dependency['output']):
+        if component_id not in ids:
+            ids.append(component_id)
+    return ','.join(ids)
+
+
+def layout_props(layout, props=None):
+    """
+    The properties of every component with an id in a Dash layout, by (id, property)
+    """
+    if props is None:
+        props = {}
+    if isinstance(layout, list):
+        for child in layout:
+            layout_props(child, props)
+    elif isinstance(layout, dict) and 'props' in layout:
+        component_props = layout['props']
+        if 'id' in component_props:
+            for prop, value in component_props.items():
+                props[(component_props['id'], prop)] = value
+        layout_props(component_props.get('children'), props)
+    return props
+
+
+def toggle_state(click_data, states, figure):
+    """
+    map.toggle_state of assets/clientside.js, only what the callbacks of the server see of it
+    """
+    selected = list(states or [])
+    state = click_data['points'][0]['location']
+    if state in selected:
+        selected.remove(state)
+    else:
+        selected.append(state)
+    return [figure, selected]
+
+
+def request_metric_map(show, *controls):
+    """
+    map.request_metric_map of assets/clientside.js, the controls go to the server only while the map is shown
+    """
+    if not show:
+        return [NO_UPDATE, {'display': 'none'}]
+    return [list(controls), {'display': 'block'}]
+
+
+def request_metric_map_series(show, data_version, series):
+    """
+    map.request_metric_map_series of assets/clientside.js, the series are only asked for while the map is shown
+    and has none of the current data version
+    """
+    if not show:
+        return [NO_UPDATE, {'display': 'none'}]
+    if series and data_version and series['version'] == data_version['version']:
+        return [NO_UPDATE, {'display': 'block'}]
+    return [data_version['version'] if data_version else None, {'display': 'block'}]
+
+
+def render_metric_map(series, *controls):
+    """
+    map.render_metric_map of assets/clientside.js draws the metric map in the browser, no callback of the server reads it
+    """
+    return NO_UPDATE
+
+
+def request_cases_plot(series, *controls):
+    """
+    plot.request_cases_plot of assets/clientside.js, the server only draws selections too large to send as series
+    """
+    if not series or not series.get('server'):
+        return NO_UPDATE
+    return series['inputs'] + list(controls)
+
+
+def render_plot(series, requested, *controls):
+    """
+    plot.render of assets/clientside.js draws the cases plot in the browser, no callback of the server reads it
+    """
+    return None
+
+
+# Returned by the stand-ins of clientside callbacks for outputs left unchanged, like dash_clientside.no_update
+NO_UPDATE = object()
+
+# Python stand-ins for the clientside callbacks, by namespace and function name
+CLIENTSIDE_FUNCTIONS = {
+    ('map', 'toggle_state'): toggle_state,
+    ('map', 'request_metric_map'): request_metric_map,
+    ('map', 'request_metric_map_series'): request_metric_map_series,
+    ('map', 'render_metric_map'): render_metric_map,
+    ('plot', 'request_cases_plot'): request_cases_plot,
+    ('plot', 'render'): render_plot,
+}
+
+
+class Recorder:
+    """
+    Latency and outcome of every request, by name
+    """
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, outcome):
+        with self._lock:
+            self.records.append((name, seconds, outcome))
+
+    def summary(self, duration):
+        names = sorted(set(name for name, _, _ in self.records))
+        result = {}
+        for name in names + ['all']:
+            records = [i for i in self.records if name in ('all', i[0])]
+            if not records:
+                continue
+            latencies = np.array([seconds for _, seconds, _ in records])*1000
+            outcomes = [outcome for _, _, outcome in records]
+            result[name] = {
+                'requests': len(records),
+                'per_second': len(records)/duration,
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p95_ms': float(np.percentile(latencies, 95)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'max_ms': float(latencies.max()),
+                'no_update': outcomes.count('no_update'),
+                'busy': outcomes.count('busy'),
+                'errors': outcomes.count('error'),
+                'error_rate': (outcomes.count('busy') + outcomes.count('error'))/len(records),
+            }
+        return result
+
+
+class Session:
+    """
+    One simulated user: loads the page, then acts on the controls like a user, waiting think_seconds on average
+    between actions. The callbacks an action triggers are sent the way the Dash renderer does: those of one
+    round together, a callback waiting for the others of its round whose outputs it takes as inputs, and the
+    outputs of a round triggering the next. Clientside callbacks run in Python, see CLIENTSIDE_FUNCTIONS.
+    """
+    def __init__(self, host, port, recorder, rng, think_seconds, timeout):
+        self.host = host
+        self.port = port
+        self.recorder = recorder
+        self.rng = rng
+        self.think_seconds = think_seconds
+        self.timeout = timeout
+
+        self.props = {}
+        self.dependencies = []
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(BROWSER_CONNECTIONS)
+
+    def _send(self, method, path, body, headers):
+        """
+        The status and body of a response. Like browsers, retry once on a new connection when the server
+        closed the idle keep-alive one.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                return response, response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+
+        connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def request(self, name, method, path, body=None):
+        """
+        Send a request over the keep-alive connection of this thread and record it. Returns the status and
+        the decoded body, None for errors.
+        """
+        headers = {'Accept-Encoding': 'gzip'}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+
+        start = time.perf_counter()
+        try:
+            response, content = self._send(method, path, body, headers)
+            if response.getheader('Content-Encoding') == 'gzip':
+                content = gzip.decompress(content)
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self._local.connection = None
+            self.recorder.add(name, time.perf_counter() - start, 'error')
+            return None, None
+        seconds = time.perf_counter() - start
+
+        if status == 200:
+            outcome = 'ok'
+        elif status == 204:
+            outcome = 'no_update'
+        elif status == 503:
+            outcome = 'busy'
+        else:
+            outcome = 'error'
+        self.recorder.add(name, seconds, outcome)
+        return status, content
+
+    def load_page(self):
+        self.request('page', 'GET', '/')
+        _, layout = self.request('_dash-layout', 'GET', '/_dash-layout')
+        _, dependencies = self.request('_dash-dependencies', 'GET', '/_dash-dependencies')
+        if layout is None or dependencies is None:
+            return False
+
+        self.props = layout_props(json.loads(layout))
+        self.dependencies = json.loads(dependencies)
+        self.run_callbacks([i for i in self.dependencies if not i.get('prevent_initial_call')], set())
+        return True
+
+    def call(self, dependency, changed):
+        """
+        Run a callback with the current values of its inputs and state. Returns its new property values.
+        """
+        inputs = [dict(i, value=self.props.get((i['id'], i['property']))) for i in dependency['inputs']]
+        state = [dict(i, value=self.props.get((i['id'], i['property']))) for i in dependency['state']]
+        outputs = split_output(dependency['output'])
+
+        clientside = dependency.get('clientside_function')
+        if clientside:
+            function = CLIENTSIDE_FUNCTIONS[(clientside['namespace'], clientside['function_name'])]
+            values = function(*[i['value'] for i in inputs + state])
+            return {prop: value for prop, value in zip(outputs, values if len(outputs) > 1 else [values]) if value is not NO_UPDATE}
+
+        output_dicts = [{'id': i, 'property': p} for i, p in outputs]
+        status, content = self.request(callback_name(dependency), 'POST', '/_dash-update-component', {
+            'output': dependency['output'],
+            'outputs': output_dicts if dependency['output'].startswith('..') else output_dicts[0],
+            'inputs': inputs,
+            'state': state,
+            'changedPropIds': ['{}.{}'.format(*i) for i in changed if i in [(j['id'], j['property']) for j in inputs]],
+        })
+        if status != 200:
+            return {}
+
+        body = json.loads(content)
+        if 'multi' not in body:
+            body['response'] = {outputs[0][0]: body['response']['props']}
+        return {(component_id, prop): value for component_id, props in body['response'].items() for prop, value in props.items()}
+
+    def triggered(self, changed):
+        return [i for i in self.dependencies if any((j['id'], j['property']) in changed for j in i['inputs'])]
+
+    def run_callbacks(self, pending, changed):
+        """
+        Run the pending callbacks, triggered by the changed properties, and those their outputs trigger
+        """
+        while pending:
+            pending_outputs = set(output for i in pending for output in split_output(i['output']))
+            ready = [i for i in pending if not any((j['id'], j['property']) in pending_outputs for j in i['inputs'])] or pending
+
+            results = list(self._pool.map(lambda dependency: self.call(dependency, changed), ready))
+
+            changed = set()
+            for result in results:
+                for prop, value in result.items():
+                    if self.props.get(prop) != value:
+                        self.props[prop] = value
+                        changed.add(prop)
+
+            waiting = [i for i in pending if i not in ready]
+            pending = waiting + [i for i in self.triggered(changed) if i not in waiting]
+
+    def set(self, prop, value):
+        self.props[prop] = value
+        self.run_callbacks(self.triggered({prop}), {prop})
+
+    def act(self, action):
+        """
+        Change the controls like a user would for action, see ACTIONS
+        """
+        rng = self.rng
+        if action == 'map_click':
+            states = self.props[('states-plot', 'figure')]['data'][0]['locations']
+            self.set(('states-plot', 'clickData'), {'points': [{'location': rng.choice(states)}]})
+        elif action == 'date_drag':
+            # The picker sets the start, then the end
+            first = datetime.strptime(str(self.props[('date-range', 'min_date_allowed')])[:10], '%Y-%m-%d')
+            last = datetime.strptime(str(self.props[('date-range', 'max_date_allowed')])[:10], '%Y-%m-%d')
+            start, end = sorted(rng.sample(range((last - first).days + 1), 2))
+            self.set(('date-range', 'start_date'), (first + timedelta(days=start)).strftime('%Y-%m-%d'))
+            time.sleep(DRAG_SECONDS)
+            self.set(('date-range', 'end_date'), (first + timedelta(days=end)).strftime('%Y-%m-%d'))
+        elif action == 'toggle_counties':
+            self.set(('cases-by-county', 'value'), [] if self.props[('cases-by-county', 'value')] else [1])
+        elif action == 'facet_page':
+            pages = self.props.get(('facet-page', 'options')) or []
+            if len(pages) > 1:
+                self.set(('facet-page', 'value'), rng.choice(pages)['value'])
+        elif action == 'smoothing':
+            self.set(('smooth-cases', 'value'), rng.choice(self.props[('smooth-cases', 'options')])['value'])
+        elif action == 'metric':
+            prop = rng.choice([('cases-or-deaths', 'value'), ('cumulative-or-new', 'value')])
+            self.set(prop, rng.choice([i['value'] for i in self.props[(prop[0], 'options')] if i['value'] != self.props[prop]]))
+        elif action == 'state_or_metro':
+            self.set(('state-or-city-selector', 'value'), 'state' if self.props[('state-or-city-selector', 'value')] != 'state' else 'state_metro')
+        elif action == 'metric_map':
+            self.set(('metric-map-toggle', 'value'), [] if self.props[('metric-map-toggle', 'value')] else [1])
+
+    def run(self, deadline):
+        try:
+            while time.monotonic() < deadline and not self.load_page():
+                time.sleep(1)
+
+            actions, weights = zip(*ACTIONS.items())
+            while time.monotonic() < deadline:
+                time.sleep(self.rng.expovariate(1/self.think_seconds) if self.think_seconds > 0 else 0)
+                if time.monotonic() < deadline:
+                    self.act(self.rng.choices(actions, weights)[0])
+        finally:
+            self._pool.shutdown()
+
+
+def run_load(host, port, users, duration, think_seconds, seed, timeout):
+    """
+    Run users sessions against the server for duration seconds. Returns the summary of the requests, by name.
+    """
+    recorder = Recorder()
+    deadline = time.monotonic() + duration
+    threads = []
+    for i in range(users):
+        session = Session(host, port, recorder, random.Random(seed + i), think_seconds, timeout)
+        threads.append(threading.Thread(target=session.run, args=(deadline,), daemon=True))
+
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return recorder.summary(time.monotonic() - start)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(repo_dir, app_dir, workers, threads, port, shared_cache_path):
+    """
+    Start gunicorn serving app.py from repo_dir on the data/ folder of app_dir, like the Procfile does,
+    and wait until it answers. Each server gets its own shared cache, so runs don't warm up each other.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repo_dir, os.environ.get('PYTHONPATH')])),
+               SHARED_CACHE_PATH=shared_cache_path)
+    command = [sys.executable, '-m', 'gunicorn', 'app:server', '--workers', str(workers), '--threads', str(threads),
+               '--bind', '127.0.0.1:{}'.format(port), '--log-level', 'warning']
+    server = subprocess.Popen(command, cwd=app_dir, env=env)
+
+    deadline = time.monotonic() + BOOT_SECONDS
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited with code {}'.format(server.returncode))
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/_dash-layout')
+            if connection.getresponse().status == 200:
+                return server
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.2)
+
+    stop_server(server)
+    raise RuntimeError('gunicorn did not answer within {} seconds'.format(BOOT_SECONDS))
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def parse_config(config):
+    """
+    Workers and threads of a gunicorn configuration written WxT, e.g. 2x4
+    """
+    workers, threads = config.lower().split('x')
+    return int(workers), int(threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay simulated user sessions against gunicorn running the app, '
+                                                 'for several worker and thread configurations and numbers of users')
+    parser.add_argument('--configs', default='1x4,2x2,2x4', help='Comma separated gunicorn configurations, workers x threads')
+    parser.add_argument('--users', default='4,16', help='Comma separated numbers of concurrent users')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds each configuration and number of users is run')
+    parser.add_argument('--think-seconds', type=float, default=1.0, help='Mean seconds a user waits between two actions')
+    parser.add_argument('--settle-seconds', type=float, default=3, help='Seconds between the server answering and the first user')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds before a request counts as an error')
+    parser.add_argument('--app-dir', default=None,
+                        help='Directory holding the data/ folder to serve, synthetic data (--counties, --days) by default')
+    parser.add_argument('--counties', type=int, default=3000, help='Number of counties in the synthetic sources')
+    parser.add_argument('--days', type=int, default=300, help='Number of days in the synthetic sources')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='load_output.json', help='Where to write the JSON results')
+    args = parser.parse_args()
+
+    repo_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='covid_dashboard_load_')
+    app_dir = args.app_dir and os.path.abspath(args.app_dir)
+    if app_dir is None:
+        app_dir = work_dir
+        data_dir = os.path.join(work_dir, 'data')
+        cases_path, deaths_path, fips_to_city_path = synthetic.generate(data_dir, args.counties, args.days, args.seed)
+        benchmark_pipeline(cases_path, deaths_path, fips_to_city_path, data_dir, 1)
+
+    runs = []
+    try:
+        for config in args.configs.split(','):
+            workers, threads = parse_config(config)
+            for users in [int(i) for i in args.users.split(',')]:
+                port = free_port()
+                shared_cache_path = os.path.join(work_dir, 'shared_cache_{}.sqlite3'.format(len(runs)))
+                server = start_server(repo_dir, app_dir, workers, threads, port, shared_cache_path)
+                try:
+                    time.sleep(args.settle_seconds)
+                    summary = run_load('127.0.0.1', port, users, args.duration, args.think_seconds, args.seed, args.timeout)
+                finally:
+                    stop_server(server)
+
+                runs.append({'workers': workers, 'threads': threads, 'users': users, 'callbacks': summary})
+                print('{}x{} workers x threads, {} users'.format(workers, threads, users))
+                for name, result in summary.items():
+                    print('  {:<32} {:>6} req {:>7.1f}/s  p50 {:>7.0f}ms  p95 {:>7.0f}ms  p99 {:>7.0f}ms  {:>5.1%} errors'.format(
+                        name, result['requests'], result['per_second'], result['p50_ms'], result['p95_ms'],
+                        result['p99_ms'], result['error_rate']))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'meta': {
+            'created': datetime.utcnow().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'app_dir': args.app_dir,
+            'counties': None if args.app_dir else args.counties,
+            'days': None if args.app_dir else args.days,
+            'duration': args.duration,
+            'think_seconds': args.think_seconds,
+            'actions': ACTIONS,
+        },
+        'runs': runs,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import plotly
+
+import dataset
+import fetch_data
+import reshape
+from benchmarks import synthetic
+
+
+def timed(function, repeat):
+    """
+    Call function repeat times. Returns its last result and the timings in seconds.
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - start)
+
+    return result, summarize(runs)
+
+
+def summarize(runs):
+    return {'min': min(runs), 'median': statistics.median(runs), 'max': max(runs), 'runs': runs}
+
+
+def benchmark_pipeline(cases_path, deaths_path, fips_to_city_path, output_dir, repeat):
+    """
+    Time each stage of fetch_data.py on the synthetic sources. Every stage is repeated on the output of the
+    previous one.
+    """
+    results = {}
+
+    def stage(name, function):
+        result, timings = timed(function, repeat)
+        results[name] = timings
+        return result
+
+    cases, deaths = stage('read', lambda: fetch_data.read_sources(cases_path, deaths_path))
+    counties = stage('align', lambda: fetch_data.align_sources(cases, deaths))
+
+    states = stage('rollup_states', lambda: fetch_data.rollup_states(counties))
+    our_counties = stage('read_fips_to_city', lambda: fetch_data.read_fips_to_city(fips_to_city_path))
+    metro_counties = stage('rollup_counties', lambda: fetch_data.rollup_counties(counties, our_counties))
+    metros = stage('rollup_metros', lambda: fetch_data.rollup_metros(metro_counties))
+
+    all_cases_and_deaths = stage('to_long', lambda: reshape.concat([states, metro_counties, metros])\
+                                                    .to_long(fetch_data.OUTPUT_COLUMNS, dataset.STRING_COLUMNS))
+    cases_and_deaths = stage('sort', lambda: fetch_data.sort_series(all_cases_and_deaths))
+
+    csv_path = os.path.join(output_dir, 'cases_and_deaths.csv')
+    artifact_path = os.path.join(output_dir, 'cases_and_deaths')
+    stage('write_csv', lambda: cases_and_deaths.to_csv(csv_path, index=False))
+    stage('write_artifact', lambda: dataset.write_artifact(cases_and_deaths, artifact_path))
+
+    results['total'] = {'median': sum(i['median'] for i in results.values())}
+    return results, len(cases_and_deaths)
+
+
+def benchmark_cold_start(repo_dir, repeat):
+    """
+    Time importing app.py in a fresh interpreter, as every gunicorn worker does when it boots: the import as
+    timed by the child process, and the whole process including the interpreter startup. Must be called from
+    a directory holding the data/ folder.
+    """
+    command = [sys.executable, '-c', 'import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)']
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repo_dir, os.environ.get('PYTHONPATH')])))
+    # Every run starts cold, without the figures an earlier run left in the shared cache
+    env.setdefault('SHARED_CACHE', 'none')
+
+    imports = []
+    processes = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.check_output(command, env=env)
+        processes.append(time.perf_counter() - start)
+        imports.append(float(output.decode().split()[-1]))
+
+    return {'import_app': summarize(imports), 'process': summarize(processes)}
+
+
+def benchmark_callbacks(selection_sizes, repeat):
+    """
+    Time the four branches of produce_cases_plot (state or metro, with or without counties) for growing
+    state selections, split into the time spent in the plot builders and in the rest of the callback,
+    plus the serialized size of the figures. Must be called from a directory holding the data/ folder.
+    """
+    # Without the background warm-up, which would compete with the timed callbacks and fill the figure cache,
+    # nor the shared cache
+    os.environ.setdefault('WARM_UP_FIGURES', '0')
+    os.environ.setdefault('SHARED_CACHE', 'none')
+    import app
+
+    normal_plot = app.produce_case_normal_plot
+    facet_plot = app.produce_case_facet_plot
+    builder_runs = []
+
+    def timed_builder(builder):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = builder(*args, **kwargs)
+            builder_runs.append(time.perf_counter() - start)
+            return result
+        return wrapper
+
+    app.produce_case_normal_plot = timed_builder(normal_plot)
+    app.produce_case_facet_plot = timed_builder(facet_plot)
+
+    data = app.data_snapshot
+    all_states = sorted(data.states['state_abbreviation'])
+    first_date = data.min_date.strftime('%Y-%m-%d')
+    last_date = data.max_date.strftime('%Y-%m-%d')
+
+    results = []
+    try:
+        for state_or_metro in ['state', 'state_metro']:
+            for cases_by_county in [[], [1]]:
+                for size in selection_sizes:
+                    states_list = all_states[:size]
+                    inputs = (states_list, state_or_metro, app.default_metros_per_state, first_date, last_date, cases_by_county, 0, 'cases', 'new')
+
+                    del builder_runs[:]
+                    figure, callback_timings = timed(lambda: app.build_cases_plot(data, *inputs), repeat)
+                    builder = 'produce_case_facet_plot' if cases_by_county else 'produce_case_normal_plot'
+
+                    serialized, serialize_timings = timed(lambda: json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder), repeat)
+                    figure_dict = json.loads(serialized)
+
+                    results.append({
+                        'branch': '{}{}'.format(state_or_metro, '_counties' if cases_by_county else ''),
+                        'builder': builder,
+                        'num_states': len(states_list),
+                        'callback': callback_timings,
+                        'builder_time': summarize(builder_runs),
+                        'serialize': serialize_timings,
+                        'num_traces': len(figure_dict['data']),
+                        'num_shapes': len(figure_dict['layout'].get('shapes', [])),
+                        'bytes': len(serialized),
+                    })
+    finally:
+        app.produce_case_normal_plot = normal_plot
+        app.produce_case_facet_plot = facet_plot
+
+    # A repeated request served by the figure cache
+    produce_cases_plot = getattr(app.produce_cases_plot, '__wrapped__', app.produce_cases_plot)
+    inputs = (all_states, 'state', app.default_metros_per_state, first_date, last_date, [], 0, 'cases', 'new', 0, None)
+    produce_cases_plot(*inputs)
+    _, cached_timings = timed(lambda: produce_cases_plot(*inputs), repeat)
+
+    _, map_timings = timed(lambda: app.display_map({'points': [{'location': all_states[0]}]}, all_states[1:]), repeat)
+
+    return {'produce_cases_plot': results, 'cached_produce_cases_plot': cached_timings, 'display_map': map_timings}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fetch_data.py and the app callbacks on synthetic data')
+    parser.add_argument('--counties', type=int, default=3000, help='Number of counties in the synthetic sources')
+    parser.add_argument('--days', type=int, default=300, help='Number of days in the synthetic sources')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each timing')
+    parser.add_argument('--selections', default='1,5,10,25,51', help='Comma separated numbers of selected states')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_output.json', help='Where to write the JSON results')
+    args = parser.parse_args()
+
+    repo_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='covid_dashboard_bench_')
+    data_dir = os.path.join(work_dir, 'data')
+
+    try:
+        cases_path, deaths_path, fips_to_city_path = synthetic.generate(data_dir, args.counties, args.days, args.seed)
+
+        pipeline, num_rows = benchmark_pipeline(cases_path, deaths_path, fips_to_city_path, data_dir, args.repeat)
+
+        # app.py loads data/ relative to the working directory
+        os.chdir(work_dir)
+        cold_start = benchmark_cold_start(repo_dir, args.repeat)
+        selection_sizes = [int(i) for i in args.selections.split(',')]
+        callbacks = benchmark_callbacks(selection_sizes, args.repeat)
+    finally:
+        os.chdir(repo_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'meta': {
+            'created': datetime.utcnow().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'plotly': plotly.__version__,
+            'counties': args.counties,
+            'days': args.days,
+            'output_rows': num_rows,
+            'repeat': args.repeat,
+        },
+        'pipeline': pipeline,
+        'cold_start': cold_start,
+        'callbacks': callbacks,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for name, timings in pipeline.items():
+        print('{:<20} {:8.3f}s'.format(name, timings['median']))
+    for name, timings in cold_start.items():
+        print('{:<20} {:8.3f}s'.format('cold_start.' + name, timings['median']))
+    for result in callbacks['produce_cases_plot']:
+        print('{:<20} {:>3} states {:8.3f}s {:>10} bytes'.format(result['branch'], result['num_states'],
+                                                                  result['callback']['median'], result['bytes']))
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from fetch_data import US_STATE_ABBREV
+
+
+FIPS_TO_CITY_COLUMNS = ['cbsacode', 'metrodivisioncode', 'csacode', 'cbsatitle', 'metropolitanmicropolitanstatis',
+                        'metropolitandivisiontitle', 'csatitle', 'countycountyequivalent', 'statename',
+                        'fipsstatecode', 'fipscountycode', 'centraloutlyingcounty']
+
+
+def source_date_columns(num_days, first_date='2020-01-22'):
+    """
+    Date column names the way JHU writes them, e.g. 3/1/20
+    """
+    return ['{}/{}/{:02d}'.format(i.month, i.day, i.year % 100) for i in pd.date_range(first_date, periods=num_days)]
+
+
+def generate(directory, num_counties=3000, num_days=300, seed=0):
+    """
+    Write JHU shaped confirmed and deaths time series with num_counties counties and num_days days,
+    and a fips_to_city.csv linking about half of the counties to metro areas, into directory.
+
+    Like the real files, the time series include rows fetch_data.py has to filter out: "Out of" and
+    "Unassigned" rows with no population in each state, territories and a cruise ship without a FIPS code.
+    A few metros span two states. Returns the paths of the confirmed, deaths and fips_to_city files.
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    state_names = sorted(US_STATE_ABBREV)
+    state_codes = {name: i+1 for i, name in enumerate(state_names)}
+
+    # Counties, spread over the states
+    county_state = rng.randint(len(state_names), size=num_counties)
+    counties = pd.DataFrame({'state': [state_names[i] for i in county_state]})
+    counties['county_code'] = counties.groupby('state').cumcount()*2 + 1
+    counties['FIPS'] = counties['state'].map(state_codes)*1000 + counties['county_code']
+    counties['Admin2'] = ['County {}'.format(i) for i in counties['county_code']]
+    counties['Population'] = rng.lognormal(10.5, 1.3, size=num_counties).astype(int) + 100
+
+    # Metro areas of 1 to 6 neighbouring counties within a state
+    fips_to_city = []
+    metro_code = 10000
+    for state, state_counties in counties.sample(frac=0.5, random_state=seed).groupby('state'):
+        rows = state_counties.sort_values('FIPS').to_dict('records')
+        while rows:
+            size = min(rng.randint(1, 7), len(rows))
+            members, rows = rows[:size], rows[size:]
+            title = 'Metro {}, {}'.format(metro_code, US_STATE_ABBREV[state])
+            for member in members:
+                fips_to_city.append((metro_code, title, member['Admin2'] + ' County', state, member['FIPS']))
+            metro_code += 5
+
+    fips_to_city = pd.DataFrame(fips_to_city, columns=['cbsacode', 'cbsatitle', 'countycountyequivalent', 'statename', 'fips'])
+
+    # Move one county of some metros into a metro of another state so that it spans both states
+    metros = fips_to_city[['cbsacode', 'cbsatitle']].drop_duplicates()
+    for _, metro in metros.sample(frac=0.05, random_state=seed).iterrows():
+        other = fips_to_city[fips_to_city['cbsacode'] != metro['cbsacode']].sample(1, random_state=rng).index
+        fips_to_city.loc[other, ['cbsacode', 'cbsatitle']] = metro[['cbsacode', 'cbsatitle']].values
+
+    fips_to_city['metrodivisioncode'] = np.nan
+    fips_to_city['csacode'] = np.nan
+    fips_to_city['metropolitanmicropolitanstatis'] = 'Metropolitan Statistical Area'
+    fips_to_city['metropolitandivisiontitle'] = np.nan
+    fips_to_city['csatitle'] = np.nan
+    fips_to_city['fipsstatecode'] = fips_to_city['fips'] // 1000
+    fips_to_city['fipscountycode'] = fips_to_city['fips'] % 1000
+    fips_to_city['centraloutlyingcounty'] = 'Central'
+
+    # Rows without population which fetch_data.py drops
+    extra = []
+    for state in state_names:
+        code = state_codes[state]
+        extra.append({'state': state, 'FIPS': 80000 + code, 'Admin2': 'Out of ' + US_STATE_ABBREV[state], 'Population': 0})
+        extra.append({'state': state, 'FIPS': 90000 + code, 'Admin2': 'Unassigned', 'Population': 0})
+    extra.append({'state': 'Puerto Rico', 'FIPS': 72001, 'Admin2': 'Adjuntas', 'Population': 17363})
+    extra.append({'state': 'Guam', 'FIPS': 66, 'Admin2': np.nan, 'Population': 168485})
+    extra.append({'state': 'Diamond Princess', 'FIPS': np.nan, 'Admin2': np.nan, 'Population': 0})
+
+    rows = pd.concat([counties, pd.DataFrame(extra)], ignore_index=True)
+    rows['UID'] = 84000000 + rows['FIPS'].fillna(99999).astype(int)
+    rows['iso2'] = 'US'
+    rows['iso3'] = 'USA'
+    rows['code3'] = 840
+    rows['Province_State'] = rows['state']
+    rows['Country_Region'] = 'US'
+    rows['Lat'] = rng.uniform(25, 49, size=len(rows)).round(6)
+    rows['Long_'] = rng.uniform(-124, -67, size=len(rows)).round(6)
+    rows['Combined_Key'] = rows['Admin2'].fillna('') + ', ' + rows['state'] + ', US'
+
+    # Cumulative counts from daily counts which grow in waves, with the odd negative correction
+    waves = 1 + np.sin(np.linspace(0, 3*np.pi, num_days))**2 * np.linspace(0.2, 3, num_days)
+    rates = rows['Population'].values[:, None] / 10000 * waves[None, :] * rng.uniform(0.2, 2, size=(len(rows), 1))
+    daily_cases = rng.poisson(rates)
+    daily_cases[rng.uniform(size=daily_cases.shape) < 0.002] *= -1
+    daily_deaths = rng.binomial(np.abs(daily_cases), 0.015) * np.sign(daily_cases)
+
+    dates = source_date_columns(num_days)
+    id_columns = ['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Admin2', 'Province_State', 'Country_Region', 'Lat', 'Long_', 'Combined_Key']
+    confirmed = pd.concat([rows[id_columns], pd.DataFrame(daily_cases.cumsum(axis=1), columns=dates)], axis=1)
+    deaths = pd.concat([rows[id_columns + ['Population']], pd.DataFrame(daily_deaths.cumsum(axis=1), columns=dates)], axis=1)
+
+    paths = [os.path.join(directory, name) for name in ['confirmed.csv', 'deaths.csv', 'fips_to_city.csv']]
+    confirmed.to_csv(paths[0], index=False)
+    deaths.to_csv(paths[1], index=False)
+    fips_to_city[FIPS_TO_CITY_COLUMNS].to_csv(paths[2], index=False)
+
+    return paths
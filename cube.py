@@ -0,0 +1,216 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import smoothing
+
+
+# Cumulative counts, one slice of the cube each. Everything the plots show is derived from them
+METRICS = ['cases', 'deaths']
+
+# Number of derived series kept by each cube
+DERIVED_CACHE_ENTRIES = int(os.environ.get('DERIVED_CACHE_ENTRIES', 4096))
+
+# An entity is one line of the data: a state, one state's part of a metro or a county of a metro
+ENTITY_COLUMNS = ['state_abbreviation', 'city', 'county']
+
+
+class Cube:
+    """
+    The cases/deaths data as a dense float array indexed by entity, date and metric, with lookup tables
+    from states and metros to their entities. Every line of a plot is a slice of the array, so building
+    a plot costs in proportion to what is plotted rather than to the size of the data.
+
+    Metros are ranked by population within their state (rank), and counties share the rank of their
+    metro, so the k largest metros of each state can be picked at request time.
+
+    Only the cumulative counts are stored. Daily counts, normalization and smoothing are applied to the
+    series a plot asks for, and the results are memoized in a bounded LRU, see derived.
+
+    Cubes are built from the data with from_data, or memory-mapped from the files written by save with load.
+    """
+    def __init__(self, values, dates, first, last, population, entities, metrics=METRICS, derived_cache_entries=DERIVED_CACHE_ENTRIES):
+        self.metrics = {metric: i for i, metric in enumerate(metrics)}
+        self.dates = dates
+        self.values = values
+
+        # Dates covered by each entity, lines are not drawn outside of them
+        self.first = first
+        self.last = last
+
+        self.population = population
+
+        self.entities = entities
+        self.states = {}          # state -> state entity
+        self.metros = {}          # state -> [(metro, entity)]
+        self.state_counties = {}  # state -> [(county, entity)]
+        self.metro_counties = {}  # (metro, state) -> [(county, entity)]
+        for entity, (state, city, county) in enumerate(entities.itertuples(index=False)):
+            if county:
+                self.state_counties.setdefault(state, []).append((county, entity))
+                self.metro_counties.setdefault((city, state), []).append((county, entity))
+            elif city:
+                self.metros.setdefault(state, []).append((city, entity))
+            elif state:
+                self.states[state] = entity
+
+        for lines in list(self.state_counties.values()) + list(self.metro_counties.values()):
+            lines.sort()
+
+        self._derived = OrderedDict()
+        self._derived_lock = threading.Lock()
+        self.derived_cache_entries = derived_cache_entries
+
+        # Rank of each metro by population within its state, ties in name order; 0 for states
+        self.rank = np.zeros(len(entities), dtype=int)
+        for state, metros in self.metros.items():
+            by_population = sorted(metros, key=lambda metro: (-self.population[metro[1]], metro[0]))
+            for rank, (city, entity) in enumerate(by_population, 1):
+                self.rank[entity] = rank
+                for county, county_entity in self.metro_counties.get((city, state), []):
+                    self.rank[county_entity] = rank
+
+    def top_metros(self, entities, k):
+        """
+        The (name, entity) pairs of entities whose metro is among the k largest of its state, all of them if k is 0
+        """
+        if not k:
+            return list(entities)
+        return [(name, entity) for name, entity in entities if self.rank[entity] <= k]
+
+    def date_range(self, first_date, last_date):
+        """
+        Positions of the dates between first_date and last_date, both included
+        """
+        start = np.searchsorted(self.dates, np.datetime64(first_date), side='left')
+        stop = np.searchsorted(self.dates, np.datetime64(last_date), side='right')
+        return start, stop
+
+    def counts(self, entity, count):
+        """
+        The stored cumulative count of one entity over its dates
+        """
+        return self.values[self.metrics[count], entity, self.first[entity]:self.last[entity] + 1].astype(np.float64)
+
+    def derived(self, entity, metric, window=0):
+        """
+        The whole series of metric per 100,000 people for one entity, smoothed over window days if window.
+        metric is one of the stored cumulative counts, or new_<count> for its daily changes.
+        """
+        key = (entity, metric, window)
+        with self._derived_lock:
+            values = self._derived.get(key)
+            if values is not None:
+                self._derived.move_to_end(key)
+                return values
+
+        new = metric.startswith('new_')
+        values = self.counts(entity, metric[len('new_'):] if new else metric)
+
+        if new:
+            values = np.diff(values, prepend=values[:1])
+        if window:
+            values = smoothing.smooth_series(values, window)
+        values = values / self.population[entity] * 100000
+        values.flags.writeable = False
+
+        with self._derived_lock:
+            self._derived[key] = values
+            while len(self._derived) > self.derived_cache_entries:
+                self._derived.popitem(last=False)
+
+        return values
+
+    def matrix(self, entities, metric, window=0):
+        """
+        The derived metric of several entities as an entities x dates array, nan outside the dates of each entity
+        """
+        values = np.full((len(entities), len(self.dates)), np.nan)
+        for row, entity in enumerate(entities):
+            values[row, self.first[entity]:self.last[entity] + 1] = self.derived(entity, metric, window)
+        return values
+
+    def series(self, entity, metric, start, stop, window=0):
+        """
+        Dates and values of a derived metric for one entity between the date positions start and stop
+        """
+        start = max(start, self.first[entity])
+        stop = max(start, min(stop, self.last[entity] + 1))
+        values = self.derived(entity, metric, window)
+        return self.dates[start:stop], values[start - self.first[entity]:stop - self.first[entity]]
+
+
+def from_data(data, metrics=METRICS):
+    """
+    Build the cube of data, in the long format of data/cases_and_deaths.csv: a dataframe or a dict of its
+    columns. Rows are matched to their entity through integer codes of the key columns, so categorical
+    columns are never expanded into strings row by row.
+    """
+    dates = np.sort(data['date'].unique())
+
+    # One integer per row combining the codes of its keys. Missing city and county are '', and the codes
+    # follow the order of the names so that the entities sort by name
+    key = np.zeros(len(data['date']), dtype=np.int64)
+    names = []
+    for column in ENTITY_COLUMNS:
+        codes, uniques = pd.factorize(data[column])
+        column_names, rank = np.unique(np.array([''] + [str(i) for i in uniques], dtype=object), return_inverse=True)
+        key *= len(column_names)
+        key += rank[codes + 1]
+        names.append(column_names)
+
+    entity_keys, entity_index = np.unique(key, return_inverse=True)
+    del key
+    entity_codes = np.unravel_index(entity_keys, [len(column_names) for column_names in names])
+    entities = pd.DataFrame({column: column_names[codes] for column, column_names, codes in zip(ENTITY_COLUMNS, names, entity_codes)})
+    date_index = np.searchsorted(dates, data['date'].values)
+
+    # Stored metric first so that the dates of one line are contiguous. Single precision holds counts
+    # exactly up to 2**24 and halves the size of the array, which holds every metro of every state
+    values = np.full((len(metrics), len(entities), len(dates)), np.nan, dtype=np.float32)
+    for i, metric in enumerate(metrics):
+        values[i, entity_index, date_index] = data[metric].to_numpy(dtype=np.float64)
+
+    first = np.full(len(entities), len(dates))
+    last = np.full(len(entities), -1)
+    np.minimum.at(first, entity_index, date_index)
+    np.maximum.at(last, entity_index, date_index)
+
+    population = np.zeros(len(entities))
+    population[entity_index] = data['population'].to_numpy(dtype=np.float64)
+
+    return Cube(values, dates, first, last, population, entities, metrics)
+
+
+def save(cases_cube, path):
+    """
+    Write the arrays of a cube into the directory path, as cube_<name>.npy files and cube.json
+    """
+    for name in ['values', 'dates', 'first', 'last', 'population']:
+        np.save(os.path.join(path, 'cube_' + name + '.npy'), getattr(cases_cube, name))
+
+    with open(os.path.join(path, 'cube.json'), 'w') as f:
+        json.dump({'metrics': list(cases_cube.metrics),
+                   'entities': cases_cube.entities[ENTITY_COLUMNS].values.tolist()}, f)
+
+
+def exists(path):
+    return os.path.exists(os.path.join(path, 'cube.json'))
+
+
+def load(path):
+    """
+    The cube saved in the directory path. The values are memory-mapped, so all workers share one copy.
+    """
+    with open(os.path.join(path, 'cube.json')) as f:
+        meta = json.load(f)
+
+    arrays = {name: np.load(os.path.join(path, 'cube_' + name + '.npy'), mmap_mode='r' if name == 'values' else None)
+              for name in ['values', 'dates', 'first', 'last', 'population']}
+    entities = pd.DataFrame(meta['entities'], columns=ENTITY_COLUMNS)
+
+    return Cube(arrays['values'], arrays['dates'], arrays['first'], arrays['last'], arrays['population'], entities, meta['metrics'])
@@ -0,0 +1,131 @@
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import cube
+
+
+ARTIFACT_DIR = 'data/cases_and_deaths'
+CSV_PATH = 'data/cases_and_deaths.csv'
+ARTIFACT_FORMAT = 2
+STRING_COLUMNS = ['state', 'state_abbreviation', 'city', 'county']
+
+
+def clean_city_names(city):
+    """
+    Metro titles are shown without their state suffix, e.g. 'Chicago-Naperville-Elgin, IL-IN-WI' -> 'Chicago-Naperville-Elgin'.
+    Categorical columns are cleaned through their categories rather than row by row.
+    """
+    if not isinstance(city.dtype, pd.CategoricalDtype):
+        return city.str.split(',').str[0]
+
+    codes, categories = pd.factorize(city.cat.categories.str.split(',').str[0])
+    category_codes = city.cat.codes.to_numpy()
+    codes = np.where(category_codes >= 0, codes[category_codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=city.index, name=city.name)
+
+
+def write_artifact(cases_and_deaths, path=ARTIFACT_DIR):
+    """
+    Write the cases/deaths data as an artifact which app.py can memory-map.
+
+    The layout of the directory is:
+        meta.json  - format, version and row count of the data
+        cube*      - the arrays of the cube app.py plots from, see cube.save
+
+    The cube is built from the columns of cases_and_deaths, without copying the frame nor expanding its
+    categorical columns into strings. The new artifact is written next to the old one and swapped in with
+    a rename, so workers which have the old files mapped keep reading a consistent copy.
+    """
+    columns = {column: cases_and_deaths[column] for column in cube.ENTITY_COLUMNS + cube.METRICS + ['population']}
+    columns['city'] = clean_city_names(columns['city'])
+    columns['date'] = pd.to_datetime(cases_and_deaths['date'])
+
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    cube.save(cube.from_data(columns), tmp_path)
+
+    meta = {
+        'format': ARTIFACT_FORMAT,
+        'version': datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'),
+        'rows': len(cases_and_deaths),
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # Swap the new artifact in
+    old_path = path + '.old'
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def read_meta(path=ARTIFACT_DIR):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+
+def current_version(artifact_path=ARTIFACT_DIR, csv_path=CSV_PATH):
+    """
+    Version of the data load_cases_cube would load, without loading it. Artifacts written in another format
+    than ARTIFACT_FORMAT are not loaded, the data is read from the CSV instead.
+    """
+    if os.path.exists(artifact_path):
+        meta = read_meta(artifact_path)
+        if meta.get('format') == ARTIFACT_FORMAT:
+            return meta['version']
+    return 'csv-{:.0f}'.format(os.path.getmtime(csv_path))
+
+
+def load_consistent(load, artifact_path=ARTIFACT_DIR, csv_path=CSV_PATH, attempts=3):
+    """
+    Call load with the version about to be loaded, and return its result with that version. The version
+    starts with csv- when the data must be read from the CSV, see current_version.
+
+    The version is read before and after loading, and the load is retried if a new artifact was swapped in
+    meanwhile, so the result always matches the version returned.
+    """
+    for attempt in range(attempts):
+        version = current_version(artifact_path, csv_path)
+        try:
+            result = load(version)
+        except (OSError, ValueError):
+            if attempt == attempts - 1:
+                raise
+            continue
+
+        if current_version(artifact_path, csv_path) == version:
+            return result, version
+
+    raise RuntimeError('The data in {} kept changing while loading it'.format(artifact_path))
+
+
+def read_csv(csv_path=CSV_PATH):
+    cases_data = pd.read_csv(csv_path, parse_dates=['date'])
+    cases_data['city'] = clean_city_names(cases_data['city'])
+    return cases_data
+
+
+def load_cases_cube(artifact_path=ARTIFACT_DIR, csv_path=CSV_PATH, attempts=3):
+    """
+    Load the cube of the cases/deaths data and its version. The cube saved in the artifact is memory-mapped,
+    so all workers share one copy of the data. It is only built from the CSV when there is no artifact, or
+    when the artifact was written in another format.
+    """
+    def load(version):
+        if not version.startswith('csv-') and cube.exists(artifact_path):
+            return cube.load(artifact_path)
+        return cube.from_data(read_csv(csv_path))
+
+    return load_consistent(load, artifact_path, csv_path, attempts)
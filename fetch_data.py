@@ -1,137 +1,290 @@
+import argparse
+import os
+
 import pandas as pd
 import numpy as np
-from scipy import signal
 
+import dataset
+import ingest
+import memory_profile
+import reshape
+
+
+CASES_URL = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_US.csv'
+DEATHS_URL = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_US.csv'
+OUTPUT_CSV = 'data/cases_and_deaths.csv'
+FIPS_TO_CITY = 'data/fips_to_city.csv'
+FIRST_DATE = '2020-03-01'
+
+# Fail the run when a stage peaks over this many megabytes of resident memory, unset for no limit
+MEMORY_BUDGET_MB = os.environ.get('FETCH_MEMORY_BUDGET_MB')
+
+# Columns of the JHU files which are not dates
+ID_COLUMNS = ['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Admin2', 'Province_State', 'Country_Region', 'Lat', 'Long_', 'Combined_Key', 'Population']
+
+# Keys which identify one series in the output
+SERIES_KEYS = ['city', 'state_abbreviation', 'county', 'fips']
 
-def custom_rolling_mean(group, cols_to_smooth):
+# Only the cumulative counts are stored. Daily counts, counts per 100,000 people and smoothed series
+# are derived by the app for the series it plots, see cube.Cube.derived
+OUTPUT_COLUMNS = ['date', 'state', 'state_abbreviation', 'city', 'county', 'fips', 'population', 'cases', 'deaths']
+
+US_STATE_ABBREV = {'Alabama': 'AL', 'Alaska': 'AK', 'Arizona': 'AZ', 'Arkansas': 'AR',
+               'California': 'CA', 'Colorado': 'CO', 'Connecticut': 'CT', 'Delaware': 'DE',
+               'District of Columbia': 'DC', 'Florida': 'FL', 'Georgia': 'GA', 'Hawaii': 'HI',
+               'Idaho': 'ID', 'Illinois': 'IL', 'Indiana': 'IN', 'Iowa': 'IA', 'Kansas': 'KS', 'Kentucky':
+               'KY', 'Louisiana': 'LA', 'Maine': 'ME', 'Maryland': 'MD', 'Massachusetts': 'MA', 'Michigan':
+               'MI', 'Minnesota': 'MN', 'Mississippi': 'MS', 'Missouri': 'MO', 'Montana': 'MT', 'Nebraska':
+               'NE', 'Nevada': 'NV', 'New Hampshire': 'NH', 'New Jersey': 'NJ', 'New Mexico': 'NM',
+               'New York': 'NY', 'North Carolina': 'NC', 'North Dakota': 'ND',
+               'Ohio': 'OH', 'Oklahoma': 'OK', 'Oregon': 'OR', 'Pennsylvania': 'PA',
+               'Rhode Island': 'RI', 'South Carolina': 'SC', 'South Dakota': 'SD', 'Tennessee': 'TN',
+               'Texas': 'TX', 'Utah': 'UT', 'Vermont': 'VT', 'Virginia': 'VA',
+               'Washington': 'WA', 'West Virginia': 'WV', 'Wisconsin': 'WI', 'Wyoming': 'WY'
+               }
+
+
+class IncrementalRefreshError(Exception):
     """
-    A custom rolling smoother because the builtin method only seems to support boxcar windows
-    Using a local linear savgol filter
+    The previous output can't be extended with the new data, a full rebuild is needed
     """
-    # We are using a local linear smoother, 13 day window.
-    results = {'date':group['date'].values}
 
-    for col in cols_to_smooth:
-        new_name = col+'_smooth'
-        smoothed = signal.savgol_filter(group[col], 13, 1)
-        results[new_name] = smoothed
 
-    return pd.DataFrame(results)
+def read_sources(cases_source=CASES_URL, deaths_source=DEATHS_URL, since=None):
+    """
+    Read the JHU confirmed cases and deaths time series, fetched and parsed concurrently.
+    Sources are URLs or local paths, see ingest.read_sources.
+    If since is given, only the date columns from that date on are parsed.
+    """
+    cases, deaths = ingest.read_sources([cases_source, deaths_source], since=since)
+    return cases, deaths
 
 
-if __name__ == '__main__':
+def align_sources(cases, deaths, since=FIRST_DATE):
+    """
+    Line up the counties of the wide JHU files, keeping the states and dates from since on we show.
+    Returns a reshape.WideTable of the cumulative cases and deaths of each county.
+    """
+    cases = cases[cases['Province_State'].isin(US_STATE_ABBREV)]
+    deaths = deaths[(deaths['Province_State'].isin(US_STATE_ABBREV)) &
+                    (deaths['Population'] > 0)]
 
-    fips_to_city = pd.read_csv('data/fips_to_city.csv')\
-                     .rename(columns={'cbsacode':'dma', 'cbsatitle':'dma_name', 'countycountyequivalent':'county'})
-    fips_to_city['fips'] = fips_to_city['fipsstatecode']*1000 + fips_to_city['fipscountycode']
-    our_counties = fips_to_city[['dma', 'dma_name', 'fips', 'county']]
-
-    # Get the cases and deaths for all states
-    us_state_abbrev = {'Alabama': 'AL', 'Alaska': 'AK', 'Arizona': 'AZ', 'Arkansas': 'AR',
-                   'California': 'CA', 'Colorado': 'CO', 'Connecticut': 'CT', 'Delaware': 'DE',
-                   'District of Columbia': 'DC', 'Florida': 'FL', 'Georgia': 'GA', 'Hawaii': 'HI',
-                   'Idaho': 'ID', 'Illinois': 'IL', 'Indiana': 'IN', 'Iowa': 'IA', 'Kansas': 'KS', 'Kentucky':
-                   'KY', 'Louisiana': 'LA', 'Maine': 'ME', 'Maryland': 'MD', 'Massachusetts': 'MA', 'Michigan':
-                   'MI', 'Minnesota': 'MN', 'Mississippi': 'MS', 'Missouri': 'MO', 'Montana': 'MT', 'Nebraska':
-                   'NE', 'Nevada': 'NV', 'New Hampshire': 'NH', 'New Jersey': 'NJ', 'New Mexico': 'NM',
-                   'New York': 'NY', 'North Carolina': 'NC', 'North Dakota': 'ND',
-                   'Ohio': 'OH', 'Oklahoma': 'OK', 'Oregon': 'OR', 'Pennsylvania': 'PA',
-                   'Rhode Island': 'RI', 'South Carolina': 'SC', 'South Dakota': 'SD', 'Tennessee': 'TN',
-                   'Texas': 'TX', 'Utah': 'UT', 'Vermont': 'VT', 'Virginia': 'VA',
-                   'Washington': 'WA', 'West Virginia': 'WV', 'Wisconsin': 'WI', 'Wyoming': 'WY'
-                   }
-
-    # Retrieve all cases data
-    cases = pd.read_csv('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_US.csv')
-    dates = list(cases.columns.difference(['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Admin2', 'Province_State', 'Country_Region', 'Lat', 'Long_', 'Combined_Key']))
-    cases['state_abbreviation'] = [us_state_abbrev[i] if i in us_state_abbrev else '' for i in cases['Province_State']]
-
-    # Melt into long format
-    cases_melt = pd.melt(cases, id_vars=['FIPS', 'state_abbreviation', 'Admin2', 'Province_State'], value_vars=dates).rename(columns={'value':'cases', 'FIPS':'fips', 'Province_State':'state', 'Admin2':'county'})
-    cases_melt['date'] = pd.to_datetime(cases_melt['variable'])
-    cases_melt = cases_melt.drop('variable', axis=1)
-
-    # Retrieve all deaths data
-    deaths = pd.read_csv('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_US.csv')
-    dates = list(deaths.columns.difference(['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Admin2', 'Province_State', 'Country_Region', 'Lat', 'Long_', 'Combined_Key', 'Population']))
-    deaths['state_abbreviation'] = [us_state_abbrev[i] if i in us_state_abbrev else '' for i in deaths['Province_State']]
-
-    # Melt into long format
-    deaths_melt = pd.melt(deaths, id_vars=['FIPS', 'state_abbreviation', 'Admin2', 'Province_State', 'Population'], value_vars=dates).rename(columns={'value':'deaths', 'FIPS':'fips', 'Province_State':'state', 'Admin2':'county', 'Population':'population'})
-    deaths_melt['date'] = pd.to_datetime(deaths_melt['variable'])
-    deaths_melt = deaths_melt.drop('variable', axis=1)
-
-    # Filter the data
-    cases_melt = cases_melt[(cases_melt.state.isin(us_state_abbrev)) &
-                            (cases_melt.date >= '2020-03-01')]
-
-    deaths_melt = deaths_melt[(deaths_melt.state.isin(us_state_abbrev)) &
-                              (deaths_melt.population > 0) &
-                              (deaths_melt.date >= '2020-03-01')]
-
-    # Merge into one dataframe
-    cases_and_deaths = cases_melt.merge(deaths_melt, on=['date', 'fips', 'state', 'state_abbreviation', 'county', 'state']).sort_values(by=['date', 'state_abbreviation', 'county'])
-
-    # Transform cumulative counts to daily new counts
-    cases_and_deaths['new_cases'] = cases_and_deaths.groupby(['fips', 'state_abbreviation', 'county', 'state'])['cases'].diff().fillna(0)
-    cases_and_deaths['new_deaths'] = cases_and_deaths.groupby(['fips', 'state_abbreviation', 'county', 'state'])['deaths'].diff().fillna(0)
-
-    # Group the data by state
-    cases_and_deaths_state = cases_and_deaths.groupby(['date', 'state', 'state_abbreviation'])[['population', 'cases', 'deaths', 'new_cases', 'new_deaths']].sum().reset_index()
-    cases_and_deaths_state = cases_and_deaths_state.assign(**{'fips': np.nan, 'county': np.nan, 'city': np.nan})
-    for col in ['new_cases', 'new_deaths', 'cases', 'deaths']:
-        cases_and_deaths_state[col+'_norm'] = cases_and_deaths_state[col]/cases_and_deaths_state['population'] * 100000
-
-    # Link counties to metro areas
-    fips_to_city = pd.read_csv('data/fips_to_city.csv')\
+    # Both files list the counties in the same order, but pair them on their keys rather than rely on it
+    key_columns = ['FIPS', 'Province_State', 'Admin2']
+    rows = cases[key_columns].assign(cases_row=np.arange(len(cases)))\
+                .merge(deaths[key_columns + ['Population']].assign(deaths_row=np.arange(len(deaths))), on=key_columns)
+
+    keys = rows[key_columns + ['Population']].rename(columns={'FIPS':'fips', 'Province_State':'state', 'Admin2':'county', 'Population':'population'})
+    keys['state_abbreviation'] = keys['state'].map(US_STATE_ABBREV)
+
+    # Dates present in both files
+    cases_dates = {ingest.parse_source_date(col): col for col in cases.columns.difference(ID_COLUMNS)}
+    deaths_dates = {ingest.parse_source_date(col): col for col in deaths.columns.difference(ID_COLUMNS)}
+    dates = sorted(date for date in cases_dates if date in deaths_dates and date >= pd.Timestamp(since))
+
+    counts = {
+        'cases': cases[[cases_dates[date] for date in dates]].to_numpy(dtype=np.int64)[rows['cases_row'].to_numpy()],
+        'deaths': deaths[[deaths_dates[date] for date in dates]].to_numpy(dtype=np.int64)[rows['deaths_row'].to_numpy()],
+    }
+    return reshape.WideTable(keys, dates, counts)
+
+
+def rollup_states(counties):
+    """
+    Group the data by state
+    """
+    states = counties.aggregate(['state', 'state_abbreviation'])
+    states.keys = states.keys.assign(**{'fips': np.nan, 'county': np.nan, 'city': np.nan})
+    return states
+
+
+def read_fips_to_city(fips_to_city_path=FIPS_TO_CITY):
+    """
+    The metro area and county name of every county which is part of a metro area
+    """
+    fips_to_city = pd.read_csv(fips_to_city_path)\
                          .rename(columns={'cbsatitle':'city', 'countycountyequivalent':'county'})
     fips_to_city['fips'] = fips_to_city['fipsstatecode']*1000 + fips_to_city['fipscountycode']
-    our_counties = fips_to_city[['city', 'fips', 'county']]
-
-    # Get the k largest metros by state
-    k = 4
-    populations = deaths_melt[['fips','state_abbreviation','population']].drop_duplicates()
-    county_pops = populations.merge(our_counties, on='fips')
-    metro_pops = county_pops.groupby(['city', 'state_abbreviation'])['population'].sum().to_frame().reset_index()
-    top_pops = metro_pops.groupby('state_abbreviation')['population'].nlargest(k).reset_index().drop('level_1', axis=1)
-    top_metros = metro_pops.merge(top_pops)[['city', 'state_abbreviation']]
-
-    # filter our_counties to just these metros
-    our_counties = our_counties.merge(top_metros)
-
-    # Group the data by metro area counties
-    cases_and_deaths_county = cases_and_deaths.drop('county', axis=1).merge(our_counties, on=['fips', 'state_abbreviation'])
-    for col in ['new_cases', 'new_deaths', 'cases', 'deaths']:
-        cases_and_deaths_county[col+'_norm'] = cases_and_deaths_county[col]/cases_and_deaths_county['population'] * 100000
-
-    # Cases/deaths by state/metro for our metros
-    cases_and_deaths_city = cases_and_deaths_county.groupby(['date', 'state', 'state_abbreviation', 'city'])[['population', 'cases', 'deaths', 'new_cases', 'new_deaths']].sum().reset_index()
-    cases_and_deaths_city = cases_and_deaths_city.assign(**{'fips': np.nan, 'county': np.nan})
-    for col in ['new_cases', 'new_deaths', 'cases', 'deaths']:
-        cases_and_deaths_city[col+'_norm'] = cases_and_deaths_city[col]/cases_and_deaths_city['population'] * 100000
-
-    # Concatenate all the data into one df
-    all_cases_and_deaths = pd.concat([
-        cases_and_deaths_state[['date', 'state', 'state_abbreviation', 'city', 'county', 'fips', 'population', 'new_cases', 'cases', 'new_deaths', 'deaths', 'new_cases_norm', 'cases_norm', 'new_deaths_norm', 'deaths_norm']],
-        cases_and_deaths_county[['date', 'state', 'state_abbreviation', 'city', 'county', 'fips', 'population', 'new_cases', 'cases', 'new_deaths', 'deaths', 'new_cases_norm', 'cases_norm', 'new_deaths_norm', 'deaths_norm']],
-        cases_and_deaths_city[['date', 'state', 'state_abbreviation', 'city', 'county', 'fips', 'population', 'new_cases', 'cases', 'new_deaths', 'deaths', 'new_cases_norm', 'cases_norm', 'new_deaths_norm', 'deaths_norm']]
-    ])
-
-    # Smooth the cases and deaths data
-    sorted_cases_and_deaths = all_cases_and_deaths\
-                                    .sort_values(by=['city', 'state_abbreviation', 'county', 'fips', 'date'])\
-                                    .fillna({'city': -1, 'county':-1, 'fips':-1}) # Fill nan so we can group on them
-
-    cols_to_smooth = ['cases', 'cases_norm',  'new_cases', 'new_cases_norm', 'deaths',
-                      'deaths_norm', 'new_deaths',  'new_deaths_norm']
-
-    smoothed = sorted_cases_and_deaths\
-        .groupby(['city', 'state_abbreviation', 'county', 'fips'], sort=False)\
-        .apply(lambda x: custom_rolling_mean(x, cols_to_smooth))\
-        .reset_index().drop('level_4', axis=1)
-
-    cases_and_deaths_smooth = sorted_cases_and_deaths.merge(smoothed, on=['city', 'state_abbreviation', 'county', 'fips', 'date'])
-    cases_and_deaths_smooth = cases_and_deaths_smooth.replace({'city': -1, 'county':-1, 'fips':-1}, np.nan) # Undo the fillnan
-
-    # Output data
-    cases_and_deaths_smooth.to_csv('data/cases_and_deaths.csv', index=False)
+    return fips_to_city[['city', 'fips', 'county']]
+
+
+def rollup_counties(counties, our_counties):
+    """
+    Keep the counties of our metro areas
+    """
+    keys = counties.keys.drop('county', axis=1).reset_index().merge(our_counties, on='fips')
+    return counties.take(keys.pop('index'), keys)
+
+
+def rollup_metros(metro_counties):
+    """
+    Cases/deaths by state/metro. Metros spanning several states are split into one part per state.
+    """
+    metros = metro_counties.aggregate(['state', 'state_abbreviation', 'city'])
+    metros.keys = metros.keys.assign(**{'fips': np.nan, 'county': np.nan})
+    return metros
+
+
+def rank_metros(metro_keys):
+    """
+    Rank of each metro by population within its state, 1 for the largest
+    """
+    return metro_keys.groupby('state_abbreviation')['population'].rank(method='first', ascending=False).to_numpy()
+
+
+def top_metros(metros, metro_counties, k):
+    """
+    Keep the k largest metros of each state and their counties
+    """
+    metros = metros.take(np.flatnonzero(rank_metros(metros.keys) <= k))
+    keys = metro_counties.keys.reset_index().merge(metros.keys[['city', 'state_abbreviation']])
+    return metros, metro_counties.take(keys.pop('index'), keys)
+
+
+def rollup(counties, k=None, fips_to_city_path=FIPS_TO_CITY, profiler=memory_profile.NullProfiler()):
+    """
+    Aggregate the county level data to states and to metro areas, and keep the counties of the metros.
+    Every metro is kept unless k is given, in which case only the k largest metros of each state are,
+    so the app can choose how many metros to show. Returns all three levels in one long dataframe,
+    which is only built here, with categorical string columns.
+    """
+    with profiler.stage('rollup_states'):
+        states = profiler.output(rollup_states(counties))
+    with profiler.stage('read_fips_to_city'):
+        our_counties = profiler.output(read_fips_to_city(fips_to_city_path))
+    with profiler.stage('rollup_counties'):
+        metro_counties = profiler.output(rollup_counties(counties, our_counties))
+    with profiler.stage('rollup_metros'):
+        metros = profiler.output(rollup_metros(metro_counties))
+    if k is not None:
+        with profiler.stage('top_metros'):
+            metros, metro_counties = profiler.output(top_metros(metros, metro_counties, k))
+
+    with profiler.stage('concat'):
+        all_levels = profiler.output(reshape.concat([states, metro_counties, metros]))
+    with profiler.stage('to_long'):
+        return profiler.output(all_levels.to_long(OUTPUT_COLUMNS, categorical_columns=dataset.STRING_COLUMNS))
+
+
+def sort_series(all_cases_and_deaths):
+    """
+    Order the rows by series and then date
+    """
+    return all_cases_and_deaths.sort_values(by=SERIES_KEYS + ['date']).reset_index(drop=True)
+
+
+def full_refresh(cases_source=CASES_URL, deaths_source=DEATHS_URL, k=None, profiler=memory_profile.NullProfiler()):
+    """
+    Rebuild the whole dataset from the full history, each stage measured by profiler
+    """
+    with profiler.stage('read'):
+        cases, deaths = profiler.output(read_sources(cases_source, deaths_source))
+    with profiler.stage('align'):
+        counties = profiler.output(align_sources(cases, deaths))
+
+    all_cases_and_deaths = rollup(counties, k, profiler=profiler)
+    with profiler.stage('sort'):
+        return profiler.output(sort_series(all_cases_and_deaths))
+
+
+def incremental_refresh(previous, cases_source=CASES_URL, deaths_source=DEATHS_URL, k=None, profiler=memory_profile.NullProfiler()):
+    """
+    Extend the previous output with the dates published since it was built.
+
+    Only the new date columns (plus the last known date, to check the sources still line up with the
+    previous output) are parsed, aligned and rolled up. Returns None when there is nothing new, and raises
+    IncrementalRefreshError when the new data doesn't line up with the previous output.
+    """
+    if not set(OUTPUT_COLUMNS) <= set(previous.columns):
+        raise IncrementalRefreshError('The previous output is missing columns')
+    previous = previous[OUTPUT_COLUMNS]
+    last_date = previous['date'].max()
+
+    with profiler.stage('read'):
+        cases, deaths = profiler.output(read_sources(cases_source, deaths_source, since=last_date))
+    source_dates = [ingest.parse_source_date(col) for col in cases.columns.difference(ID_COLUMNS)]
+    if last_date not in source_dates:
+        raise IncrementalRefreshError('The sources no longer contain {:%Y-%m-%d}'.format(last_date))
+
+    if not any(date > last_date for date in source_dates):
+        return None
+
+    with profiler.stage('align'):
+        counties = align_sources(cases, deaths, since=last_date)
+        counties = profiler.output(counties.select_dates(counties.dates > last_date))
+
+    new_cases_and_deaths = rollup(counties, k, profiler=profiler)
+
+    # Every series must continue one which is already in the output
+    previous_series = set(previous[SERIES_KEYS].astype(object).fillna(-1).itertuples(index=False, name=None))
+    new_series = set(new_cases_and_deaths[SERIES_KEYS].astype(object).fillna(-1).itertuples(index=False, name=None))
+    if previous_series != new_series:
+        raise IncrementalRefreshError('The series in the sources differ from the previous output')
+
+    with profiler.stage('merge'):
+        return profiler.output(sort_series(pd.concat([previous, new_cases_and_deaths])))
+
+
+def write_outputs(cases_and_deaths, csv_path=OUTPUT_CSV, artifact_path=dataset.ARTIFACT_DIR, profiler=memory_profile.NullProfiler()):
+    """
+    Output data
+    """
+    with profiler.stage('write_csv'):
+        cases_and_deaths.to_csv(csv_path, index=False)
+    with profiler.stage('write_artifact'):
+        dataset.write_artifact(cases_and_deaths, artifact_path)
+
+
+def refresh(args, profiler):
+    """
+    Build and write the outputs as the command line asks
+    """
+    cases_and_deaths = None
+    if args.incremental and os.path.exists(OUTPUT_CSV):
+        with profiler.stage('read_previous'):
+            previous = profiler.output(pd.read_csv(OUTPUT_CSV, parse_dates=['date']))
+        try:
+            cases_and_deaths = incremental_refresh(previous, args.cases_source, args.deaths_source, args.top_metros, profiler)
+            if cases_and_deaths is None:
+                print('No new dates since {:%Y-%m-%d}'.format(previous['date'].max()))
+                return
+        except IncrementalRefreshError as e:
+            print('Falling back to a full rebuild: {}'.format(e))
+
+    # The previous output is no longer needed, don't hold it during the rest of the run
+    previous = None
+
+    if cases_and_deaths is None:
+        cases_and_deaths = full_refresh(args.cases_source, args.deaths_source, args.top_metros, profiler)
+
+    write_outputs(cases_and_deaths, profiler=profiler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download the JHU time series and build data/cases_and_deaths.csv')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process the dates added since the previous output, falling back to a full rebuild when needed')
+    parser.add_argument('--cases-source', default=CASES_URL, help='URL or local path of the confirmed cases time series')
+    parser.add_argument('--deaths-source', default=DEATHS_URL, help='URL or local path of the deaths time series')
+    parser.add_argument('--top-metros', type=int, default=None,
+                        help='Only keep the given number of largest metros of each state, all of them by default')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='Report the duration, peak resident memory and output size of each stage')
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help='Also trace the allocations of each stage with tracemalloc and report the largest, much slower')
+    parser.add_argument('--memory-budget-mb', type=float, default=MEMORY_BUDGET_MB,
+                        help='Fail when a stage peaks over this many megabytes of resident memory')
+    args = parser.parse_args()
+
+    if args.profile_memory or args.trace_allocations or args.memory_budget_mb is not None:
+        budget_bytes = None if args.memory_budget_mb is None else args.memory_budget_mb*1024*1024
+        profiler = memory_profile.Profiler(trace=args.trace_allocations, budget_bytes=budget_bytes)
+    else:
+        profiler = memory_profile.NullProfiler()
+
+    try:
+        refresh(args, profiler)
+    except memory_profile.MemoryBudgetExceeded as e:
+        profiler.report()
+        raise SystemExit(str(e))
+    profiler.report()
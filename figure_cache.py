@@ -0,0 +1,146 @@
+import json
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import plotly
+
+
+def metros_key(state_or_metro, metros_per_state, counties):
+    """
+    The number of metros per state as far as it changes the plot: the lines of the state view are the
+    states themselves, so it only matters for metros, or for the counties of the largest metros of a state
+    """
+    if state_or_metro == 'state' and not counties:
+        return 0
+    return int(metros_per_state or 0)
+
+
+def make_key(states_list, state_or_metro, metros_per_state, first_date, last_date, cases_by_county, smooth_data, cases_or_deaths, cumulative_or_new, facet_page=0):
+    """
+    Normalize the inputs of produce_cases_plot so that equivalent requests share a key:
+    the state list is deduplicated and sorted, dates are reduced to the day and the county checklist to a boolean.
+    The facet page only matters with the county checklist checked, the number of metros per state only when
+    metros or counties are shown.
+    """
+    counties = len(cases_by_county) != 0
+    return (
+        tuple(sorted(set(states_list))),
+        state_or_metro,
+        metros_key(state_or_metro, metros_per_state, counties),
+        pd.to_datetime(first_date).strftime('%Y-%m-%d'),
+        pd.to_datetime(last_date).strftime('%Y-%m-%d'),
+        counties,
+        int(smooth_data or 0),
+        cases_or_deaths,
+        cumulative_or_new,
+        int(facet_page or 0) if counties else 0,
+    )
+
+
+def make_series_key(states_list, state_or_metro, metros_per_state, cases_by_county, facet_page=0):
+    """
+    Normalize the selection inputs of produce_plot_series, like make_key
+    """
+    counties = len(cases_by_county) != 0
+    return (
+        tuple(sorted(set(states_list))),
+        state_or_metro,
+        metros_key(state_or_metro, metros_per_state, counties),
+        counties,
+        int(facet_page or 0) if counties else 0,
+    )
+
+
+def figure_json(figure):
+    """
+    The figure serialized for the browser, as bytes
+    """
+    return json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder).encode()
+
+
+def figure_size(figure):
+    """
+    Size in bytes of the figure once serialized for the browser
+    """
+    return len(figure_json(figure))
+
+
+class FigureCache:
+    """
+    A thread-safe LRU cache of built figures, bounded by both number of entries and total serialized size.
+
+    Entries belong to one version of the dataset. Calling invalidate with a new version drops everything,
+    so figures built from old data are never served after a reload.
+    """
+    def __init__(self, max_entries=256, max_bytes=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()  # key -> (figure, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        The cached figure for key, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, figure, size=None, version=None):
+        """
+        Add a figure, evicting the least recently used ones until the cache is within its bounds.
+        A figure built from a version of the dataset other than the current one is not stored.
+        """
+        if size is None:
+            size = figure_size(figure)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (figure, size)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, version=None):
+        """
+        Drop every entry, e.g. because the dataset was reloaded
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.version = version
+
+    def stats(self):
+        with self._lock:
+            return {
+                'version': self.version,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,130 @@
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+
+# Downloaded sources and their ETag/Last-Modified, for conditional GETs on the next run
+CACHE_DIR = os.environ.get('SOURCE_CACHE_DIR', 'data/sources')
+
+RETRIES = 3
+BACKOFF_SECONDS = 2
+TIMEOUT_SECONDS = 60
+
+# Columns of the JHU files we use besides the dates
+USED_ID_COLUMNS = ['FIPS', 'Admin2', 'Province_State', 'Population']
+ID_DTYPES = {'FIPS': np.float64, 'Admin2': object, 'Province_State': object, 'Population': np.int64}
+
+# Cumulative counts fit in 32 bits
+COUNT_DTYPE = np.int32
+
+
+def parse_source_date(column):
+    """
+    JHU date columns look like 3/1/20
+    """
+    return pd.Timestamp(datetime.strptime(column, '%m/%d/%y'))
+
+
+def is_url(source):
+    return urlparse(str(source)).scheme in ('http', 'https')
+
+
+def local_path(source):
+    """
+    Path of a local source, which may be given as a file:// URL
+    """
+    parsed = urlparse(str(source))
+    if parsed.scheme == 'file':
+        return urllib.request.url2pathname(parsed.path)
+    return str(source)
+
+
+def download(url, cache_dir=CACHE_DIR, retries=RETRIES, timeout=TIMEOUT_SECONDS):
+    """
+    Download url into cache_dir and return the path of the file. The request is conditional on the
+    ETag/Last-Modified of the previous download, which is reused as is when the server answers 304.
+    Connection errors and 5xx responses are retried with exponential backoff.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, os.path.basename(urlparse(url).path) or 'source')
+    validators_path = path + '.json'
+
+    headers = {}
+    if os.path.exists(path) and os.path.exists(validators_path):
+        with open(validators_path) as f:
+            validators = json.load(f)
+        if validators.get('url') == url:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+                # Write next to the previous download and swap, so an interrupted download never replaces it
+                with open(path + '.tmp', 'wb') as f:
+                    while True:
+                        chunk = response.read(1024*1024)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                os.replace(path + '.tmp', path)
+
+                with open(validators_path, 'w') as f:
+                    json.dump({'url': url,
+                               'etag': response.headers.get('ETag'),
+                               'last_modified': response.headers.get('Last-Modified')}, f)
+                return path
+
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return path
+            if e.code < 500 or attempt == retries:
+                raise
+        except (urllib.error.URLError, OSError):
+            if attempt == retries:
+                raise
+
+        time.sleep(BACKOFF_SECONDS * 2**attempt)
+
+
+def parse_source(path, since=None):
+    """
+    Parse a JHU time series with only the columns we use and compact dtypes.
+    If since is given, only the date columns from that date on are kept.
+    """
+    columns = pd.read_csv(path, nrows=0).columns
+    date_columns = [col for col in columns if col not in USED_ID_COLUMNS and col[:1].isdigit()]
+    if since is not None:
+        date_columns = [col for col in date_columns if parse_source_date(col) >= since]
+
+    usecols = [col for col in USED_ID_COLUMNS if col in columns] + date_columns
+    dtype = dict(ID_DTYPES, **{col: COUNT_DTYPE for col in date_columns})
+
+    return pd.read_csv(path, usecols=usecols, dtype=dtype)
+
+
+def read_source(source, since=None, cache_dir=CACHE_DIR):
+    """
+    Fetch (when source is an http(s) URL) and parse one source. Local paths and file:// URLs are read in place.
+    """
+    path = download(source, cache_dir) if is_url(source) else local_path(source)
+    return parse_source(path, since)
+
+
+def read_sources(sources, since=None, cache_dir=CACHE_DIR):
+    """
+    Fetch and parse several sources concurrently. Returns the dataframes in the order of sources.
+    """
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = [executor.submit(read_source, source, since, cache_dir) for source in sources]
+        return [future.result() for future in futures]
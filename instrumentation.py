@@ -0,0 +1,226 @@
+import functools
+import os
+import threading
+import time
+from collections import deque
+
+import flask
+import numpy as np
+
+
+# Opt-in, everything below is a no-op unless this is set when the app starts
+ENABLED = os.environ.get('DASH_INSTRUMENTATION', '0') == '1'
+
+# Number of most recent values each histogram keeps
+WINDOW = int(os.environ.get('DASH_INSTRUMENTATION_WINDOW', 1000))
+
+# Upper bounds of the histogram buckets, in the unit of the metric (ms, bytes or counts)
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 100000, 1000000, 10000000]
+
+LOCAL_ADDRESSES = {'127.0.0.1', '::1', 'localhost'}
+
+
+class RollingHistogram:
+    """
+    The last WINDOW values of a metric, summarized into percentiles and bucket counts on demand
+    """
+    def __init__(self, size=WINDOW):
+        self.values = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        self.values.append(value)
+        self.count += 1
+
+    def summary(self):
+        values = np.array(self.values)
+        if len(values) == 0:
+            return {'count': self.count}
+
+        bucket_counts = np.histogram(values, bins=[-np.inf] + BUCKETS + [np.inf])[0]
+        return {
+            'count': self.count,
+            'window': len(values),
+            'mean': float(values.mean()),
+            'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'p99': float(np.percentile(values, 99)),
+            'max': float(values.max()),
+            'buckets': {('le_' + str(bound)): int(count) for bound, count in zip(BUCKETS + ['inf'], bucket_counts)},
+        }
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+_metrics_sources = {}
+
+
+def record(name, value):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(name, RollingHistogram())
+    histogram.add(value)
+
+
+def _metric_name(name):
+    """
+    Metrics recorded while serving a callback are prefixed with its name
+    """
+    if flask.has_request_context():
+        callback = flask.g.get('callback')
+        if callback is not None and callback != name:
+            return callback + '.' + name
+    return name
+
+
+class _Phase:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = (time.perf_counter() - self.start) * 1000
+        record(_metric_name(self.name) + '.ms', duration)
+
+        if flask.has_request_context():
+            flask.g.setdefault('server_timing', []).append((self.name, duration))
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_PHASE = _NullPhase()
+
+
+def phase(name):
+    """
+    Context manager timing one phase of a callback, e.g. with phase('filter'): ...
+    """
+    if not ENABLED:
+        return NULL_PHASE
+    return _Phase(name)
+
+
+def count_figure(result):
+    """
+    Number of traces and shapes of the first figure in a callback result
+    """
+    candidates = result if isinstance(result, (list, tuple)) else [result]
+    for candidate in candidates:
+        if hasattr(candidate, 'to_plotly_json'):
+            candidate = candidate.to_plotly_json()
+        if isinstance(candidate, dict) and 'data' in candidate:
+            data = candidate['data']
+            layout = candidate.get('layout') or {}
+            if hasattr(layout, 'to_plotly_json'):
+                layout = layout.to_plotly_json()
+            num_traces = len(data) if isinstance(data, (list, tuple)) else 1
+            return num_traces, len(layout.get('shapes') or [])
+    return None
+
+
+def timed(name):
+    """
+    Decorator timing a callback or a plot builder. The outermost timed function of a request names the
+    callback; the ones it calls are recorded as its phases. Returns the function untouched when disabled.
+    """
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            outermost = flask.has_request_context() and flask.g.get('callback') is None
+            if outermost:
+                flask.g.callback = name
+
+            with _Phase('total' if outermost else name):
+                result = function(*args, **kwargs)
+
+            counts = count_figure(result)
+            if counts is not None:
+                record(_metric_name(name if not outermost else 'figure') + '.traces', counts[0])
+                record(_metric_name(name if not outermost else 'figure') + '.shapes', counts[1])
+                if outermost:
+                    flask.g.figure_counts = counts
+
+            if outermost:
+                flask.g.callback_end = time.perf_counter()
+            return result
+
+        return wrapper
+    return decorator
+
+
+def add_metrics_source(name, function):
+    """
+    Include the dict returned by function under name in /metrics, e.g. cache statistics
+    """
+    _metrics_sources[name] = function
+
+
+def snapshot():
+    with _histograms_lock:
+        histograms = dict(_histograms)
+    metrics = {name: histogram.summary() for name, histogram in sorted(histograms.items())}
+    for name, function in _metrics_sources.items():
+        metrics[name] = function()
+    return metrics
+
+
+def _after_request(response):
+    """
+    Record the serialization time and response size of instrumented callbacks and send the timings
+    of the request as a Server-Timing header
+    """
+    callback = flask.g.get('callback')
+    if callback is None:
+        return response
+
+    timings = flask.g.get('server_timing', [])
+    callback_end = flask.g.get('callback_end')
+    if callback_end is not None:
+        serialize = (time.perf_counter() - callback_end) * 1000
+        record(callback + '.serialize.ms', serialize)
+        timings.append(('serialize', serialize))
+
+    header = ['{};dur={:.2f}'.format(name, duration) for name, duration in timings]
+
+    if not response.direct_passthrough:
+        size = len(response.get_data())
+        record(callback + '.bytes', size)
+        header.append('bytes;desc="{}"'.format(size))
+
+    counts = flask.g.get('figure_counts')
+    if counts is not None:
+        header.append('traces;desc="{}"'.format(counts[0]))
+        header.append('shapes;desc="{}"'.format(counts[1]))
+
+    response.headers['Server-Timing'] = ', '.join(header)
+    return response
+
+
+def _metrics():
+    if flask.request.remote_addr not in LOCAL_ADDRESSES:
+        flask.abort(404)
+    return flask.jsonify(snapshot())
+
+
+def instrument(server):
+    """
+    Send Server-Timing headers and serve the histograms on /metrics, to local clients only
+    """
+    if not ENABLED:
+        return
+
+    server.after_request(_after_request)
+    server.add_url_rule('/metrics', 'metrics', _metrics)
@@ -0,0 +1,194 @@
+import contextlib
+import linecache
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+# Allocations listed for each stage when tracing
+TOP_ALLOCATIONS = 5
+
+# Frames of the stack kept for each allocation, enough to get from pandas and numpy back to the pipeline
+TRACE_FRAMES = 25
+
+# Allocations are attributed to the innermost line of the pipeline's own code in their stack
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class MemoryBudgetExceeded(Exception):
+    """
+    The peak resident memory of a stage went over the budget
+    """
+
+
+def rss_bytes():
+    """
+    The current resident memory of the process, None where /proc isn't available
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1])*resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def reset_peak_rss():
+    """
+    Restart the peak resident memory from the current one. Returns whether the kernel allowed it (Linux only),
+    otherwise peak_rss_bytes keeps reporting the peak of the whole process.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes():
+    """
+    The peak resident memory since the last reset_peak_rss, or since the process started
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    # Kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak*1024
+
+
+def size_bytes(value):
+    """
+    Memory held by a stage output: dataframes with their strings, numpy arrays, reshape.WideTables and
+    tuples or lists of those. None for anything else.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, 'keys') and hasattr(value, 'counts'):
+        return size_bytes(value.keys) + sum(matrix.nbytes for matrix in value.counts.values())
+    if isinstance(value, (tuple, list)):
+        sizes = [size_bytes(i) for i in value]
+        return None if None in sizes else sum(sizes)
+    return None
+
+
+def top_allocations(snapshot, count):
+    """
+    The count lines of the pipeline which allocated the most memory still held in snapshot, as
+    (bytes, filename, line number), largest first
+    """
+    # Not the measurements themselves
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, __file__, all_frames=True)])
+
+    sizes = {}
+    for stat in snapshot.statistics('traceback'):
+        # Frames go from the oldest to the most recent
+        frames = [frame for frame in stat.traceback if frame.filename.startswith(SOURCE_DIR)] or list(stat.traceback)
+        line = (frames[-1].filename, frames[-1].lineno)
+        sizes[line] = sizes.get(line, 0) + stat.size
+    return sorted(((size,) + line for line, size in sizes.items()), reverse=True)[:count]
+
+
+def megabytes(num_bytes):
+    return '-' if num_bytes is None else '{:.1f}'.format(num_bytes/1024/1024)
+
+
+class Profiler:
+    """
+    Measures the named stages of a pipeline: duration, peak resident memory and, when trace is set, the peak
+    of the memory allocated during the stage and the lines of the pipeline whose allocations it still holds at
+    its end, with tracemalloc (numpy arrays included). Tracing slows the stages down several times, and
+    writing a CSV a hundred times; the resident memory is free to measure.
+
+    Stages must not nest. A stage whose peak resident memory goes over budget_bytes raises
+    MemoryBudgetExceeded once it ends, before the next stage starts.
+    """
+    def __init__(self, trace=False, budget_bytes=None, top_allocations=TOP_ALLOCATIONS):
+        self.trace = trace
+        self.budget_bytes = budget_bytes
+        self.top_allocations = top_allocations
+        self.stages = []
+        self._current = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stage = {'name': name, 'peak_is_stage': reset_peak_rss()}
+        self._current = stage
+        if self.trace:
+            # Only the allocations of this stage are traced
+            tracemalloc.start(TRACE_FRAMES)
+        start = time.perf_counter()
+
+        # Record the stage even if it fails, its memory is the likely culprit
+        try:
+            yield
+        finally:
+            stage['seconds'] = time.perf_counter() - start
+            stage['peak_rss'] = peak_rss_bytes()
+            stage['rss_after'] = rss_bytes()
+            if self.trace:
+                stage['traced_peak'] = tracemalloc.get_traced_memory()[1]
+                stage['top_allocations'] = top_allocations(tracemalloc.take_snapshot(), self.top_allocations)
+                tracemalloc.stop()
+            self.stages.append(stage)
+            self._current = None
+
+        if self.budget_bytes is not None and stage['peak_rss'] > self.budget_bytes:
+            raise MemoryBudgetExceeded('Stage {} peaked at {} MB of resident memory, over the budget of {} MB'.format(
+                name, megabytes(stage['peak_rss']), megabytes(self.budget_bytes)))
+
+    def output(self, value):
+        """
+        Record the size of value as the output of the running stage. Returns value.
+        """
+        if self._current is not None:
+            self._current['output_bytes'] = size_bytes(value)
+        return value
+
+    def report(self, out=sys.stdout):
+        columns = '{:<18} {:>8} {:>10} {:>10} {:>10} {:>10}'
+        print(columns.format('stage', 'seconds', 'peak MB', 'rss MB', 'traced MB', 'output MB'), file=out)
+        for stage in self.stages:
+            print(columns.format(stage['name'], '{:.2f}'.format(stage['seconds']),
+                                 megabytes(stage['peak_rss']) + ('' if stage['peak_is_stage'] else '*'),
+                                 megabytes(stage['rss_after']), megabytes(stage.get('traced_peak')),
+                                 megabytes(stage.get('output_bytes'))), file=out)
+        if not all(stage['peak_is_stage'] for stage in self.stages):
+            print('* peak of the process so far, the peak of a single stage is only measured on Linux', file=out)
+
+        for stage in self.stages:
+            if not stage.get('top_allocations'):
+                continue
+            print('\nLargest allocations of {} still held at its end:'.format(stage['name']), file=out)
+            for size, filename, lineno in stage['top_allocations']:
+                source = linecache.getline(filename, lineno).strip()
+                if filename.startswith(SOURCE_DIR):
+                    filename = os.path.relpath(filename, SOURCE_DIR)
+                print('  {:>8} MB  {}:{}  {}'.format(megabytes(size), filename, lineno, source), file=out)
+
+
+class NullProfiler:
+    """
+    Runs the stages without measuring them
+    """
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield
+
+    def output(self, value):
+        return value
+
+    def report(self, out=sys.stdout):
+        pass
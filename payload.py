@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+
+
+# Figures are compacted unless this is set to 0
+ENABLED = os.environ.get('COMPACT_FIGURES', '1') == '1'
+
+# Budget of points for a whole figure, shared between its traces
+MAX_POINTS = int(os.environ.get('COMPACT_FIGURES_MAX_POINTS', 20000))
+MIN_POINTS_PER_TRACE = 100
+
+# Values keep at least 2 decimals, which is what the hover labels show, and at least 4 significant
+# digits so that small values keep their shape
+DISPLAY_DECIMALS = 2
+SIGNIFICANT_DIGITS = 4
+
+
+# The browser draws a figure from integer series without dates, cheaper to send than the points of a compact
+# figure. Series of more values than this many per point the figure may keep are not sent, see series_fit
+SERIES_VALUES_PER_POINT = 4
+
+
+def points_per_trace(num_traces, max_points=None):
+    """
+    How many points each trace of a figure with num_traces traces may keep, out of max_points, MAX_POINTS by default
+    """
+    if max_points is None:
+        max_points = MAX_POINTS
+    return max(MIN_POINTS_PER_TRACE, max_points // max(num_traces, 1))
+
+
+def series_fit(num_values, num_traces):
+    """
+    Whether num_values values of series, which the browser draws num_traces traces from, make a smaller payload
+    than the compact figure of these traces. Everything fits when figures aren't compacted.
+    """
+    if not ENABLED:
+        return True
+    return num_values <= SERIES_VALUES_PER_POINT * points_per_trace(num_traces) * max(num_traces, 1)
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Returns the positions of the threshold points which
+    best preserve the visual shape of the series; the first and last points are always kept.
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+
+    # The points between the first and the last are split in threshold-2 buckets
+    edges = (np.arange(threshold - 1) * (n - 2) / (threshold - 2)).astype(int) + 1
+    edges[-1] = n - 1
+
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    previous = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i+1]
+
+        # Average of the next bucket, or the last point for the last bucket
+        if i + 2 < len(edges):
+            next_x = x[stop:edges[i+2]].mean()
+            next_y = y[stop:edges[i+2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+
+        # Keep the point making the largest triangle with the previously kept point and the next average
+        areas = np.abs((x[previous] - next_x) * (y[start:stop] - y[previous]) -
+                       (x[previous] - x[start:stop]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[i+1] = previous
+
+    return selected
+
+
+def round_for_display(values):
+    """
+    Round to the precision shown on the plot, see DISPLAY_DECIMALS and SIGNIFICANT_DIGITS
+    """
+    values = np.asarray(values, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitude = np.floor(np.log10(np.abs(values)))
+    magnitude[~np.isfinite(magnitude)] = 0
+    decimals = np.maximum(DISPLAY_DECIMALS, SIGNIFICANT_DIGITS - 1 - magnitude).astype(int)
+
+    scale = 10.0 ** decimals
+    return np.round(values * scale) / scale
+
+
+def compact_series(dates, values, max_points):
+    """
+    The x and y of a trace: dates as day strings instead of full timestamps, values rounded for display,
+    and at most max_points points
+    """
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    values = np.asarray(values, dtype=np.float64)
+
+    if len(values) > max_points:
+        keep = lttb(dates.astype(np.int64), values, max_points)
+        dates = dates[keep]
+        values = values[keep]
+
+    return np.datetime_as_string(dates, unit='D'), round_for_display(values)
@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+
+import dataset
+
+
+# Seconds between two checks for a new version of the dataset, 0 to never reload
+INTERVAL_SECONDS = int(os.environ.get('DATA_RELOAD_SECONDS', 60))
+
+
+class Reloader:
+    """
+    Watches the version of the dataset and, when a new one is published, builds a snapshot of it with load
+    in a background thread and hands it to swap. Requests keep being served from the old snapshot while the
+    new one loads.
+    """
+    def __init__(self, load, swap, version, interval=INTERVAL_SECONDS):
+        self.load = load
+        self.swap = swap
+        self.version = version
+        self.interval = interval
+
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        """
+        Reload if the dataset changed. Returns whether a new snapshot was swapped in.
+        """
+        try:
+            version = dataset.current_version()
+        except (OSError, ValueError, KeyError):
+            # Missing, or caught between the renames of write_artifact; try again on the next check
+            return False
+
+        if version == self.version:
+            return False
+
+        try:
+            new_snapshot = self.load()
+        except Exception as e:
+            print('Reloading the data failed, keeping version {}: {!r}'.format(self.version, e))
+            return False
+
+        self.swap(new_snapshot)
+        self.version = new_snapshot.version
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def ensure_started(self):
+        """
+        Start the watcher thread of this process if it isn't running. Threads don't survive a fork, so this
+        is called on every request and gunicorn workers start their own watcher on their first one.
+        """
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='data-reloader', daemon=True).start()
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class WideTable:
+    """
+    Time series stored wide: keys holds one row per series, and each count is a matrix with one row per
+    series and one column per date. Rollups and differences are array operations on the matrices; the long
+    one-row-per-series-and-date frame is only built by to_long.
+    """
+    def __init__(self, keys, dates, counts):
+        self.keys = keys.reset_index(drop=True)
+        self.dates = pd.DatetimeIndex(dates)
+        self.counts = counts
+
+    def take(self, rows, keys=None):
+        """
+        The series at the positions rows, with keys replacing their keys if given
+        """
+        rows = np.asarray(rows)
+        if keys is None:
+            keys = self.keys.iloc[rows]
+        return WideTable(keys, self.dates, {name: matrix[rows] for name, matrix in self.counts.items()})
+
+    def select_dates(self, mask):
+        return WideTable(self.keys, self.dates[mask], {name: matrix[:, mask] for name, matrix in self.counts.items()})
+
+    def aggregate(self, by, sum_columns=('population',)):
+        """
+        Sum the series within each group of the key columns by. The sum_columns of keys are summed too.
+        """
+        group_ids = self.keys.groupby(by, sort=True).ngroup().to_numpy()
+        keys = self.keys[by].assign(group=group_ids).drop_duplicates('group').sort_values('group')
+        keys = keys[keys['group'] >= 0].drop('group', axis=1)
+
+        return self.rollup(membership_matrix(group_ids, len(keys)), keys, sum_columns)
+
+    def rollup(self, membership, keys, sum_columns=('population',)):
+        """
+        Aggregate with a sparse groups x series membership matrix: every count of every date is summed
+        into its groups with one matrix product. keys describes the groups.
+        """
+        keys = keys.reset_index(drop=True)
+        for col in sum_columns:
+            keys[col] = membership @ self.keys[col].to_numpy()
+
+        counts = {name: membership @ matrix for name, matrix in self.counts.items()}
+        return WideTable(keys, self.dates, counts)
+
+    def to_long(self, columns, categorical_columns=()):
+        """
+        One row per series and date with the given columns, taken from keys, counts or 'date'.
+        categorical_columns are built as categoricals from the codes of each series.
+        """
+        num_series, num_dates = len(self.keys), len(self.dates)
+
+        data = {}
+        for col in columns:
+            if col == 'date':
+                data[col] = np.tile(self.dates.values, num_series)
+            elif col in self.counts:
+                data[col] = self.counts[col].ravel()
+            elif col in categorical_columns:
+                codes, categories = pd.factorize(self.keys[col], sort=True)
+                data[col] = pd.Categorical.from_codes(np.repeat(codes, num_dates), categories)
+            else:
+                data[col] = np.repeat(self.keys[col].to_numpy(), num_dates)
+
+        return pd.DataFrame(data, columns=columns)
+
+
+def membership_matrix(group_ids, num_groups):
+    """
+    Sparse num_groups x len(group_ids) matrix of 0/1 which sums member j into group group_ids[j].
+    Members with a negative group id belong to no group.
+    """
+    members = np.flatnonzero(group_ids >= 0)
+    ones = np.ones(len(members), dtype=np.int64)
+    return sparse.csr_matrix((ones, (group_ids[members], members)), shape=(num_groups, len(group_ids)))
+
+
+def concat(tables):
+    """
+    Stack the series of tables which share the same dates
+    """
+    keys = pd.concat([table.keys for table in tables], ignore_index=True, sort=False)
+    counts = {name: np.concatenate([table.counts[name] for table in tables]) for name in tables[0].counts}
+    return WideTable(keys, tables[0].dates, counts)
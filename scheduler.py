@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# Figure builds running at once in a process, other requests wait for a slot
+BUILD_SLOTS = int(os.environ.get('BUILD_SLOTS', 2))
+
+# Requests waiting for a slot in a process, more are turned away
+MAX_WAITING = int(os.environ.get('BUILD_MAX_WAITING', 16))
+
+# Seconds a request waits for a slot before it is turned away
+WAIT_SECONDS = float(os.environ.get('BUILD_WAIT_SECONDS', 10))
+
+# Sessions whose latest request is remembered
+MAX_SESSIONS = 10000
+
+# Seconds between two checks for a newer request while waiting for a slot
+POLL_SECONDS = 0.05
+
+
+class Superseded(Exception):
+    """
+    A newer request of the same session arrived while this one was waiting or building
+    """
+
+
+class Busy(Exception):
+    """
+    Too many requests are waiting for a build slot
+    """
+
+
+class BuildScheduler:
+    """
+    Runs figure builds in a bounded number of slots, numbering the requests of each session.
+
+    Only the latest request of a session is worth building, the browser only shows its response. Older ones
+    leave the queue as soon as a newer one arrives, and running builds stop at their next call to check.
+    So a session holds at most one slot for long, however fast its user clicks, and the other sessions get
+    the remaining slots. When max_waiting requests already wait, or a slot doesn't free up within
+    wait_seconds, the request is turned away instead of piling up.
+    """
+    def __init__(self, slots=BUILD_SLOTS, max_waiting=MAX_WAITING, wait_seconds=WAIT_SECONDS, max_sessions=MAX_SESSIONS):
+        self.max_waiting = max_waiting
+        self.wait_seconds = wait_seconds
+        self.max_sessions = max_sessions
+
+        self.completed = 0
+        self.superseded = 0
+        self.rejected = 0
+
+        self._slots = threading.BoundedSemaphore(slots)
+        self._latest = OrderedDict()  # session -> number of its latest request
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def is_latest(self, session, request):
+        with self._lock:
+            return self._latest.get(session) == request
+
+    def _acquire(self, session, request):
+        """
+        Wait for a slot, leaving early when superseded or when the wait is too long
+        """
+        with self._lock:
+            if self._waiting >= self.max_waiting:
+                self.rejected += 1
+                raise Busy()
+            self._waiting += 1
+
+        try:
+            deadline = time.monotonic() + self.wait_seconds
+            while True:
+                if not self.is_latest(session, request):
+                    raise Superseded()
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._lock:
+                        self.rejected += 1
+                    raise Busy()
+
+                if self._slots.acquire(timeout=min(remaining, POLL_SECONDS)):
+                    return
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def enter(self, session):
+        """
+        Number a new request of session, superseding the older ones. Returns its number, for run and check_latest.
+        """
+        with self._lock:
+            request = self._latest.pop(session, 0) + 1
+            self._latest[session] = request
+            while len(self._latest) > self.max_sessions:
+                self._latest.popitem(last=False)
+        return request
+
+    def run(self, session, build, request=None):
+        """
+        Run build() in a slot as the latest request of session and return its result. request is the number
+        given by enter, a new one by default.
+        Raises Superseded if a newer request of session arrives first, Busy if no slot is available.
+        """
+        if request is None:
+            request = self.enter(session)
+
+        try:
+            self._acquire(session, request)
+        except Superseded:
+            with self._lock:
+                self.superseded += 1
+            raise
+
+        self._local.job = (session, request)
+        try:
+            result = build()
+        except Superseded:
+            with self._lock:
+                self.superseded += 1
+            raise
+        finally:
+            self._local.job = None
+            self._slots.release()
+
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def check_latest(self, session, request):
+        """
+        Raises Superseded if a newer request of session arrived since request. The newer one may have been
+        answered already, from a cache, and the browser must not get an older response after it.
+        """
+        if not self.is_latest(session, request):
+            with self._lock:
+                self.superseded += 1
+            raise Superseded()
+
+    def check(self):
+        """
+        Called by builds between units of work. Raises Superseded if the build running in this thread
+        belongs to a request which is no longer the latest of its session. Does nothing outside of run.
+        """
+        job = getattr(self._local, 'job', None)
+        if job is not None and not self.is_latest(*job):
+            raise Superseded()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'waiting': self._waiting,
+                'sessions': len(self._latest),
+                'completed': self.completed,
+                'superseded': self.superseded,
+                'rejected': self.rejected,
+            }
@@ -0,0 +1,255 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import uuid
+
+import brotli
+import flask
+import numpy as np
+import pandas as pd
+
+import figure_cache
+import instrumentation
+import scheduler
+import shared_cache
+import smoothing
+
+
+# Responses kept in memory, in the encodings clients asked for, for the current version of the data
+CACHE_ENTRIES = int(os.environ.get('SERIES_API_CACHE_ENTRIES', 256))
+CACHE_MB = int(os.environ.get('SERIES_API_CACHE_MB', 64))
+
+# Queries of more series x dates than this are turned away, asking for fewer states, metros or dates.
+# Bodies stay small enough to build in a few seconds and to fit in the cache
+MAX_VALUES = int(os.environ.get('SERIES_API_MAX_VALUES', 1000000))
+
+# Compressed on the first request of each encoding. Higher settings cost several times the time for a few
+# percent smaller bodies
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+LEVELS = ['state', 'metro', 'county']
+METRICS = ['cases', 'deaths', 'new_cases', 'new_deaths']
+FORMATS = {'json': 'application/json', 'csv': 'text/csv'}
+
+# Values are per 100,000 people like on the plots, rounded to this many decimals
+DECIMALS = 4
+
+
+class SeriesAPI:
+    """
+    Read-only endpoints serving the series the dashboard plots, /api/series.json and /api/series.csv:
+
+        level             state, metro or county (the counties of the metros)
+        states            comma separated state abbreviations, all states by default
+        metros_per_state  only the metros (and their counties) among the largest of each state, 0 (default) for all
+        metric            cases, deaths, new_cases or new_deaths, per 100,000 people
+        smooth            smoothing window in days, 0 (default) for none
+        start, end        first and last dates, YYYY-MM-DD, the whole data by default
+
+    The county level needs states, and queries of more than MAX_VALUES values are answered with a 400.
+
+    Responses carry a strong ETag derived from the data version and the normalized query, so revalidation costs
+    no more than parsing the query. Bodies are served in the best encoding the client accepts, built once per
+    version and kept in an LRU in each encoding requested so far. A miss of the LRU of the process looks in
+    shared, the cache shared with the other workers, before building the body. Bodies are built in the slots
+    of build_scheduler, shared with the figures of the app, and requests finding no slot get a 503.
+    """
+    def __init__(self, get_snapshot, shared=shared_cache.NullCache(), build_scheduler=scheduler.BuildScheduler(),
+                 cache_entries=CACHE_ENTRIES, cache_bytes=CACHE_MB*1024*1024, max_values=MAX_VALUES):
+        self.get_snapshot = get_snapshot
+        self.shared = shared
+        self.build_scheduler = build_scheduler
+        self.max_values = max_values
+        self.cache = figure_cache.FigureCache(max_entries=cache_entries, max_bytes=cache_bytes)
+
+    def register(self, server):
+        server.add_url_rule('/api/series.<fmt>', 'series_api', self.serve)
+        instrumentation.add_metrics_source('series_api_cache', self.cache.stats)
+
+    def serve(self, fmt):
+        if fmt not in FORMATS:
+            flask.abort(404)
+
+        # Take the current snapshot once, so the ETag and the body are of the same version
+        data = self.get_snapshot()
+        query = parse_query(flask.request.args, data, self.max_values)
+        encoding = choose_encoding(flask.request)
+
+        # Strong ETags identify the bytes, so each encoding has its own
+        etag = make_etag(data.version, fmt, query) + ('-' + encoding if encoding != 'identity' else '')
+
+        if flask.request.if_none_match.contains(etag):
+            response = flask.Response(status=304)
+        else:
+            try:
+                body = self.encoded_body(data, fmt, query, encoding)
+            except scheduler.Busy:
+                flask.abort(flask.Response(json.dumps({'error': 'Too many series are being built, try again'}), status=503,
+                                           mimetype='application/json', headers={'Retry-After': '1'}))
+
+            response = flask.Response(body, mimetype=FORMATS[fmt])
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'public, no-cache'
+        return response
+
+    def encoded_body(self, data, fmt, query, encoding):
+        """
+        The body of a response in encoding, from the cache, compressed from the identity body or built on a miss
+        """
+        if self.cache.version != data.version:
+            self.cache.invalidate(data.version)
+
+        key = (fmt, query, encoding)
+        body = self.cache.get(key)
+        if body is None:
+            if encoding == 'identity':
+                # Requests of the API are never superseded, each is a session of its own
+                compute = lambda: self.build_scheduler.run(uuid.uuid4().hex, lambda: build_body(data, fmt, *query))
+            else:
+                compute = lambda: encode_body(self.encoded_body(data, fmt, query, 'identity'), encoding)
+            body = self.shared.get_or_compute(repr(('series', fmt, encoding) + query), data.version, compute, bytes, bytes)
+            self.cache.put(key, body, size=len(body), version=data.version)
+        return body
+
+
+def encode_body(body, encoding):
+    """
+    The body compressed with encoding, gzip or br
+    """
+    if encoding == 'gzip':
+        return gzip.compress(body, GZIP_LEVEL)
+    return brotli.compress(body, quality=BROTLI_QUALITY)
+
+
+def bad_request(message):
+    flask.abort(flask.Response(json.dumps({'error': message}), status=400, mimetype='application/json'))
+
+
+def parse_query(args, data, max_values=MAX_VALUES):
+    """
+    The normalized query of the request arguments, answering 400 to invalid ones and to those of more than
+    max_values values. Equivalent queries normalize the same, so they share an ETag and a cache entry.
+    """
+    level = args.get('level', 'state')
+    if level not in LEVELS:
+        bad_request('level must be one of ' + ', '.join(LEVELS))
+
+    metric = args.get('metric', 'cases')
+    if metric not in METRICS:
+        bad_request('metric must be one of ' + ', '.join(METRICS))
+
+    states = set(data.cube.states)
+    if level == 'county' and not args.get('states'):
+        bad_request('states is required at the county level')
+    if args.get('states'):
+        unknown = set(args['states'].split(',')) - states
+        if unknown:
+            bad_request('unknown states ' + ', '.join(sorted(unknown)))
+        states = set(args['states'].split(','))
+
+    try:
+        metros_per_state = int(args.get('metros_per_state', 0))
+        smooth = int(args.get('smooth', 0))
+        start = pd.to_datetime(args.get('start', data.min_date))
+        end = pd.to_datetime(args.get('end', data.max_date))
+    except ValueError as e:
+        bad_request(str(e))
+
+    if metros_per_state < 0:
+        bad_request('metros_per_state must be 0 or more')
+    if level == 'state':
+        metros_per_state = 0
+    if smooth not in [0] + smoothing.WINDOW_LENGTHS:
+        bad_request('smooth must be one of ' + ', '.join(str(i) for i in [0] + smoothing.WINDOW_LENGTHS))
+    if start > end:
+        bad_request('start must not be after end')
+
+    query = (level, tuple(sorted(states)), metros_per_state, metric, smooth,
+             start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+
+    num_series = len(select_series(data.cube, level, query[1], metros_per_state))
+    start, stop = data.cube.date_range(query[5], query[6])
+    if num_series*(stop - start) > max_values:
+        bad_request('{} series over {} dates are more than the {} values a response may hold, ask for fewer states, '
+                    'metros_per_state or dates'.format(num_series, stop - start, max_values))
+
+    return query
+
+
+def choose_encoding(request):
+    """
+    br or gzip if the client accepts them, in that order of preference, otherwise identity
+    """
+    for encoding in ['br', 'gzip']:
+        if request.accept_encodings[encoding] > 0:
+            return encoding
+    return 'identity'
+
+
+def make_etag(version, fmt, query):
+    return hashlib.sha1(json.dumps([version, fmt, query]).encode()).hexdigest()
+
+
+def select_series(cases_cube, level, states, metros_per_state):
+    """
+    The (state, metro, county, entity) of the series of the query
+    """
+    series = []
+    for state in states:
+        if level == 'state':
+            series.append((state, '', '', cases_cube.states[state]))
+            continue
+
+        for metro, entity in cases_cube.top_metros(cases_cube.metros.get(state, []), metros_per_state):
+            if level == 'metro':
+                series.append((state, metro, '', entity))
+            else:
+                series.extend((state, metro, county, county_entity)
+                              for county, county_entity in cases_cube.metro_counties.get((metro, state), []))
+    return series
+
+
+def build_body(data, fmt, level, states, metros_per_state, metric, smooth, start_date, end_date):
+    """
+    The response body of a query: in JSON the dates once and the values of each series aligned to them,
+    null where the series has no data; in CSV one row per series and date
+    """
+    cases_cube = data.cube
+    start, stop = cases_cube.date_range(start_date, end_date)
+    dates = np.datetime_as_string(cases_cube.dates[start:stop], unit='D').tolist()
+
+    rows = []
+    for state, metro, county, entity in select_series(cases_cube, level, states, metros_per_state):
+        line_dates, line_values = cases_cube.series(entity, metric, start, stop, smooth)
+        values = np.full(stop - start, np.nan)
+        offset = max(start, cases_cube.first[entity]) - start
+        values[offset:offset + len(line_values)] = np.round(line_values, DECIMALS)
+        rows.append((state, metro, county, float(cases_cube.population[entity]), values))
+
+    if fmt == 'csv':
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(['state_abbreviation', 'metro', 'county', 'population', 'date', metric])
+        for state, metro, county, population, values in rows:
+            for date, value in zip(dates, values):
+                if not np.isnan(value):
+                    writer.writerow([state, metro, county, '{:.0f}'.format(population), date, repr(float(value))])
+        return out.getvalue().encode()
+
+    return json.dumps({
+        'version': data.version,
+        'metric': metric,
+        'smooth': smooth,
+        'dates': dates,
+        'series': [{'state_abbreviation': state, 'metro': metro, 'county': county, 'population': population,
+                    'values': [None if np.isnan(value) else float(value) for value in values]}
+                   for state, metro, county, population, values in rows],
+    }, separators=(',', ':')).encode()
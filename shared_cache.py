@@ -0,0 +1,199 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+# sqlite (default) shares cached figures and series between the workers of a machine, none disables it
+BACKEND = os.environ.get('SHARED_CACHE', 'sqlite')
+PATH = os.environ.get('SHARED_CACHE_PATH', 'data/shared_cache.sqlite3')
+MAX_BYTES = int(os.environ.get('SHARED_CACHE_MB', 256))*1024*1024
+
+# Seconds a worker may hold the lock of a key while computing it, other workers wait for it meanwhile
+LOCK_SECONDS = 30
+
+# Seconds between two looks for the value of a key locked by another worker
+POLL_SECONDS = 0.05
+
+# Hits refresh the access time of an entry at most this often, to keep reads from writing every time
+TOUCH_SECONDS = 1
+
+
+class NullCache:
+    """
+    Computes every value, for SHARED_CACHE=none
+    """
+    def get_or_compute(self, key, version, compute, dumps, loads):
+        return compute()
+
+    def purge(self, version):
+        pass
+
+    def stats(self):
+        return {'backend': 'none'}
+
+
+class SQLiteCache:
+    """
+    A cache shared by the processes of one machine through a SQLite file. Entries belong to a version of the
+    dataset and are only served for that version. The total size is bounded, least recently used entries
+    are evicted first.
+
+    get_or_compute protects against stampedes: the first worker to miss a key takes a lock on it in the
+    database and computes the value, the others wait for the value to appear instead of computing it too.
+    Locks expire after lock_seconds, so a worker dying mid-computation doesn't block the key for long.
+    """
+    def __init__(self, path=PATH, max_bytes=MAX_BYTES, lock_seconds=LOCK_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock_seconds = lock_seconds
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+        self._owner = uuid.uuid4().hex
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, version TEXT, value BLOB, '
+                               'size INTEGER, accessed REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            connection.execute('CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+
+    def _connection(self):
+        """
+        The connection of this thread. Connections can't be shared between threads, nor survive a fork.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key, version):
+        """
+        The bytes stored for key and version, or None
+        """
+        connection = self._connection()
+        row = connection.execute('SELECT value, accessed FROM entries WHERE key = ? AND version = ?',
+                                 (key, version)).fetchone()
+        if row is None:
+            return None
+
+        now = time.time()
+        if row[1] < now - TOUCH_SECONDS:
+            connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+        return row[0]
+
+    def put(self, key, version, value):
+        """
+        Store value, bytes, then evict least recently used entries until the cache fits in max_bytes
+        """
+        if len(value) > self.max_bytes:
+            return
+
+        connection = self._connection()
+        connection.execute('INSERT OR REPLACE INTO entries (key, version, value, size, accessed) VALUES (?, ?, ?, ?, ?)',
+                           (key, version, sqlite3.Binary(value), len(value), time.time()))
+
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        while total > self.max_bytes:
+            oldest = connection.execute('SELECT key, size FROM entries ORDER BY accessed LIMIT 16').fetchall()
+            connection.executemany('DELETE FROM entries WHERE key = ?', [(row[0],) for row in oldest])
+            total -= sum(row[1] for row in oldest)
+
+    def _lock(self, key):
+        """
+        Take the lock of key unless another worker holds it. Returns whether it was taken.
+        """
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM locks WHERE key = ? AND expires < ?', (key, now))
+            taken = connection.execute('INSERT OR IGNORE INTO locks (key, owner, expires) VALUES (?, ?, ?)',
+                                       (key, self._owner, now + self.lock_seconds)).rowcount == 1
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return taken
+
+    def _unlock(self, key):
+        self._connection().execute('DELETE FROM locks WHERE key = ? AND owner = ?', (key, self._owner))
+
+    def get_or_compute(self, key, version, compute, dumps, loads):
+        """
+        The value of key for version: loaded with loads from the stored bytes, or computed with compute,
+        stored as dumps(value) and returned. Only one worker computes a missing key at a time.
+        """
+        deadline = time.time() + self.lock_seconds
+        waited = False
+        while True:
+            value = self.get(key, version)
+            if value is not None:
+                self.hits += 1
+                return loads(value)
+
+            if self._lock(key):
+                try:
+                    # Computed by the previous holder of the lock meanwhile?
+                    value = self.get(key, version)
+                    if value is not None:
+                        self.hits += 1
+                        return loads(value)
+
+                    self.misses += 1
+                    result = compute()
+                    self.put(key, version, dumps(result))
+                    return result
+                finally:
+                    self._unlock(key)
+
+            if not waited:
+                self.waits += 1
+                waited = True
+            if time.time() > deadline:
+                self.misses += 1
+                return compute()
+            time.sleep(POLL_SECONDS)
+
+    def purge(self, version):
+        """
+        Drop the entries of every other version of the dataset
+        """
+        self._connection().execute('DELETE FROM entries WHERE version != ?', (version,))
+
+    def stats(self):
+        entries, size = self._connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {
+            'backend': 'sqlite',
+            'entries': entries,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'waits': self.waits,
+        }
+
+
+def open_cache(backend=BACKEND, path=PATH):
+    """
+    The shared cache configured by SHARED_CACHE
+    """
+    if backend == 'sqlite':
+        try:
+            return SQLiteCache(path)
+        except (sqlite3.Error, OSError) as e:
+            print('Shared cache unavailable at {}, caching per process only: {!r}'.format(path, e))
+            return NullCache()
+    if backend == 'none':
+        return NullCache()
+    raise ValueError('Unknown SHARED_CACHE backend {}'.format(backend))
@@ -0,0 +1,35 @@
+import numpy as np
+
+
+# We are using a local linear smoother, 13 day window by default.
+WINDOW_LENGTH = 13
+POLYORDER = 1
+
+# Window lengths offered by the app, in days
+WINDOW_LENGTHS = [7, 13, 21]
+
+
+def fitted_window(length, window_length=WINDOW_LENGTH, polyorder=POLYORDER):
+    """
+    The window to use on a series of the given length. Series shorter than the window are smoothed
+    with the largest odd window that fits, and returned as is when no window can fit the polynomial.
+    """
+    if length >= window_length:
+        return window_length
+
+    window = length if length % 2 == 1 else length - 1
+    if window <= polyorder:
+        return None
+    return window
+
+
+def smooth_series(values, window_length=WINDOW_LENGTH, polyorder=POLYORDER):
+    """
+    Savgol smooth one series, which must not contain missing values
+    """
+    window = fitted_window(len(values), window_length, polyorder)
+    if window is None:
+        return np.asarray(values, dtype=np.float64)
+    # scipy.signal takes a while to import, only pay for it once something is smoothed
+    from scipy import signal
+    return signal.savgol_filter(values, window, polyorder)
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+import plotly.io as pio
+
+import dataset
+import weekends
+
+
+def make_base_map_figure(states):
+    """
+    The clickable map with nothing selected. Clicks only change the selection vector z of this figure.
+    Built as a dict with the default template applied, like go.Figure would, without go.Figure which imports
+    most of plotly.
+    """
+    return {
+         'data': [go.Choropleth({
+             'colorscale': [[0, '#009dd9'], [0.5, '#a5a5a4'], [1, '#ffcd00']],
+             'geo': 'geo',
+             'hovertemplate': '%{location}',
+             'locationmode': 'USA-states',
+             'locations': states['state_abbreviation'],
+             'name': '',
+             'showlegend': False,
+             'showscale': False,
+             'z': np.zeros(len(states), dtype=int)
+         }).to_plotly_json()],
+         'layout': dict(go.Layout(
+              height=450,
+              geo_scope='usa', # limit map scope to USA
+              margin=dict(
+                l=0,
+                r=0,
+                b=0,
+                t=0,
+                pad=0
+            ),
+            dragmode = False
+        ).to_plotly_json(), template=pio.templates[pio.templates.default].to_plotly_json())}
+
+
+class Snapshot:
+    """
+    Everything app.py derives from one version of the dataset. A reload builds a new snapshot and replaces
+    the current one with a single assignment; callbacks take the current snapshot once and use it throughout,
+    so a figure is never built from two versions.
+
+    Everything is derived from the cube, which is loaded prebuilt from the artifact, so creating a snapshot
+    doesn't touch the rows of the data.
+    """
+    def __init__(self, cases_cube, version):
+        self.version = version
+
+        # Dense entity x date x metric array the plots are sliced from
+        self.cube = cases_cube
+
+        # Get the dates which are weekends
+        self.weekend_shading = weekends.WeekendShading(cases_cube.dates)
+
+        # Get all the states present in the data for the map
+        states = pd.DataFrame({'state_abbreviation': sorted(cases_cube.states)})
+        states['has_counties'] = states['state_abbreviation'].isin(set(cases_cube.state_counties))
+        self.states = states
+        self.base_map_figure = make_base_map_figure(states)
+
+        # For the Date slider
+        self.dates = pd.Series(pd.DatetimeIndex(cases_cube.dates))
+        self.min_date = self.dates.iloc[0]
+        self.max_date = self.dates.iloc[-1]
+
+
+def load():
+    """
+    Snapshot of the current version of the data
+    """
+    return Snapshot(*dataset.load_cases_cube())
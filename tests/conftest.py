@@ -0,0 +1,33 @@
+import importlib
+import os
+
+import pytest
+
+import shared_cache
+from benchmarks import synthetic
+from benchmarks.run_benchmarks import benchmark_pipeline
+
+
+@pytest.fixture(scope='session')
+def dashboard(tmp_path_factory):
+    """
+    The app module serving small synthetic data, without the warm-up, the reloader nor the shared cache
+    """
+    work_dir = str(tmp_path_factory.mktemp('dashboard'))
+    data_dir = os.path.join(work_dir, 'data')
+    cases_path, deaths_path, fips_to_city_path = synthetic.generate(data_dir, num_counties=300, num_days=120)
+    benchmark_pipeline(cases_path, deaths_path, fips_to_city_path, data_dir, 1)
+
+    # app.py loads data/ relative to the working directory
+    repo_dir = os.getcwd()
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('WARM_UP_FIGURES', '0')
+        patch.setenv('SHARED_CACHE', 'none')
+        patch.setenv('DATA_RELOAD_SECONDS', '0')
+        patch.chdir(work_dir)
+        # Test modules may have imported shared_cache before SHARED_CACHE was set
+        importlib.reload(shared_cache)
+        try:
+            yield importlib.import_module('app')
+        finally:
+            os.chdir(repo_dir)
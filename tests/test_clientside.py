@@ -0,0 +1,233 @@
+import json
+import math
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+import figure_cache
+import payload
+
+
+NODE = shutil.which('node')
+pytestmark = pytest.mark.skipif(NODE is None, reason='runs assets/clientside.js with node')
+
+CLIENTSIDE_JS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'assets', 'clientside.js')
+
+# Calls the functions of clientside.js with the arguments read from stdin, like the Dash renderer does
+RUNNER = '''
+global.window = {dash_clientside: {no_update: 'NO_UPDATE'}};
+require(process.argv[1]);
+var calls = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+process.stdout.write(JSON.stringify(calls.map(function(call) {
+    return window.dash_clientside[call[0]][call[1]].apply(null, call[2]);
+})));
+'''
+
+
+def run_clientside(calls):
+    """
+    The results of the (namespace, function, arguments) calls of clientside.js, serialized like the server's figures
+    """
+    arguments = figure_cache.figure_json([[namespace, function, args] for namespace, function, args in calls])
+    output = subprocess.run([NODE, '-e', RUNNER, os.path.abspath(CLIENTSIDE_JS)], input=arguments,
+                            stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output)
+
+
+def as_json(figure):
+    return json.loads(figure_cache.figure_json(figure))
+
+
+def assert_same(server, browser, path='figure', rel_tol=1e-9, abs_tol=1e-9):
+    """
+    The figures are the same but for the rounding of the floats
+    """
+    if isinstance(server, dict):
+        assert isinstance(browser, dict), path
+        assert sorted(server) == sorted(browser), path
+        for key in server:
+            assert_same(server[key], browser[key], path + '.' + key, rel_tol, abs_tol)
+    elif isinstance(server, list):
+        assert isinstance(browser, list) and len(server) == len(browser), path
+        for i, (server_item, browser_item) in enumerate(zip(server, browser)):
+            assert_same(server_item, browser_item, '{}[{}]'.format(path, i), rel_tol, abs_tol)
+    elif isinstance(server, float) or isinstance(browser, float):
+        assert math.isclose(server, browser, rel_tol=rel_tol, abs_tol=abs_tol), path
+    else:
+        assert server == browser, path
+
+
+def as_drawn(figure):
+    """
+    The figure as it is drawn: dates as days, and the population of a line in its hover label, whether the
+    server repeats it on every point or the browser writes it once. Lines without points show no label.
+    """
+    for key, axis in figure['layout'].items():
+        if key.startswith('xaxis') and 'range' in axis:
+            axis['range'] = [date[:10] for date in axis['range']]
+    for trace in figure['data']:
+        population = trace.pop('customdata', None)
+        if population:
+            trace['hovertemplate'] = trace['hovertemplate'].replace('%{customdata:,}', '{:,.0f}'.format(population[0]))
+        if 'x' in trace:
+            trace['x'] = [date[:10] for date in trace['x']]
+            if not trace['x']:
+                trace['hovertemplate'] = trace['hovertemplate'].split('<br>Population')[0]
+    return figure
+
+
+def toggles(data):
+    """
+    Dates, smoothing, cases or deaths and cumulative or new of the comparisons
+    """
+    dates = [date.strftime('%Y-%m-%d') for date in data.cube.dates.astype('datetime64[D]').tolist()]
+    return [
+        (dates[0], dates[-1], 0, 'cases', 'new'),
+        (dates[0], dates[-1], 7, 'deaths', 'cumulative'),
+        (dates[10], dates[40], 5, 'cases', 'cumulative'),
+        (dates[-20] + 'T00:00:00', dates[-1] + 'T00:00:00', 15, 'deaths', 'new'),
+        # None of the dates of the data
+        ('1990-01-01', '1990-02-01', 0, 'cases', 'new'),
+    ]
+
+
+def compare_cases_plots(dashboard, rel_tol=1e-9, abs_tol=1e-9):
+    """
+    Compare plot.render with build_cases_plot for 8 selections with 5 settings of the controls each. Returns
+    the number of comparisons of figures drawn by the browser.
+    """
+    data = dashboard.data_snapshot
+    states = sorted(data.cube.states)
+    selections = [
+        (states[:2], 'state', 0, []),
+        (states, 'state', 0, []),
+        ([], 'state', 0, []),
+        (states[:1], 'state_metro', 0, []),
+        (states[1:3], 'state_metro', 2, []),
+        (states[:1], 'state', 0, [1]),
+        (states[:3], 'state_metro', 1, [1]),
+        ([], 'state', 0, [1]),
+    ]
+
+    calls = []
+    server = []
+    for states_list, state_or_metro, metros_per_state, cases_by_county in selections:
+        series = as_json(dashboard.build_plot_series(data, states_list, state_or_metro, metros_per_state, cases_by_county))
+        for controls in toggles(data):
+            figure = as_json(dashboard.build_cases_plot(data, states_list, state_or_metro, metros_per_state, controls[0], controls[1],
+                                                        cases_by_county, *controls[2:]))
+            # Selections too large for the browser show the figure the server sends for the current controls
+            requested = {'request': series['inputs'] + list(controls), 'figure': figure} if series.get('server') else None
+            calls.append(('plot', 'render', [series, requested] + list(controls)))
+            calls.append(('plot', 'request_cases_plot', [series] + list(controls)))
+            # The same figure without downsampling
+            calls.append(('plot', 'render', [dict(series, max_points=None), requested] + list(controls)))
+            server.append((figure, requested))
+
+    assert len(server) == 40
+    results = run_clientside(calls)
+    for i, ((figure, requested), browser_figure, request, full_figure) in enumerate(zip(server, results[::3], results[1::3], results[2::3])):
+        path = 'figure {}'.format(i)
+        if requested:
+            assert request == requested['request']
+            assert browser_figure == figure
+            continue
+
+        assert request == 'NO_UPDATE'
+        figure = as_drawn(figure)
+        for j, (server_trace, browser_trace, full_trace) in enumerate(zip(figure['data'], browser_figure['data'], full_figure['data'])):
+            if len(server_trace.get('x') or []) < len(full_trace.get('x') or []):
+                assert_same_downsampling(server_trace, browser_trace, full_trace, '{}.data[{}]'.format(path, j))
+        assert_same(figure, as_drawn(browser_figure), path, rel_tol, abs_tol)
+    return sum(requested is None for _, requested in server)
+
+
+def assert_same_downsampling(server_trace, browser_trace, full_trace, path):
+    """
+    The browser keeps the points payload.lttb keeps of its full line, as many as the server. The derived values
+    of the browser differ from the server's in their last bits, which can tip LTTB to the other of two nearly
+    equal triangles, so the dates may differ from the server's. The browser trace then takes the dates kept by
+    the server, for the comparison of the figures.
+    """
+    days = np.array(full_trace['x'], dtype='datetime64[D]').astype(np.int64)
+    values = np.array(full_trace['y'], dtype=np.float64)
+    keep = payload.lttb(days, values, len(server_trace['x']))
+    assert browser_trace['x'] == [full_trace['x'][i] for i in keep], path
+    assert browser_trace['y'] == [full_trace['y'][i] for i in keep], path
+
+    full = dict(zip(full_trace['x'], full_trace['y']))
+    browser_trace['x'] = server_trace['x']
+    browser_trace['y'] = [full[x] for x in server_trace['x']]
+
+
+def test_cases_plot_matches_build_cases_plot(dashboard, monkeypatch):
+    monkeypatch.setattr(payload, 'ENABLED', False)
+    assert compare_cases_plots(dashboard) == 40
+
+
+def test_cases_plot_matches_compact_build_cases_plot(dashboard, monkeypatch):
+    # Small enough budgets that lines are downsampled, and some selections are drawn by the server
+    monkeypatch.setattr(payload, 'MAX_POINTS', 200)
+    monkeypatch.setattr(payload, 'MIN_POINTS_PER_TRACE', 20)
+
+    # The server rounds the values it sends to 4 significant digits and at least 2 decimals
+    drawn_by_browser = compare_cases_plots(dashboard, rel_tol=5e-4, abs_tol=5e-3)
+    assert 0 < drawn_by_browser < 40
+
+
+def test_series_are_smaller_than_the_compact_figures(dashboard, monkeypatch):
+    data = dashboard.data_snapshot
+    states = sorted(data.cube.states)
+    first_date, last_date = data.min_date.strftime('%Y-%m-%d'), data.max_date.strftime('%Y-%m-%d')
+
+    for max_points, min_points in [(payload.MAX_POINTS, payload.MIN_POINTS_PER_TRACE), (200, 20)]:
+        monkeypatch.setattr(payload, 'MAX_POINTS', max_points)
+        monkeypatch.setattr(payload, 'MIN_POINTS_PER_TRACE', min_points)
+        for states_list in [states[:1], states[:5], states]:
+            for state_or_metro, metros_per_state, cases_by_county in [('state', 0, []), ('state_metro', 0, []), ('state_metro', 2, []),
+                                                                      ('state', 0, [1]), ('state_metro', 0, [1])]:
+                series = dashboard.build_plot_series(data, states_list, state_or_metro, metros_per_state, cases_by_county)
+                figure = dashboard.build_cases_plot(data, states_list, state_or_metro, metros_per_state, first_date, last_date,
+                                                    cases_by_county, 0, 'cases', 'new')
+                assert figure_cache.figure_size(series) <= figure_cache.figure_size(figure), (states_list, state_or_metro, metros_per_state, cases_by_county)
+
+    map_figure = dashboard.build_metric_map(data, first_date, last_date, 'new_cases', 'Daily New Cases', 0)
+    assert figure_cache.figure_size(dashboard.build_metric_map_series(data)) <= figure_cache.figure_size(map_figure)
+
+
+def test_metric_map_matches_build_metric_map(dashboard, monkeypatch):
+    monkeypatch.setattr(payload, 'ENABLED', False)
+    data = dashboard.data_snapshot
+    series = as_json(dashboard.build_metric_map_series(data))
+
+    calls = []
+    server = []
+    for first_date, last_date, smooth_data, cases_or_deaths, cumulative_or_new in toggles(data):
+        calls.append(('map', 'render_metric_map', [series, [1], first_date, last_date, smooth_data, cases_or_deaths, cumulative_or_new]))
+        col, y_title = dashboard.metric_column(cases_or_deaths, cumulative_or_new)
+        server.append(dashboard.build_metric_map(data, first_date[:10], last_date[:10], col, y_title, smooth_data))
+
+    for i, (server_figure, browser_figure) in enumerate(zip(server, run_clientside(calls))):
+        assert_same(as_json(server_figure), browser_figure, 'map {}'.format(i))
+
+
+def test_metric_map_series_only_requested_while_shown_and_stale(dashboard):
+    version = {'version': 'v2', 'max_date': '2020-05-01'}
+    results = run_clientside([
+        ('map', 'request_metric_map_series', [[], version, None]),
+        ('map', 'request_metric_map_series', [[1], version, None]),
+        ('map', 'request_metric_map_series', [[1], version, {'version': 'v1'}]),
+        ('map', 'request_metric_map_series', [[1], version, {'version': 'v2'}]),
+        ('map', 'render_metric_map', [{'version': 'v2'}, [], '2020-01-01', '2020-05-01', 0, 'cases', 'new']),
+    ])
+
+    assert results == [
+        ['NO_UPDATE', {'display': 'none'}],
+        ['v2', {'display': 'block'}],
+        ['v2', {'display': 'block'}],
+        ['NO_UPDATE', {'display': 'block'}],
+        'NO_UPDATE',
+    ]
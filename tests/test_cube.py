@@ -0,0 +1,185 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from scipy import signal
+
+import cube
+import dataset
+import smoothing
+
+
+def long_data():
+    """
+    Two dates of a state, a metro of it and a county of the metro, with the string columns as objects
+    """
+    return pd.DataFrame({
+        'date': pd.to_datetime(['2020-03-01', '2020-03-02'] * 3),
+        'state_abbreviation': ['IL'] * 6,
+        'city': [np.nan, np.nan, 'Chicago, IL-IN', 'Chicago, IL-IN', 'Chicago, IL-IN', 'Chicago, IL-IN'],
+        'county': [np.nan, np.nan, np.nan, np.nan, 'Cook', 'Cook'],
+        'population': [100.0, 100.0, 50.0, 50.0, 40.0, 40.0],
+        'cases': [1.0, 2.0, 1.0, 2.0, 1.0, 1.0],
+        'deaths': [0.0, 1.0, 0.0, 0.0, 0.0, 0.0],
+    })
+
+
+def test_clean_city_names_of_categoricals_matches_strings():
+    city = long_data()['city']
+
+    cleaned = dataset.clean_city_names(city.astype('category'))
+
+    assert cleaned.astype(object).tolist() == dataset.clean_city_names(city).tolist()
+
+
+def test_artifact_of_another_format_falls_back_to_the_csv(tmp_path):
+    data = long_data()
+    artifact_path = str(tmp_path / 'cases_and_deaths')
+    csv_path = str(tmp_path / 'cases_and_deaths.csv')
+    data.to_csv(csv_path, index=False)
+    dataset.write_artifact(data, artifact_path)
+
+    cases_cube, version = dataset.load_cases_cube(artifact_path, csv_path)
+    assert version == dataset.read_meta(artifact_path)['version']
+    assert isinstance(cases_cube.values, np.memmap)
+
+    meta = dataset.read_meta(artifact_path)
+    meta['format'] = dataset.ARTIFACT_FORMAT - 1
+    with open(os.path.join(artifact_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    cases_cube, version = dataset.load_cases_cube(artifact_path, csv_path)
+    assert version.startswith('csv-')
+    assert not isinstance(cases_cube.values, np.memmap)
+    assert cases_cube.metro_counties == {('Chicago', 'IL'): [('Cook', 2)]}
+
+
+def test_from_data_of_categoricals_matches_strings():
+    data = long_data()
+    data['city'] = dataset.clean_city_names(data['city'])
+    categorical = data.astype({column: 'category' for column in cube.ENTITY_COLUMNS})
+
+    expected = cube.from_data(data)
+    result = cube.from_data({column: categorical[column] for column in categorical.columns})
+
+    assert result.entities.values.tolist() == [['IL', '', ''], ['IL', 'Chicago', ''], ['IL', 'Chicago', 'Cook']]
+    assert expected.entities.equals(result.entities)
+    np.testing.assert_array_equal(expected.values, result.values)
+    assert result.states == {'IL': 0}
+    assert result.metro_counties == {('Chicago', 'IL'): [('Cook', 2)]}
+
+
+
+def series_cube(cases, population=50000.0, derived_cache_entries=cube.DERIVED_CACHE_ENTRIES):
+    """
+    A cube of one state with the given cumulative cases, and as many deaths
+    """
+    cases = np.asarray(cases, dtype=np.float32)
+    values = np.stack([cases, cases])[:, np.newaxis, :]
+    dates = np.datetime64('2020-03-01') + np.arange(len(cases))
+    entities = pd.DataFrame([['IL', '', '']], columns=cube.ENTITY_COLUMNS)
+    return cube.Cube(values, dates, np.array([0]), np.array([len(cases) - 1]), np.array([population]), entities,
+                     derived_cache_entries=derived_cache_entries)
+
+
+def random_cases(num_days=60, seed=0):
+    return np.cumsum(np.random.default_rng(seed).integers(0, 50, num_days))
+
+
+def test_derived_counts_per_100k():
+    cases_cube = series_cube([1, 3, 6, 6, 10])
+
+    np.testing.assert_allclose(cases_cube.derived(0, 'cases'), [2, 6, 12, 12, 20])
+    # The first day has no daily change
+    np.testing.assert_allclose(cases_cube.derived(0, 'new_cases'), [0, 4, 6, 0, 8])
+
+
+def test_derived_smooths_the_daily_changes_before_normalizing():
+    cases = random_cases()
+    cases_cube = series_cube(cases)
+
+    for window in smoothing.WINDOW_LENGTHS:
+        new_cases = np.diff(cases, prepend=cases[:1]).astype(np.float64)
+        expected = signal.savgol_filter(new_cases, window, smoothing.POLYORDER) / 50000 * 100000
+        np.testing.assert_allclose(cases_cube.derived(0, 'new_cases', window), expected)
+
+        # Smoothing the cumulative counts and then taking their daily changes gives another series
+        smoothed_first = np.diff(signal.savgol_filter(cases.astype(np.float64), window, 1), prepend=np.nan)
+        assert not np.allclose(cases_cube.derived(0, 'new_cases', window)[1:], smoothed_first[1:] / 50000 * 100000)
+
+
+def test_derived_of_a_line_starting_late_covers_its_dates():
+    cases_cube = series_cube([1, 3, 6, 6, 10])
+    cases_cube.first[0] = 2
+
+    np.testing.assert_allclose(cases_cube.derived(0, 'new_cases'), [0, 0, 8])
+    dates, values = cases_cube.series(0, 'cases', 0, 5)
+    assert dates[0] == np.datetime64('2020-03-03')
+    np.testing.assert_allclose(values, [12, 12, 20])
+
+
+def test_derived_cache_is_a_bounded_lru():
+    cases_cube = series_cube(random_cases(), derived_cache_entries=2)
+
+    cases = cases_cube.derived(0, 'cases')
+    new_cases = cases_cube.derived(0, 'new_cases')
+    assert cases_cube.derived(0, 'cases') is cases
+    # new_cases is now the least recently used
+    cases_cube.derived(0, 'deaths')
+
+    assert list(cases_cube._derived) == [(0, 'cases', 0), (0, 'deaths', 0)]
+    assert cases_cube.derived(0, 'new_cases') is not new_cases
+    assert not cases.flags.writeable
+
+
+def test_derived_cache_is_shared_by_threads():
+    cases_cube = series_cube(random_cases(), derived_cache_entries=3)
+    keys = [(metric, window) for metric in ['cases', 'new_cases', 'deaths', 'new_deaths'] for window in [0] + smoothing.WINDOW_LENGTHS]
+    expected = {key: cases_cube.derived(0, *key).copy() for key in keys}
+    errors = []
+
+    def read():
+        try:
+            for _ in range(20):
+                for key in keys:
+                    np.testing.assert_allclose(cases_cube.derived(0, *key), expected[key])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(cases_cube._derived) == 3
+
+
+def test_window_lengths():
+    assert smoothing.WINDOW_LENGTHS == [7, 13, 21]
+    assert smoothing.WINDOW_LENGTH in smoothing.WINDOW_LENGTHS
+
+
+def test_fitted_window_of_short_series():
+    assert smoothing.fitted_window(30, 21) == 21
+    assert smoothing.fitted_window(21, 21) == 21
+    # The largest odd window that fits
+    assert smoothing.fitted_window(10, 21) == 9
+    assert smoothing.fitted_window(9, 21) == 9
+    assert smoothing.fitted_window(3, 7) == 3
+    # No window fits a line through less than 3 points
+    assert smoothing.fitted_window(2, 7) is None
+    assert smoothing.fitted_window(1, 7) is None
+
+
+def test_smooth_series_shorter_than_the_window():
+    values = np.diff(random_cases(10)).astype(np.float64)
+
+    np.testing.assert_allclose(smoothing.smooth_series(values, 21), signal.savgol_filter(values, 9, 1))
+    np.testing.assert_array_equal(smoothing.smooth_series(values[:2], 7), values[:2])
+
+    cases_cube = series_cube(random_cases(10))
+    np.testing.assert_allclose(cases_cube.derived(0, 'new_cases', 21), cases_cube.derived(0, 'new_cases', 9))
@@ -0,0 +1,25 @@
+import figure_cache
+
+
+def key(states_list, state_or_metro, metros_per_state, cases_by_county):
+    return figure_cache.make_key(states_list, state_or_metro, metros_per_state, '2020-03-01', '2020-06-01T00:00:00',
+                                 cases_by_county, 7, 'cases', 'new')
+
+
+def test_equivalent_inputs_share_a_key():
+    assert key(['WI', 'IL', 'IL'], 'state', 3, []) == key(['IL', 'WI'], 'state', 3, [])
+    assert key(['IL'], 'state', 3, []) == figure_cache.make_key(['IL'], 'state', 3, '2020-03-01T00:00:00', '2020-06-01', [], '7', 'cases', 'new', 4)
+
+
+def test_metros_per_state_only_keys_plots_it_changes():
+    # The state view plots the states themselves
+    assert key(['IL'], 'state', 3, []) == key(['IL'], 'state', 5, []) == key(['IL'], 'state', None, [])
+    assert key(['IL'], 'state_metro', 3, []) != key(['IL'], 'state_metro', 5, [])
+    # The county facets of a state only hold the counties of its largest metros
+    assert key(['IL'], 'state', 3, [1]) != key(['IL'], 'state', 5, [1])
+
+
+def test_metros_per_state_only_keys_series_it_changes():
+    assert figure_cache.make_series_key(['IL'], 'state', 3, []) == figure_cache.make_series_key(['IL'], 'state', 0, [])
+    assert figure_cache.make_series_key(['IL'], 'state_metro', 3, []) != figure_cache.make_series_key(['IL'], 'state_metro', 0, [])
+    assert figure_cache.make_series_key(['IL'], 'state', 3, [1], 2) != figure_cache.make_series_key(['IL'], 'state', 0, [1], 2)
@@ -0,0 +1,42 @@
+def dependencies(dashboard):
+    return dashboard.app.server.test_client().get('/_dash-dependencies').get_json()
+
+
+def test_controls_never_reach_the_server(dashboard):
+    controls = {'date-range', 'smooth-cases', 'cases-or-deaths', 'cumulative-or-new', 'metric-map-toggle'}
+
+    for dependency in dependencies(dashboard):
+        if 'metric-map' not in dependency['output'] or dependency.get('clientside_function'):
+            continue
+        # Server callbacks of the map: the browser asks for its series once per data version while it is
+        # shown, and draws it for any controls
+        assert [i['id'] for i in dependency['inputs']] == ['metric-map-series-request']
+        assert not controls & set(i['id'] for i in dependency['state'])
+
+
+def test_produce_metric_map_series_sends_every_state(dashboard):
+    data = dashboard.data_snapshot
+
+    response = dashboard.app.server.test_client().post('/_dash-update-component', json={
+        'output': 'metric-map-series.data',
+        'outputs': {'id': 'metric-map-series', 'property': 'data'},
+        'inputs': [{'id': 'metric-map-series-request', 'property': 'data', 'value': data.version}],
+        'state': [{'id': 'session-id', 'property': 'data', 'value': 'session'}],
+        'changedPropIds': ['metric-map-series-request.data'],
+    })
+    assert response.status_code == 200
+    series = response.get_json()['response']['metric-map-series']['data']
+
+    assert series['version'] == data.version
+    assert series['trace']['locations'] == list(data.states['state_abbreviation'])
+    assert len(series['lines']) == len(series['trace']['locations'])
+    assert len(series['dates']) == len(data.cube.dates)
+
+
+def test_build_metric_map_has_a_frame_per_date(dashboard):
+    data = dashboard.data_snapshot
+    figure = dashboard.build_metric_map(data, data.min_date, data.max_date, 'new_deaths', 'Daily New Deaths', 7)
+
+    assert len(figure['frames']) == len(data.cube.dates)
+    assert figure['layout']['sliders'][0]['active'] == len(data.cube.dates) - 1
+    assert figure['data'][0]['colorbar']['title']['text'] == 'Daily New Deaths<br>per 100k'
@@ -0,0 +1,43 @@
+import numpy as np
+
+import payload
+
+
+def test_lttb_keeps_endpoints_and_threshold_points():
+    rng = np.random.default_rng(0)
+    x = np.arange(1000)
+    y = rng.normal(size=1000).cumsum()
+
+    keep = payload.lttb(x, y, 100)
+
+    assert len(keep) == 100
+    assert keep[0] == 0
+    assert keep[-1] == 999
+    assert np.all(np.diff(keep) > 0)
+
+
+def test_lttb_keeps_short_series_unchanged():
+    x = np.arange(50)
+    y = np.sin(x)
+
+    np.testing.assert_array_equal(payload.lttb(x, y, 50), x)
+    np.testing.assert_array_equal(payload.lttb(x, y, 100), x)
+
+
+def test_lttb_keeps_spikes():
+    x = np.arange(500)
+    y = np.zeros(500)
+    y[123] = 10
+
+    assert 123 in payload.lttb(x, y, 20)
+
+
+def test_compact_series_downsamples_to_max_points():
+    dates = np.arange('2020-01-01', '2021-01-01', dtype='datetime64[D]')
+    values = np.linspace(0, 1000, len(dates))
+
+    x, y = payload.compact_series(dates, values, 50)
+
+    assert len(x) == len(y) == 50
+    assert x[0] == '2020-01-01'
+    assert x[-1] == '2020-12-31'
@@ -0,0 +1,235 @@
+import threading
+import time
+
+import dash
+import pytest
+import werkzeug
+
+import figure_cache
+import scheduler
+
+
+def start(function):
+    """
+    Run function in a thread, returns the thread and a list receiving its result or exception
+    """
+    outcome = []
+
+    def target():
+        try:
+            outcome.append(function())
+        except Exception as e:
+            outcome.append(e)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread, outcome
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def hold_slot(build_scheduler, session):
+    """
+    Take a slot of build_scheduler for session until the returned event is set
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def build():
+        started.set()
+        release.wait(5)
+        return 'held'
+
+    thread, outcome = start(lambda: build_scheduler.run(session, build))
+    assert started.wait(5)
+    return release, thread, outcome
+
+
+def test_run_returns_the_build():
+    build_scheduler = scheduler.BuildScheduler(slots=1)
+
+    assert build_scheduler.run('a', lambda: 42) == 42
+    assert build_scheduler.stats()['completed'] == 1
+
+
+def test_busy_when_too_many_requests_wait():
+    build_scheduler = scheduler.BuildScheduler(slots=1, max_waiting=1, wait_seconds=5)
+    release, holder, _ = hold_slot(build_scheduler, 'a')
+
+    # b waits for the slot, c finds the waiting list full
+    waiter, waiter_outcome = start(lambda: build_scheduler.run('b', lambda: 'b'))
+    wait_for(lambda: build_scheduler.stats()['waiting'] == 1)
+    with pytest.raises(scheduler.Busy):
+        build_scheduler.run('c', lambda: 'c')
+
+    release.set()
+    holder.join()
+    waiter.join()
+    assert waiter_outcome == ['b']
+    assert build_scheduler.stats()['rejected'] == 1
+
+
+def test_busy_when_no_slot_frees_up_in_time():
+    build_scheduler = scheduler.BuildScheduler(slots=1, wait_seconds=0.1)
+    release, holder, _ = hold_slot(build_scheduler, 'a')
+
+    with pytest.raises(scheduler.Busy):
+        build_scheduler.run('b', lambda: 'b')
+
+    release.set()
+    holder.join()
+
+
+def test_waiting_request_superseded_by_a_newer_one_of_its_session():
+    build_scheduler = scheduler.BuildScheduler(slots=1, wait_seconds=5)
+    release, holder, _ = hold_slot(build_scheduler, 'a')
+
+    older, older_outcome = start(lambda: build_scheduler.run('b', lambda: 'older'))
+    wait_for(lambda: build_scheduler.stats()['waiting'] == 1)
+    newer, newer_outcome = start(lambda: build_scheduler.run('b', lambda: 'newer'))
+    older.join(5)
+    assert isinstance(older_outcome[0], scheduler.Superseded)
+
+    release.set()
+    newer.join(5)
+    assert newer_outcome == ['newer']
+    assert build_scheduler.stats()['superseded'] == 1
+
+
+def test_running_build_stops_at_check_when_superseded():
+    build_scheduler = scheduler.BuildScheduler(slots=2)
+    started = threading.Event()
+
+    def build():
+        started.set()
+        while True:
+            build_scheduler.check()
+
+    running, outcome = start(lambda: build_scheduler.run('a', build))
+    assert started.wait(5)
+    assert build_scheduler.run('a', lambda: 'newer') == 'newer'
+    running.join(5)
+    assert isinstance(outcome[0], scheduler.Superseded)
+
+
+def test_sessions_do_not_supersede_each_other():
+    build_scheduler = scheduler.BuildScheduler(slots=2)
+    release, holder, outcome = hold_slot(build_scheduler, 'a')
+
+    assert build_scheduler.run('b', lambda: 'b') == 'b'
+    release.set()
+    holder.join()
+    assert outcome == ['held']
+
+
+def test_check_outside_of_run_does_nothing():
+    scheduler.BuildScheduler().check()
+
+
+def cases_plot_inputs(dashboard, states_list):
+    data = dashboard.data_snapshot
+    return (states_list, 'state', dashboard.default_metros_per_state, data.min_date.strftime('%Y-%m-%d'),
+            data.max_date.strftime('%Y-%m-%d'), [], 0, 'cases', 'new', 0)
+
+
+def test_busy_callback_answers_503(dashboard, monkeypatch):
+    # No request may wait, so every build is turned away
+    monkeypatch.setattr(dashboard, 'build_scheduler', scheduler.BuildScheduler(max_waiting=0))
+    states_list = sorted(dashboard.data_snapshot.cube.states)[:3]
+
+    with pytest.raises(werkzeug.exceptions.HTTPException) as error:
+        dashboard.produce_cases_plot(*cases_plot_inputs(dashboard, states_list), 'session')
+    assert error.value.response.status_code == 503
+    assert error.value.response.headers['Retry-After'] == '1'
+
+
+def test_superseded_callback_prevents_update(dashboard, monkeypatch):
+    build_scheduler = scheduler.BuildScheduler()
+    monkeypatch.setattr(dashboard, 'build_scheduler', build_scheduler)
+    states_list = sorted(dashboard.data_snapshot.cube.states)[3:6]
+    started = threading.Event()
+    newer = threading.Event()
+
+    # A newer request of the session arrives while the figure is built
+    build_cases_plot = dashboard.build_cases_plot
+
+    def slow_build(*args):
+        started.set()
+        newer.wait(5)
+        return build_cases_plot(*args)
+
+    monkeypatch.setattr(dashboard, 'build_cases_plot', slow_build)
+    older, outcome = start(lambda: dashboard.produce_cases_plot(*cases_plot_inputs(dashboard, states_list), 'session'))
+    assert started.wait(5)
+    build_scheduler.run('session', lambda: None)
+    newer.set()
+    older.join(5)
+
+    assert isinstance(outcome[0], dash.exceptions.PreventUpdate)
+
+
+def test_busy_series_callbacks_answer_503(dashboard, monkeypatch):
+    monkeypatch.setattr(dashboard, 'build_scheduler', scheduler.BuildScheduler(max_waiting=0))
+    # Nothing is served from the cache
+    monkeypatch.setattr(dashboard, 'cases_plot_cache', figure_cache.FigureCache())
+    states_list = sorted(dashboard.data_snapshot.cube.states)[6:9]
+
+    for produce in [lambda: dashboard.produce_plot_series(states_list, 'state_metro', 2, [], 0, None, 'session'),
+                    lambda: dashboard.produce_metric_map_series(None, 'session')]:
+        with pytest.raises(werkzeug.exceptions.HTTPException) as error:
+            produce()
+        assert error.value.response.status_code == 503
+
+
+def test_entered_request_supersedes_a_waiting_one():
+    build_scheduler = scheduler.BuildScheduler(slots=1, wait_seconds=5)
+    release, holder, _ = hold_slot(build_scheduler, 'a')
+
+    older, outcome = start(lambda: build_scheduler.run('b', lambda: 'older'))
+    wait_for(lambda: build_scheduler.stats()['waiting'] == 1)
+    request = build_scheduler.enter('b')
+    older.join(5)
+    assert isinstance(outcome[0], scheduler.Superseded)
+
+    build_scheduler.check_latest('b', request)
+    release.set()
+    holder.join()
+
+
+def test_cached_newer_request_supersedes_a_running_build(dashboard, monkeypatch):
+    build_scheduler = scheduler.BuildScheduler()
+    monkeypatch.setattr(dashboard, 'build_scheduler', build_scheduler)
+    cases_plot_cache = figure_cache.FigureCache()
+    cases_plot_cache.invalidate(dashboard.data_snapshot.version)
+    monkeypatch.setattr(dashboard, 'cases_plot_cache', cases_plot_cache)
+    states = sorted(dashboard.data_snapshot.cube.states)
+
+    # The newer request of the session is served from the cache
+    cached = dashboard.cases_plot(dashboard.data_snapshot, *cases_plot_inputs(dashboard, states[:2]))
+
+    started = threading.Event()
+    newer = threading.Event()
+    build_cases_plot = dashboard.build_cases_plot
+
+    def slow_build(*args):
+        # Past the last check of the build when the newer request arrives
+        figure = build_cases_plot(*args)
+        started.set()
+        newer.wait(5)
+        return figure
+
+    monkeypatch.setattr(dashboard, 'build_cases_plot', slow_build)
+    older, outcome = start(lambda: dashboard.produce_cases_plot(*cases_plot_inputs(dashboard, states[2:4]), 'session'))
+    assert started.wait(5)
+    assert dashboard.produce_cases_plot(*cases_plot_inputs(dashboard, states[:2]), 'session') is cached
+    newer.set()
+    older.join(5)
+
+    assert isinstance(outcome[0], dash.exceptions.PreventUpdate)
+    # The older figure is still cached for later requests
+    assert dashboard.cases_plot_cache.stats()['entries'] == 2
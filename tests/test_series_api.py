@@ -0,0 +1,88 @@
+import gzip
+import json
+
+import brotli
+import flask
+import pytest
+
+import scheduler
+import series_api
+
+
+@pytest.fixture
+def make_client(dashboard):
+    """
+    A test client of a fresh SeriesAPI over the data of the dashboard, taking the arguments of SeriesAPI
+    """
+    def make(**kwargs):
+        server = flask.Flask(__name__)
+        api = series_api.SeriesAPI(lambda: dashboard.data_snapshot, **kwargs)
+        server.add_url_rule('/api/series.<fmt>', 'series_api', api.serve)
+        return api, server.test_client()
+    return make
+
+
+def some_states(dashboard, count=2):
+    return ','.join(sorted(dashboard.data_snapshot.cube.states)[:count])
+
+
+def test_start_after_end_is_a_bad_request(dashboard, make_client):
+    _, client = make_client()
+
+    response = client.get('/api/series.json?start=2020-03-10&end=2020-03-01')
+
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'start must not be after end'}
+
+
+def test_county_level_requires_states(dashboard, make_client):
+    _, client = make_client()
+
+    assert client.get('/api/series.csv?level=county').status_code == 400
+    assert client.get('/api/series.csv?level=county&states=' + some_states(dashboard)).status_code == 200
+
+
+def test_queries_over_max_values_are_bad_requests(dashboard, make_client):
+    num_dates = len(dashboard.data_snapshot.cube.dates)
+    _, client = make_client(max_values=2*num_dates)
+
+    assert client.get('/api/series.json?states=' + some_states(dashboard, 2)).status_code == 200
+    response = client.get('/api/series.json?states=' + some_states(dashboard, 3))
+    assert response.status_code == 400
+    assert 'fewer states' in response.get_json()['error']
+
+
+def test_busy_builds_answer_503(dashboard, make_client):
+    _, client = make_client(build_scheduler=scheduler.BuildScheduler(max_waiting=0))
+
+    response = client.get('/api/series.json')
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_only_requested_encodings_are_compressed(dashboard, make_client):
+    api, client = make_client()
+    path = '/api/series.json?level=metro&states=' + some_states(dashboard)
+
+    identity = client.get(path, headers={'Accept-Encoding': 'identity'})
+    compressed = client.get(path, headers={'Accept-Encoding': 'gzip'})
+
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == identity.data
+    assert json.loads(identity.data)['series']
+    assert api.cache.stats()['entries'] == 2
+
+    compressed = client.get(path, headers={'Accept-Encoding': 'br'})
+    assert brotli.decompress(compressed.data) == identity.data
+    assert api.cache.stats()['entries'] == 3
+
+
+def test_etag_revalidates(dashboard, make_client):
+    _, client = make_client()
+
+    response = client.get('/api/series.csv')
+    revalidated = client.get('/api/series.csv', headers={'If-None-Match': response.headers['ETag']})
+
+    assert response.status_code == 200
+    assert revalidated.status_code == 304
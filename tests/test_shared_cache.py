@@ -0,0 +1,120 @@
+import threading
+import time
+
+import figure_cache
+import shared_cache
+
+
+def dumps(value):
+    return value.encode()
+
+
+def loads(value):
+    return bytes(value).decode()
+
+
+def test_value_is_computed_once_and_shared(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    first, second = shared_cache.SQLiteCache(path), shared_cache.SQLiteCache(path)
+    computed = []
+
+    def compute():
+        computed.append(1)
+        return 'figure'
+
+    assert first.get_or_compute('key', 'v1', compute, dumps, loads) == 'figure'
+    assert second.get_or_compute('key', 'v1', compute, dumps, loads) == 'figure'
+    assert len(computed) == 1
+    assert first.stats()['misses'] == 1
+    assert second.stats()['hits'] == 1
+
+
+def test_workers_missing_the_same_key_wait_for_the_one_computing_it(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    first, second = shared_cache.SQLiteCache(path), shared_cache.SQLiteCache(path)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_compute():
+        started.set()
+        release.wait(5)
+        return 'first'
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(first.get_or_compute('key', 'v1', slow_compute, dumps, loads)))
+    thread.start()
+    assert started.wait(5)
+
+    # The second worker finds the lock row and waits instead of computing
+    waiter = threading.Thread(target=lambda: results.append(second.get_or_compute('key', 'v1', lambda: 'second', dumps, loads)))
+    waiter.start()
+    deadline = time.monotonic() + 5
+    while second.stats()['waits'] == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+    release.set()
+    thread.join(5)
+    waiter.join(5)
+    assert results == ['first', 'first']
+    assert second.stats()['misses'] == 0
+
+
+def test_entries_are_only_served_for_their_version(tmp_path):
+    cache = shared_cache.SQLiteCache(str(tmp_path / 'cache.sqlite3'))
+
+    cache.get_or_compute('key', 'v1', lambda: 'old', dumps, loads)
+    assert cache.get_or_compute('key', 'v2', lambda: 'new', dumps, loads) == 'new'
+    assert cache.get_or_compute('key', 'v2', lambda: 'newer', dumps, loads) == 'new'
+
+    cache.put('other', 'v1', b'old')
+    cache.purge('v2')
+    assert cache.get('other', 'v1') is None
+    assert cache.stats()['entries'] == 1
+
+
+def test_expired_lock_of_a_dead_worker_is_taken_over(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+
+    # A worker took the lock of the key and died before computing it
+    dead = shared_cache.SQLiteCache(path, lock_seconds=0.2)
+    assert dead._lock('key')
+
+    cache = shared_cache.SQLiteCache(path)
+    start = time.monotonic()
+    assert cache.get_or_compute('key', 'v1', lambda: 'figure', dumps, loads) == 'figure'
+    assert 0.2 <= time.monotonic() - start < 5
+    assert cache.stats()['waits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_put_evicts_least_recently_used_entries(tmp_path):
+    cache = shared_cache.SQLiteCache(str(tmp_path / 'cache.sqlite3'), max_bytes=10)
+
+    cache.put('a', 'v1', b'12345')
+    cache.put('b', 'v1', b'12345')
+    cache.put('c', 'v1', b'12345')
+    cache.put('too large', 'v1', b'12345678901')
+
+    assert cache.get('a', 'v1') is None
+    assert cache.get('too large', 'v1') is None
+    assert cache.stats()['bytes'] <= 10
+
+
+def test_cached_figure_serializes_a_built_figure_once(dashboard, monkeypatch, tmp_path):
+    monkeypatch.setattr(dashboard, 'shared_results', shared_cache.SQLiteCache(str(tmp_path / 'cache.sqlite3')))
+    serialized = []
+    figure_json = figure_cache.figure_json
+
+    def counted_figure_json(figure):
+        serialized.append(figure_json(figure))
+        return serialized[-1]
+
+    monkeypatch.setattr(figure_cache, 'figure_json', counted_figure_json)
+    key = ('test', 'serialized once')
+
+    dashboard.cached_figure(dashboard.data_snapshot, key, lambda: {'data': [], 'layout': {'title': 'test'}})
+
+    assert len(serialized) == 1
+    assert dashboard.cases_plot_cache.get(key) == {'data': [], 'layout': {'title': 'test'}}
+    assert dashboard.cases_plot_cache.stats()['bytes'] >= len(serialized[0])
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+
+class WeekendShading:
+    """
+    The gray bars shading weekends on the plots.
+
+    Weekends are computed once from the dates in the data and kept as a sorted array of Saturdays, with
+    the shape bounds already formatted the way plotly serializes them. The shapes for a date range are
+    then a binary search and a slice away.
+    """
+    def __init__(self, dates):
+        dates = pd.DatetimeIndex(pd.unique(dates))
+
+        # A weekend is shown if either of its days is present in the data
+        present_saturdays = dates[dates.dayofweek == 5]
+        implied_saturdays = dates[dates.dayofweek == 6] - pd.Timedelta(days=1)
+        saturdays = present_saturdays.union(implied_saturdays).sort_values()
+
+        # Each bar runs from 0.4 days before Saturday to 1.4 days after it
+        self.saturdays = saturdays.values
+        self._x0 = [i.isoformat() for i in saturdays - pd.Timedelta('9h36m')]
+        self._x1 = [i.isoformat() for i in saturdays + pd.Timedelta('33h36m')]
+
+    def __len__(self):
+        return len(self.saturdays)
+
+    def bounds(self):
+        """
+        The Saturday, x0 and x1 of every weekend, for drawing the shapes in the browser
+        """
+        return [[saturday, x0, x1] for saturday, x0, x1 in
+                zip(np.datetime_as_string(self.saturdays, unit='D').tolist(), self._x0, self._x1)]
+
+    def index_range(self, first_date, last_date):
+        """
+        Positions of the weekends with at least one day between first_date and last_date
+        """
+        first_saturday = np.datetime64(pd.Timestamp(first_date) - pd.Timedelta(days=1))
+        last_saturday = np.datetime64(pd.Timestamp(last_date))
+
+        start = np.searchsorted(self.saturdays, first_saturday, side='left')
+        stop = np.searchsorted(self.saturdays, last_saturday, side='right')
+        return start, stop
+
+    def shapes(self, first_date, last_date, xref='x', yref='paper', y0=0, y1=1):
+        """
+        One rect shape per weekend in the date range. With the default paper y reference a single set of
+        shapes spans every subplot sharing the x axis.
+        """
+        start, stop = self.index_range(first_date, last_date)
+
+        return [dict(
+            type="rect",
+            xref=xref,
+            yref=yref,
+            x0=self._x0[i],
+            y0=y0,
+            x1=self._x1[i],
+            y1=y1,
+            fillcolor="black",
+            opacity=0.04,
+            layer="below",
+            line=dict(width=0.0)
+        ) for i in range(start, stop)]